@@ -0,0 +1,123 @@
+import collections
+import threading
+
+import torch
+
+
+def allocator_stats(device=None):
+    """
+    The CUDA caching allocator's counters that show whether serving still allocates: `segments_allocated` counts
+    the device allocations it made (cumulative, flat in steady state), `reserved_bytes` the memory it holds,
+    `fragmented_bytes` the unused parts of split blocks and `alloc_retries` the times it had to free its cache to
+    satisfy a request. Empty without CUDA.
+    """
+    if not torch.cuda.is_available():
+        return {}
+    stats = torch.cuda.memory_stats(device)
+    return {
+        "segments_allocated": stats.get("segment.all.allocated", 0),
+        "reserved_bytes": stats.get("reserved_bytes.all.current", 0),
+        "fragmented_bytes": stats.get("inactive_split_bytes.all.current", 0),
+        "alloc_retries": stats.get("num_alloc_retries", 0),
+    }
+
+
+def nbytes(tensor):
+    return tensor.numel() * tensor.element_size()
+
+
+class BufferArena:
+    """
+    Pools of preallocated tensors for the buffers every request needs — latents, denoised predictions, noise,
+    control images and decoded images — keyed by shape, dtype and device, i.e. by resolution bucket and batch size.
+    A request takes its buffers when it is admitted and gives them back once it is decoded, so in steady state
+    requests of a shape seen before reuse the buffers of an earlier one instead of allocating.
+
+    Buffers are handed out uninitialized. Host buffers are page-locked when CUDA is available. Free buffers are
+    kept up to `budget` bytes, least recently used first out. Buffers that are never given back, e.g. by a failed
+    request, are freed as usual. Allocations, reuses and the pool size go to `metrics` under `arena.`, and
+    `allocator_stats` under `allocator.` whenever buffers are given back.
+    """
+
+    def __init__(self, budget, metrics=None):
+        self.budget = budget
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        # (shape, dtype, device, memory format) -> free buffers, least recently used first
+        self.free = collections.OrderedDict()
+        self.free_bytes = 0
+        self.counts = collections.Counter()
+
+    def take(self, shape, dtype, device, memory_format=torch.contiguous_format):
+        """
+        A buffer of `shape` and `dtype` on `device`, laid out in `memory_format`, reused from the pool if there is
+        one
+        """
+        device = torch.device(device)
+        if device.type == "cuda" and device.index is None:
+            # the key of a buffer is the device it is on
+            device = torch.device("cuda", torch.cuda.current_device())
+        key = (tuple(shape), dtype, device, memory_format)
+        with self.lock:
+            pool = self.free.get(key)
+            if pool:
+                buffer = pool.pop()
+                if not pool:
+                    del self.free[key]
+                self.free_bytes -= nbytes(buffer)
+                self.counts["reuses"] += 1
+                return buffer
+            self.counts["allocations"] += 1
+        if device.type == "cpu":
+            return torch.empty(
+                shape,
+                dtype=dtype,
+                pin_memory=torch.cuda.is_available(),
+                memory_format=memory_format,
+            )
+        return torch.empty(
+            shape, dtype=dtype, device=device, memory_format=memory_format
+        )
+
+    def give(self, buffers):
+        """
+        Return `buffers` to the pool. Device work already queued on them still runs first, as later users queue
+        theirs on the same stream.
+        """
+        with self.lock:
+            for buffer in buffers:
+                memory_format = (
+                    torch.contiguous_format
+                    if buffer.is_contiguous()
+                    else torch.channels_last
+                )
+                key = (tuple(buffer.shape), buffer.dtype, buffer.device, memory_format)
+                self.free.setdefault(key, []).append(buffer)
+                self.free.move_to_end(key)
+                self.free_bytes += nbytes(buffer)
+            while self.free_bytes > self.budget:
+                key, pool = next(iter(self.free.items()))
+                self.free_bytes -= nbytes(pool.pop(0))
+                if not pool:
+                    del self.free[key]
+                self.counts["evictions"] += 1
+            stats = self._stats()
+        if self.metrics is not None:
+            for name, value in stats.items():
+                self.metrics.set(f"arena.{name}", value)
+            for name, value in allocator_stats().items():
+                self.metrics.set(f"allocator.{name}", value)
+
+    def stats(self):
+        """Buffers allocated, reused and evicted so far, and the free buffers in the pool"""
+        with self.lock:
+            return self._stats()
+
+    def _stats(self):
+        return {
+            "allocations": self.counts["allocations"],
+            "reuses": self.counts["reuses"],
+            "evictions": self.counts["evictions"],
+            "free_buffers": sum(len(pool) for pool in self.free.values()),
+            "free_bytes": self.free_bytes,
+        }
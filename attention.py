@@ -0,0 +1,239 @@
+import math
+import time
+
+import torch
+from diffusers.models.attention_processor import Attention, AttnProcessor2_0
+from diffusers.models.controlnet import ControlNetModel
+from diffusers.utils import USE_PEFT_BACKEND
+
+BACKENDS = ["sdpa", "sliced", "chunked"]
+
+
+class SplitAttnProcessor:
+    r"""
+    Attention computed in pieces along dimension `dim` of the `(batch x heads, queries, keys)` scores, `size` at a
+    time, so that only one piece of the scores is in memory at once. Plain PyTorch, so it runs on CPU as well as GPU,
+    and the pieces are concatenated rather than written into a buffer, so it also works under `vmap`.
+    """
+
+    dim = 0
+
+    def __init__(self, size):
+        self.size = size
+
+    def __call__(
+        self,
+        attn: Attention,
+        hidden_states,
+        encoder_hidden_states=None,
+        attention_mask=None,
+        temb=None,
+        scale=1.0,
+    ):
+        residual = hidden_states
+        args = () if USE_PEFT_BACKEND else (scale,)
+
+        if attn.spatial_norm is not None:
+            hidden_states = attn.spatial_norm(hidden_states, temb)
+
+        input_ndim = hidden_states.ndim
+        if input_ndim == 4:
+            batch_size, channel, height, width = hidden_states.shape
+            hidden_states = hidden_states.view(
+                batch_size, channel, height * width
+            ).transpose(1, 2)
+
+        batch_size, sequence_length, _ = (
+            hidden_states.shape
+            if encoder_hidden_states is None
+            else encoder_hidden_states.shape
+        )
+        attention_mask = attn.prepare_attention_mask(
+            attention_mask, sequence_length, batch_size
+        )
+
+        if attn.group_norm is not None:
+            hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(
+                1, 2
+            )
+
+        query = attn.to_q(hidden_states, *args)
+        if encoder_hidden_states is None:
+            encoder_hidden_states = hidden_states
+        elif attn.norm_cross:
+            encoder_hidden_states = attn.norm_encoder_hidden_states(
+                encoder_hidden_states
+            )
+        key = attn.to_k(encoder_hidden_states, *args)
+        value = attn.to_v(encoder_hidden_states, *args)
+
+        query = attn.head_to_batch_dim(query)
+        key = attn.head_to_batch_dim(key)
+        value = attn.head_to_batch_dim(value)
+
+        pieces = []
+        for start in range(0, query.shape[self.dim], self.size):
+            end = start + self.size
+            if self.dim == 0:
+                q, k, v = query[start:end], key[start:end], value[start:end]
+                mask = attention_mask[start:end] if attention_mask is not None else None
+            else:
+                q, k, v = query[:, start:end], key, value
+                mask = (
+                    attention_mask[:, start:end]
+                    if attention_mask is not None and attention_mask.shape[1] > 1
+                    else attention_mask
+                )
+            probs = attn.get_attention_scores(q, k, mask)
+            pieces.append(torch.bmm(probs, v))
+        hidden_states = torch.cat(pieces, dim=self.dim)
+        hidden_states = attn.batch_to_head_dim(hidden_states)
+
+        # linear proj
+        hidden_states = attn.to_out[0](hidden_states, *args)
+        # dropout
+        hidden_states = attn.to_out[1](hidden_states)
+
+        if input_ndim == 4:
+            hidden_states = hidden_states.transpose(-1, -2).reshape(
+                batch_size, channel, height, width
+            )
+
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+
+        hidden_states = hidden_states / attn.rescale_output_factor
+
+        return hidden_states
+
+
+class SlicedAttnProcessor(SplitAttnProcessor):
+    """Attention for `size` of the batch x heads slices at a time"""
+
+    dim = 0
+
+
+class ChunkedAttnProcessor(SplitAttnProcessor):
+    """Attention for `size` queries at a time, so memory grows linearly with the token count"""
+
+    dim = 1
+
+
+class AttentionBackends:
+    """
+    Chooses the attention implementation of the UNets, ControlNets and VAEs it is applied to per resolution bucket.
+    `buckets` are pixel counts; an image uses the backend of the smallest bucket at least its size, or of the largest
+    bucket. The backends are
+
+    - "sdpa": `torch.nn.functional.scaled_dot_product_attention`, with flash or memory-efficient kernels where
+      PyTorch has them
+    - "sliced": attention for `slice_size` of the batch x heads slices at a time
+    - "chunked": attention for `chunk_size` queries at a time, which bounds memory on CPU as well as GPU
+
+    `select()` benchmarks them per bucket and picks the fastest that fits a memory budget. Models switch to the backend
+    of their input's size as they are called, so every model must only be called from one thread at a time.
+    """
+
+    def __init__(self, buckets, backend="sdpa", slice_size=4, chunk_size=1024):
+        if backend not in BACKENDS:
+            raise ValueError(
+                f"Unknown attention backend {backend}, expected one of {BACKENDS}"
+            )
+        self.buckets = sorted(buckets)
+        self.table = {bucket: backend for bucket in self.buckets}
+        self.processors = {
+            "sdpa": AttnProcessor2_0(),
+            "sliced": SlicedAttnProcessor(slice_size),
+            "chunked": ChunkedAttnProcessor(chunk_size),
+        }
+        # model -> (its attention modules, pixels per input element, current backend)
+        self.models = {}
+        self.handles = []
+
+    def backend_for(self, pixels):
+        for bucket in self.buckets:
+            if pixels <= bucket:
+                return self.table[bucket]
+        return self.table[self.buckets[-1]]
+
+    def apply(self, pipe):
+        """Hooks the UNet, the ControlNets (including the vmapped ones) and the VAE of `pipe`"""
+        scale = pipe.vae_scale_factor
+        models = [(pipe.unet, scale), (pipe.vae.encoder, 1), (pipe.vae.decoder, scale)]
+        controlnet = getattr(pipe, "controlnet", None)
+        if controlnet is not None:
+            models += [
+                (module, scale)
+                for module in controlnet.modules()
+                if isinstance(module, ControlNetModel)
+            ]
+            if hasattr(controlnet, "_batched_stack"):
+                models.append((controlnet._batched_stack[2], scale))
+
+        for model, scale in models:
+            if model in self.models:
+                continue
+            attentions = [m for m in model.modules() if isinstance(m, Attention)]
+            self.models[model] = [attentions, scale, None]
+            self.handles.append(
+                model.register_forward_pre_hook(self._switch, with_kwargs=True)
+            )
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        self.models = {}
+
+    def _switch(self, model, args, kwargs):
+        sample = args[0] if args else kwargs["sample"]
+        entry = self.models[model]
+        attentions, scale, current = entry
+        backend = self.backend_for(sample.shape[-2] * sample.shape[-1] * scale**2)
+        if backend != current:
+            processor = self.processors[backend]
+            for attention in attentions:
+                attention.set_processor(processor)
+            entry[2] = backend
+
+    def select(self, run, memory_budget, backends=BACKENDS):
+        """
+        Times `run(width, height)` with every backend at every bucket size and keeps the fastest whose peak device
+        memory fits `memory_budget`, or the one with the lowest peak if none does. Returns the measurements as
+        `{bucket: {backend: (seconds, peak_memory)}}`, with `None` for runs out of memory.
+        """
+        results = {}
+        for bucket in self.buckets:
+            # the largest square with sides a multiple of 8 within the bucket
+            size = math.isqrt(bucket) // 8 * 8
+            results[bucket] = {}
+            for backend in backends:
+                self.table[bucket] = backend
+                torch.cuda.empty_cache()
+                torch.cuda.synchronize()
+                torch.cuda.reset_peak_memory_stats()
+                start = time.perf_counter()
+                try:
+                    run(size, size)
+                    torch.cuda.synchronize()
+                except torch.cuda.OutOfMemoryError:
+                    results[bucket][backend] = None
+                    continue
+                results[bucket][backend] = (
+                    time.perf_counter() - start,
+                    torch.cuda.max_memory_allocated(),
+                )
+
+            measured = {b: r for b, r in results[bucket].items() if r is not None}
+            if not measured:
+                raise RuntimeError(
+                    f"Every attention backend ran out of memory at {size}x{size}"
+                )
+            fitting = [
+                b for b, (_, memory) in measured.items() if memory <= memory_budget
+            ]
+            if fitting:
+                self.table[bucket] = min(fitting, key=lambda b: measured[b][0])
+            else:
+                self.table[bucket] = min(measured, key=lambda b: measured[b][1])
+        return results
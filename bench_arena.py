@@ -0,0 +1,69 @@
+"""
+Benchmark for the buffer arena: serves rounds of ControlNet requests over a mix of sizes and batch sizes through
+the engine and reports, per round, the buffers the arena had to allocate and the device allocations the CUDA
+caching allocator made. After the first round both should stay flat.
+
+    python bench_arena.py --control-image input.png --sizes 512 768 --batch-sizes 1 4 --rounds 4
+"""
+
+import argparse
+import itertools
+import time
+
+from arena import allocator_stats
+from bench_early_stopping import PROMPTS
+from predict import Predictor
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512, 768])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--rounds", type=int, default=4)
+    parser.add_argument("--steps", type=int, default=4)
+    parser.add_argument("--control-image", required=True)
+    args = parser.parse_args()
+
+    predictor = Predictor()
+    predictor.setup()
+    arena = predictor.controlnet_pipe.arena
+    shapes = list(itertools.product(args.sizes, args.batch_sizes))
+
+    print(
+        f"{'round':>5} {'seconds':>8} {'arena allocs':>13} {'arena reuses':>13} {'segments':>9} {'fragmented MiB':>15}"
+    )
+    previous = {**arena.stats(), **allocator_stats()}
+    for number in range(args.rounds):
+        start = time.perf_counter()
+        # submitted together, so requests of different shapes are in flight at once
+        futures = [
+            predictor.submit(
+                dict(
+                    predictor.default_inputs(),
+                    prompt="\n".join(PROMPTS[:batch_size]),
+                    width=size,
+                    height=size,
+                    num_inference_steps=args.steps,
+                    control_image=args.control_image,
+                    seed=number,
+                )
+            )
+            for size, batch_size in shapes
+        ]
+        for future in futures:
+            future.result()
+        current = {**arena.stats(), **allocator_stats()}
+        print(
+            f"{number:>5} {time.perf_counter() - start:>8.2f} "
+            f"{current['allocations'] - previous['allocations']:>13} "
+            f"{current['reuses'] - previous['reuses']:>13} "
+            f"{current.get('segments_allocated', 0) - previous.get('segments_allocated', 0):>9} "
+            f"{current.get('fragmented_bytes', 0) / 2**20:>15.1f}"
+        )
+        previous = current
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Benchmark for broadcast inputs: prepares and runs ControlNet requests with a growing number of images per prompt and
+reports the device memory held by the prepared inputs, what they would take as copies per image, and the peak memory
+of the whole generation, both with the shared inputs broadcast and with them materialized as copies per image. It
+exits with status 1 if broadcasting saves less than `--min-saving` of the bytes of the copies it avoids.
+
+    python bench_broadcast.py --num-images 1 8 16 32 50
+"""
+
+import argparse
+import contextlib
+import sys
+
+import torch
+from PIL import Image
+
+import latent_consistency_controlnet
+from predict import CONTROLNET_MODELS, Predictor
+
+
+@contextlib.contextmanager
+def materialized():
+    """Repeat shared inputs as a copy per image, as before they were broadcast"""
+    repeat_rows = latent_consistency_controlnet.repeat_rows
+    latent_consistency_controlnet.repeat_rows = (
+        lambda tensor, repeats: tensor.repeat_interleave(repeats, dim=0)
+    )
+    try:
+        yield
+    finally:
+        latent_consistency_controlnet.repeat_rows = repeat_rows
+
+
+def measure(pipe, kwargs):
+    """The device memory held by the prepared inputs, and the peak memory of the generation above it"""
+    torch.cuda.empty_cache()
+    before = torch.cuda.memory_allocated()
+    state = pipe.prepare_generation(**kwargs)
+    inputs = torch.cuda.memory_allocated() - before
+    del state
+
+    torch.cuda.empty_cache()
+    torch.cuda.reset_peak_memory_stats()
+    before = torch.cuda.memory_allocated()
+    pipe(output_type="latent", **kwargs)
+    torch.cuda.synchronize()
+    return inputs, torch.cuda.max_memory_allocated() - before
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--num-images", type=int, nargs="+", default=[1, 8, 16, 32])
+    parser.add_argument("--steps", type=int, default=4)
+    parser.add_argument("--width", type=int, default=768)
+    parser.add_argument("--height", type=int, default=768)
+    parser.add_argument("--control-image", default=None, help="Control image")
+    parser.add_argument(
+        "--min-saving",
+        type=float,
+        default=0.5,
+        help="Least share of the bytes of the avoided copies the peak memory has to drop by",
+    )
+    args = parser.parse_args()
+
+    predictor = Predictor()
+    predictor.setup()
+    pipe = predictor.controlnet_pipe
+
+    if args.control_image:
+        image = Image.open(args.control_image).convert("RGB")
+    else:
+        image = Image.new("RGB", (args.width, args.height))
+    image = image.resize((args.width, args.height))
+    control_image = [image] * len(CONTROLNET_MODELS)
+
+    print(
+        f"{'images':>7} {'inputs (MiB)':>13} {'as copies (MiB)':>16} {'peak (MiB)':>11}"
+        f" {'copied peak (MiB)':>18} {'saved (MiB)':>12}"
+    )
+    failed = False
+    for num_images in args.num_images:
+        kwargs = dict(
+            prompt="A photo of a red fox in a snowy forest, golden hour",
+            width=args.width,
+            height=args.height,
+            num_inference_steps=args.steps,
+            control_image=control_image,
+            num_images_per_prompt=num_images,
+        )
+
+        # fresh generators for each run, so both sample the same noise
+        generator = [torch.Generator("cpu").manual_seed(i) for i in range(num_images)]
+        inputs, peak = measure(pipe, {**kwargs, "generator": generator})
+        with materialized():
+            generator = [
+                torch.Generator("cpu").manual_seed(i) for i in range(num_images)
+            ]
+            copies, copied_peak = measure(pipe, {**kwargs, "generator": generator})
+        saved = copied_peak - peak
+
+        print(
+            f"{num_images:>7} {inputs / 2**20:>13.1f} {copies / 2**20:>16.1f}"
+            f" {peak / 2**20:>11.1f} {copied_peak / 2**20:>18.1f} {saved / 2**20:>12.1f}"
+        )
+        expected = args.min_saving * (copies - inputs)
+        # nothing is broadcast for a single image
+        if expected > 0 and saved < expected:
+            print(
+                f"FAIL: {num_images} images save {saved / 2**20:.1f} MiB of peak memory, "
+                f"expected at least {expected / 2**20:.1f} MiB"
+            )
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Benchmark for ControlNet residual reuse: runs a fixed prompt set through the canny ControlNet at several intervals and
+reports the time per step, how far the images land from the ones sampled with the ControlNet at every step, and how
+well their edges still follow the control image.
+
+    python bench_controlnet_cache.py --control-image input.png --steps 8 --intervals 2 3 4
+"""
+
+import argparse
+import time
+
+import cv2 as cv
+import numpy as np
+import torch
+from PIL import Image
+
+from bench_early_stopping import PROMPTS, psnr
+from predict import CONTROLNET_MODELS, Predictor
+
+
+def run(pipe, args, control_image, controlnet_cache_interval):
+    generator = [
+        torch.Generator("cpu").manual_seed(args.seed + i) for i in range(len(PROMPTS))
+    ]
+    torch.cuda.synchronize()
+    start = time.perf_counter()
+    images = pipe(
+        prompt=PROMPTS,
+        width=args.width,
+        height=args.height,
+        num_inference_steps=args.steps,
+        guidance_scale=args.guidance_scale,
+        control_image=control_image,
+        generator=generator,
+        controlnet_cache_interval=controlnet_cache_interval,
+        output_type="np",
+    ).images
+    torch.cuda.synchronize()
+    return images, time.perf_counter() - start
+
+
+def edge_f1(images, edges, args, tolerance=2):
+    """
+    Mean F1 score of the canny edges of `images` against the control `edges`, counting edges within `tolerance`
+    pixels of each other as matching
+    """
+    kernel = np.ones((2 * tolerance + 1, 2 * tolerance + 1), np.uint8)
+    near_control = cv.dilate(edges, kernel) > 0
+    scores = []
+    for image in images:
+        image_edges = cv.Canny(
+            (image * 255).round().astype(np.uint8),
+            args.low_threshold,
+            args.high_threshold,
+        )
+        near_image = cv.dilate(image_edges, kernel) > 0
+        precision = near_control[image_edges > 0].mean() if image_edges.any() else 0.0
+        recall = near_image[edges > 0].mean() if edges.any() else 0.0
+        scores.append(
+            2 * precision * recall / (precision + recall) if precision + recall else 0.0
+        )
+    return float(np.mean(scores))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--control-image", required=True, help="Image to take edges from"
+    )
+    parser.add_argument("--intervals", type=int, nargs="+", default=[2, 3, 4])
+    parser.add_argument("--steps", type=int, default=8)
+    parser.add_argument("--width", type=int, default=768)
+    parser.add_argument("--height", type=int, default=768)
+    parser.add_argument("--guidance-scale", type=float, default=8.0)
+    parser.add_argument("--low-threshold", type=int, default=100)
+    parser.add_argument("--high-threshold", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    predictor = Predictor()
+    predictor.setup()
+    pipe = predictor.controlnet_pipe
+
+    image = Image.open(args.control_image).convert("RGB")
+    canny = predictor.control_image(
+        image.resize((args.width, args.height)),
+        args.low_threshold,
+        args.high_threshold,
+    )
+    edges = np.array(canny)
+    control_image = [None] * len(CONTROLNET_MODELS)
+    control_image[0] = canny
+
+    # one run to settle allocations before measuring
+    baseline, elapsed = run(pipe, args, control_image, None)
+    baseline, elapsed = run(pipe, args, control_image, None)
+
+    print(
+        f"{'interval':>9} {'ms/step':>8} {'speedup':>8}"
+        f" {'PSNR (dB)':>10} {'mean abs':>10} {'edge F1':>8}"
+    )
+    print(
+        f"{'none':>9} {1000 * elapsed / args.steps:>8.1f} {1.0:>8.2f}"
+        f" {'inf':>10} {0.0:>10.4f} {edge_f1(baseline, edges, args):>8.3f}"
+    )
+    for interval in args.intervals:
+        images, seconds = run(pipe, args, control_image, interval)
+        print(
+            f"{interval:>9} {1000 * seconds / args.steps:>8.1f} {elapsed / seconds:>8.2f}"
+            f" {psnr(images, baseline):>10.2f} {np.abs(images - baseline).mean():>10.4f}"
+            f" {edge_f1(images, edges, args):>8.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
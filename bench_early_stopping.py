@@ -0,0 +1,107 @@
+"""
+Benchmark for adaptive early stopping: runs a fixed prompt set at several convergence thresholds and reports the
+denoising steps saved and how far the images land from the ones sampled with every step.
+
+    python bench_early_stopping.py --steps 8 --thresholds 0.01 0.02 0.05
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from predict import CONTROLNET_MODELS, Predictor
+
+PROMPTS = [
+    "Self-portrait oil painting, a beautiful cyborg with golden hair, 8k",
+    "A photo of a red fox in a snowy forest, golden hour",
+    "An isometric illustration of a tiny city on a floating island",
+    "Close-up portrait of an old fisherman, dramatic lighting, 35mm",
+    "A bowl of ramen on a wooden table, studio photography",
+    "Watercolor painting of a lighthouse on a cliff at dawn",
+    "A futuristic sports car in a neon-lit street at night",
+    "A cozy reading nook with plants and sunlight, interior design",
+]
+
+
+def psnr(a, b):
+    mse = float(np.mean((a - b) ** 2))
+    return float("inf") if mse == 0 else 10 * np.log10(1.0 / mse)
+
+
+def run(pipe, args, control_image, convergence_threshold):
+    generator = [
+        torch.Generator("cpu").manual_seed(args.seed + i) for i in range(len(PROMPTS))
+    ]
+    torch.cuda.synchronize()
+    start = time.perf_counter()
+    output = pipe(
+        prompt=PROMPTS,
+        width=args.width,
+        height=args.height,
+        num_inference_steps=args.steps,
+        guidance_scale=args.guidance_scale,
+        control_image=control_image,
+        generator=generator,
+        convergence_threshold=convergence_threshold,
+        output_type="np",
+    )
+    torch.cuda.synchronize()
+    return output.images, output.steps_used, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--thresholds", type=float, nargs="+", default=[0.01, 0.02, 0.05]
+    )
+    parser.add_argument("--steps", type=int, default=8)
+    parser.add_argument("--width", type=int, default=768)
+    parser.add_argument("--height", type=int, default=768)
+    parser.add_argument("--guidance-scale", type=float, default=8.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--control-image",
+        default=None,
+        help="Canny ControlNet image; plain LCM sampling without one",
+    )
+    args = parser.parse_args()
+
+    predictor = Predictor()
+    predictor.setup()
+    pipe = predictor.controlnet_pipe
+
+    control_image = [None] * len(CONTROLNET_MODELS)
+    if args.control_image:
+        image = Image.open(args.control_image).convert("RGB")
+        control_image[0] = predictor.control_image(
+            image.resize((args.width, args.height)), 100, 200
+        )
+
+    # one run to settle allocations before measuring
+    baseline, steps, elapsed = run(pipe, args, control_image, None)
+    baseline, steps, elapsed = run(pipe, args, control_image, None)
+
+    print(
+        f"{'threshold':>10} {'avg steps':>10} {'time (s)':>10}"
+        f" {'PSNR (dB)':>10} {'mean abs':>10} {'max abs':>10}"
+    )
+    print(
+        f"{'none':>10} {np.mean(steps):>10.2f} {elapsed:>10.2f}"
+        f" {'inf':>10} {0.0:>10.4f} {0.0:>10.4f}"
+    )
+    for threshold in args.thresholds:
+        images, steps, elapsed = run(pipe, args, control_image, threshold)
+        diff = np.abs(images - baseline)
+        print(
+            f"{threshold:>10} {np.mean(steps):>10.2f} {elapsed:>10.2f}"
+            f" {psnr(images, baseline):>10.2f} {diff.mean():>10.4f} {diff.max():>10.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Benchmark for UNet feature caching: runs a fixed prompt set at several full-step intervals and reports the sampling
+time and how far the images land from the ones sampled with the full UNet at every step.
+
+    python bench_feature_cache.py --steps 8 --intervals 2 3 4 --control-image input.png
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from bench_early_stopping import PROMPTS, psnr
+from predict import CONTROLNET_MODELS, Predictor
+
+
+def run(pipe, args, control_image, feature_cache_interval):
+    generator = [
+        torch.Generator("cpu").manual_seed(args.seed + i) for i in range(len(PROMPTS))
+    ]
+    torch.cuda.synchronize()
+    start = time.perf_counter()
+    images = pipe(
+        prompt=PROMPTS,
+        width=args.width,
+        height=args.height,
+        num_inference_steps=args.steps,
+        guidance_scale=args.guidance_scale,
+        control_image=control_image,
+        generator=generator,
+        feature_cache_interval=feature_cache_interval,
+        output_type="np",
+    ).images
+    torch.cuda.synchronize()
+    return images, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--intervals", type=int, nargs="+", default=[2, 3, 4])
+    parser.add_argument(
+        "--depth",
+        type=int,
+        nargs="+",
+        default=[1],
+        help="Outer block pairs recomputed on partial steps",
+    )
+    parser.add_argument("--steps", type=int, default=8)
+    parser.add_argument("--width", type=int, default=768)
+    parser.add_argument("--height", type=int, default=768)
+    parser.add_argument("--guidance-scale", type=float, default=8.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--control-image",
+        default=None,
+        help="Canny ControlNet image; plain LCM sampling without one",
+    )
+    args = parser.parse_args()
+
+    predictor = Predictor()
+    predictor.setup()
+    pipe = predictor.controlnet_pipe
+
+    control_image = [None] * len(CONTROLNET_MODELS)
+    if args.control_image:
+        image = Image.open(args.control_image).convert("RGB")
+        control_image[0] = predictor.control_image(
+            image.resize((args.width, args.height)), 100, 200
+        )
+
+    # one run to settle allocations before measuring
+    baseline, elapsed = run(pipe, args, control_image, None)
+    baseline, elapsed = run(pipe, args, control_image, None)
+
+    print(
+        f"{'depth':>6} {'interval':>9} {'time (s)':>10} {'speedup':>8}"
+        f" {'PSNR (dB)':>10} {'mean abs':>10} {'max abs':>10}"
+    )
+    print(
+        f"{'-':>6} {'none':>9} {elapsed:>10.2f} {1.0:>8.2f}"
+        f" {'inf':>10} {0.0:>10.4f} {0.0:>10.4f}"
+    )
+    for depth in args.depth:
+        pipe.feature_cache_depth = depth
+        for interval in args.intervals:
+            images, seconds = run(pipe, args, control_image, interval)
+            diff = np.abs(images - baseline)
+            print(
+                f"{depth:>6} {interval:>9} {seconds:>10.2f} {elapsed / seconds:>8.2f}"
+                f" {psnr(images, baseline):>10.2f} {diff.mean():>10.4f} {diff.max():>10.4f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Benchmark for LoRA serving: times a 4-step generation, fusing each adapter the first time, swapping between adapters
+whose fused weights are cached, and switching back to no adapter, so the swap cost can be read against the cost of
+the generation itself.
+
+    LORAS=user/style-a,user/style-b python bench_lora.py --rounds 3
+"""
+
+import argparse
+import time
+
+import torch
+
+from predict import LORAS, MODELS, Predictor
+
+
+def generate(pipe, args):
+    torch.cuda.synchronize()
+    start = time.perf_counter()
+    pipe(
+        prompt="A photo of a red fox in a snowy forest, golden hour",
+        width=args.width,
+        height=args.height,
+        num_inference_steps=args.steps,
+        generator=torch.Generator("cpu").manual_seed(0),
+        output_type="latent",
+    )
+    torch.cuda.synchronize()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--steps", type=int, default=4)
+    parser.add_argument("--width", type=int, default=768)
+    parser.add_argument("--height", type=int, default=768)
+    parser.add_argument("--scale", type=float, default=1.0)
+    args = parser.parse_args()
+    if not LORAS:
+        parser.error("Set LORAS to the adapters to swap between")
+
+    predictor = Predictor()
+    predictor.setup()
+    pipe = predictor.txt2img_pipe
+    cache = predictor.lora_cache
+
+    print(f"Generation: {generate(pipe, args):.3f}s")
+    print(f"{'adapter':>40} {'swap (s)':>9} {'generate (s)':>13}")
+    for _ in range(args.rounds):
+        for adapter in LORAS + [None]:
+            start = time.perf_counter()
+            cache.activate(pipe.unet, MODELS[0], adapter, args.scale)
+            swap = time.perf_counter() - start
+            print(f"{str(adapter):>40} {swap:>9.3f} {generate(pipe, args):>13.3f}")
+
+    for name, value in sorted(predictor.metrics.snapshot().items()):
+        if name.startswith("lora."):
+            print(f"{name}: {value}")
+
+
+if __name__ == "__main__":
+    main()
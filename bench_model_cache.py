@@ -0,0 +1,54 @@
+"""
+Benchmark for checkpoint hot-swapping: switches the predictor between checkpoints (and ControlNets) through the model
+cache and reports how long each switch takes from disk, from host memory and when the weights are already active,
+next to the time of loading a fresh pipeline.
+
+    MODELS=SimianLuo/LCM_Dreamshaper_v7,other/lcm-checkpoint python bench_model_cache.py --rounds 3
+"""
+
+import argparse
+import time
+
+from diffusers import DiffusionPipeline
+
+from predict import CONTROL_IMAGE_MODELS, MODELS, Predictor
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument(
+        "--slot",
+        choices=["checkpoint", "controlnet"],
+        default="checkpoint",
+        help="Swap checkpoints (MODELS) or ControlNets (CONTROL_IMAGE_MODELS)",
+    )
+    args = parser.parse_args()
+
+    variants = MODELS if args.slot == "checkpoint" else CONTROL_IMAGE_MODELS
+    if len(variants) < 2:
+        parser.error(f"Set at least two variants to swap between, got {variants}")
+
+    predictor = Predictor()
+    predictor.setup()
+
+    start = time.perf_counter()
+    predictor.create_pipeline(DiffusionPipeline)
+    print(f"Fresh pipeline load: {time.perf_counter() - start:.2f}s")
+
+    print(f"{'variant':>50} {'tier':>7} {'seconds':>8}")
+    for _ in range(args.rounds):
+        for variant in variants:
+            start = time.perf_counter()
+            tier = predictor.model_cache.activate(args.slot, variant)
+            print(f"{variant:>50} {tier:>7} {time.perf_counter() - start:>8.3f}")
+
+    for name, value in sorted(predictor.metrics.snapshot().items()):
+        if name.startswith("model_cache."):
+            print(f"{name}: {value}")
+
+
+if __name__ == "__main__":
+    main()
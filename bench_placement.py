@@ -0,0 +1,155 @@
+"""
+Benchmark for component placement: sets the predictor up with the placement WEIGHT_MEMORY_GIB and
+PLACEMENT_LATENCY_SECONDS pick (setup prints every plan on the memory/latency frontier), then serves requests of
+each mode one at a time and reports their latency, peak device memory and the weights copied to the device for
+them. Run it once without a weight budget for the all-resident baseline, and compare the added latency with the
+plan's prediction.
+
+With --check it instead places the components by every plan in turn, on the frontier or not, serves concurrent
+ControlNet and text-to-image requests under each, so that the engine admits and finishes requests between the steps
+of others, and compares their images with the all-resident ones. It exits with status 1 if a request fails or its
+images differ by more than --tolerance on average.
+
+    python bench_placement.py --control-image input.png
+    WEIGHT_MEMORY_GIB=3 PLACEMENT_LATENCY_SECONDS=1 python bench_placement.py --control-image input.png
+    python bench_placement.py --control-image input.png --check
+"""
+
+import argparse
+import statistics
+import sys
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from predict import PLACEMENT_STEPS, Predictor
+
+
+def serve(predictor, requests):
+    """The images of `requests`, submitted together, as float arrays; the exception instead of those that fail"""
+    futures = [predictor.submit(dict(request)) for request in requests]
+    outputs = []
+    for future in futures:
+        try:
+            paths = future.result()
+        except Exception as e:
+            outputs.append(e)
+            continue
+        outputs.append(
+            [
+                np.asarray(Image.open(path), dtype=np.float32)
+                for path in paths
+                if not path.name.startswith("canny")
+            ]
+        )
+    return outputs
+
+
+def check(predictor, args):
+    """Compare the images of `serve` under every plan with the all-resident ones, see --check"""
+    requests = [
+        dict(
+            predictor.default_inputs(),
+            prompt="a photo of a lighthouse at dusk",
+            width=args.size,
+            height=args.size,
+            num_inference_steps=PLACEMENT_STEPS,
+            seed=seed,
+            **({"control_image": args.control_image} if seed % 3 else {}),
+        )
+        for seed in range(args.concurrency)
+    ]
+    for placement in getattr(predictor, "placements", []):
+        placement.remove()
+    reference = serve(predictor, requests)
+
+    failed = False
+    planner = predictor.placement_planner()
+    for plan, _, _ in planner.plans():
+        predictor.place_components(plan)
+        outputs = serve(predictor, requests)
+        for placement in predictor.placements:
+            placement.remove()
+
+        errors = [output for output in outputs if isinstance(output, Exception)]
+        differences = [
+            np.abs(image - expected).mean()
+            for output, images in zip(outputs, reference)
+            if not isinstance(output, Exception)
+            for image, expected in zip(output, images)
+        ]
+        worst = max(differences, default=0.0)
+        ok = not errors and worst <= args.tolerance
+        failed = failed or not ok
+        print(
+            f"{'ok' if ok else 'FAIL':>4} {', '.join(f'{c} {p}' for c, p in plan.items())}: "
+            f"{len(errors)} failed, mean pixel difference up to {worst:.2f}"
+            + (f" ({errors[0]!r})" if errors else "")
+        )
+    sys.exit(1 if failed else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--size", type=int, default=768)
+    parser.add_argument("--control-image", required=True)
+    parser.add_argument("--check", action="store_true")
+    parser.add_argument("--concurrency", type=int, default=6)
+    parser.add_argument("--tolerance", type=float, default=1.0)
+    args = parser.parse_args()
+
+    predictor = Predictor()
+    predictor.setup()
+    if args.check:
+        check(predictor, args)
+    planned = predictor.metrics.snapshot()
+    if "placement.latency_seconds" in planned:
+        print(
+            f"Planned {planned['placement.weight_bytes'] / 2**30:.2f} GiB of weights, "
+            f"+{planned['placement.latency_seconds']:.3f}s per request"
+        )
+
+    requests = {
+        "txt2img": {},
+        "controlnet": {"control_image": args.control_image},
+    }
+    print(
+        f"{'mode':>10} {'median s':>9} {'peak GiB':>9} {'loads':>6} {'loaded GiB':>11}"
+    )
+    for mode, inputs in requests.items():
+        latencies, peaks = [], []
+        before = predictor.metrics.snapshot()
+        for number in range(args.rounds):
+            torch.cuda.reset_peak_memory_stats()
+            start = time.perf_counter()
+            predictor.predict(
+                **dict(
+                    predictor.default_inputs(),
+                    prompt="a photo of a lighthouse at dusk",
+                    width=args.size,
+                    height=args.size,
+                    num_inference_steps=PLACEMENT_STEPS,
+                    seed=number,
+                    **inputs,
+                )
+            )
+            latencies.append(time.perf_counter() - start)
+            peaks.append(torch.cuda.max_memory_allocated())
+        after = predictor.metrics.snapshot()
+        loads = after.get("placement.loads", 0) - before.get("placement.loads", 0)
+        loaded = after.get("placement.loaded_bytes", 0) - before.get(
+            "placement.loaded_bytes", 0
+        )
+        print(
+            f"{mode:>10} {statistics.median(latencies):>9.3f} {max(peaks) / 2**30:>9.2f} "
+            f"{loads / args.rounds:>6.0f} {loaded / args.rounds / 2**30:>11.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Benchmark for postprocessing decoded images: times the float path (denormalize and clamp on the device, copy float32
+to the host, quantize there) against the uint8 path of `quantize_images` and `copy_to_host`, and reports the bytes
+each one copies to the host.
+
+    python bench_postprocess.py --sizes 512 768 1024 --batch-size 4
+"""
+
+import argparse
+import time
+
+import torch
+
+from latent_consistency_controlnet import copy_to_host, quantize_images
+from predict import Predictor
+
+
+def float_path(pipe, image):
+    image = pipe.image_processor.postprocess(image, output_type="np")
+    return (image * 255).round().astype("uint8"), image.nbytes
+
+
+def uint8_path(pipe, image):
+    image, _ = copy_to_host(quantize_images(image))
+    return image.numpy(), image.numel()
+
+
+def measure(path, pipe, image, rounds):
+    path(pipe, image)
+    torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        _, nbytes = path(pipe, image)
+    torch.cuda.synchronize()
+    return (time.perf_counter() - start) / rounds, nbytes
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512, 768, 1024])
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--rounds", type=int, default=10)
+    args = parser.parse_args()
+
+    predictor = Predictor()
+    predictor.setup()
+    pipe = predictor.txt2img_pipe
+
+    print(
+        f"{'size':>6} {'float (ms)':>11} {'float MiB':>10} {'uint8 (ms)':>11} {'uint8 MiB':>10}"
+    )
+    for size in args.sizes:
+        # decoded images as the VAE returns them, in [-1, 1]
+        image = (
+            torch.rand(
+                args.batch_size, 3, size, size, device=pipe.device, dtype=pipe.vae.dtype
+            )
+            .mul_(2.2)
+            .sub_(1.1)
+        )
+        expected, _ = float_path(pipe, image)
+        quantized, _ = uint8_path(pipe, image)
+        assert (expected == quantized).all(), "uint8 path differs from the float path"
+
+        float_time, float_bytes = measure(float_path, pipe, image, args.rounds)
+        uint8_time, uint8_bytes = measure(uint8_path, pipe, image, args.rounds)
+        print(
+            f"{size:>6} {float_time * 1000:>11.2f} {float_bytes / 2**20:>10.1f} "
+            f"{uint8_time * 1000:>11.2f} {uint8_bytes / 2**20:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
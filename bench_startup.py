@@ -0,0 +1,75 @@
+"""
+Import time check for predict.py: imports it in fresh interpreters with `-X importtime`, reports the median import
+time and the top-level packages that take the longest, and exits with status 1 if the import takes longer than
+`--budget` seconds or pulls in any of the `--forbidden` packages, which predict.py only imports where they are used.
+Run it in CI to catch an eager import creeping back in. The rest of startup, weight loading and warmup, is broken
+down by `Predictor.setup` itself.
+
+    python bench_startup.py --budget 3 --rounds 5
+"""
+
+import argparse
+import collections
+import statistics
+import subprocess
+import sys
+
+
+def import_times(module):
+    """Self and cumulative import seconds of every module imported by `import module` in a fresh interpreter"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        times[name.strip()] = (int(self_us) / 1e6, int(cumulative_us) / 1e6)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--module", default="predict")
+    parser.add_argument("--budget", type=float, default=3.0)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument(
+        "--forbidden", nargs="*", default=["diffusers", "transformers", "cv2"]
+    )
+    args = parser.parse_args()
+
+    rounds = [import_times(args.module) for _ in range(args.rounds)]
+    total = statistics.median(times[args.module][1] for times in rounds)
+    # self time summed per top-level package, from the round with the median total
+    times = sorted(rounds, key=lambda times: times[args.module][1])[len(rounds) // 2]
+    packages = collections.Counter()
+    for name, (self_seconds, _) in times.items():
+        packages[name.split(".")[0]] += self_seconds
+
+    print(f"{'package':<30} {'seconds':>8}")
+    for package, seconds in packages.most_common(args.top):
+        print(f"{package:<30} {seconds:>8.3f}")
+    print(
+        f"import {args.module}: {total:.2f}s median of {args.rounds} (budget {args.budget:.2f}s)"
+    )
+
+    failed = False
+    if total > args.budget:
+        print(f"FAIL: import takes {total:.2f}s, over the {args.budget:.2f}s budget")
+        failed = True
+    imported = [package for package in args.forbidden if package in packages]
+    if imported:
+        print(f"FAIL: import pulls in {', '.join(imported)}")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Benchmark for tiled generation: samples growing output sizes whole and in tiles and reports the peak device memory
+and the time of each, showing that the peak follows the tile size rather than the output size.
+
+    python bench_tiling.py --sizes 1024 1536 2048 --tile-size 768
+"""
+
+import argparse
+import time
+
+import torch
+
+from predict import CONTROLNET_MODELS, TILE_BATCH_SIZE, TILE_OVERLAP, Predictor
+
+
+def run(pipe, args, size, tile_size):
+    torch.cuda.empty_cache()
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    try:
+        pipe(
+            prompt="A photo of a red fox in a snowy forest, golden hour",
+            width=size,
+            height=size,
+            num_inference_steps=args.steps,
+            control_image=[None] * len(CONTROLNET_MODELS),
+            generator=[torch.Generator("cpu").manual_seed(args.seed)],
+            tile_size=tile_size,
+            tile_overlap=TILE_OVERLAP,
+            tile_batch_size=TILE_BATCH_SIZE,
+            output_type="np",
+        )
+        torch.cuda.synchronize()
+    except torch.cuda.OutOfMemoryError:
+        return None, None
+    return torch.cuda.max_memory_allocated(), time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 1536, 2048])
+    parser.add_argument("--tile-size", type=int, default=768)
+    parser.add_argument("--steps", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    predictor = Predictor()
+    predictor.setup()
+    pipe = predictor.controlnet_pipe
+
+    def cell(memory, seconds):
+        if memory is None:
+            return f"{'out of memory':>22}"
+        return f"{memory / 2**30:>10.2f} GiB {seconds:>7.2f}s"
+
+    print(f"{'size':>6} {'whole':>22} {'tiled':>22}")
+    for size in args.sizes:
+        whole = run(pipe, args, size, None)
+        tiled = run(pipe, args, size, args.tile_size)
+        print(f"{size:>6} {cell(*whole)} {cell(*tiled)}")
+
+
+if __name__ == "__main__":
+    main()
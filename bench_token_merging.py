@@ -0,0 +1,101 @@
+"""
+Benchmark for token merging: runs a fixed prompt set at several image sizes and merge ratios and reports latency,
+peak device memory and how far the images land from the unmerged ones. The ratios predict uses for each size
+(TOKEN_MERGING_RATIOS) are marked with a *.
+
+    python bench_token_merging.py --sizes 768 1024 --ratios 0.3 0.5 0.7 --control-image input.png
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from bench_early_stopping import PROMPTS, psnr
+from predict import CONTROLNET_MODELS, Predictor
+
+
+def run(pipe, args, size, control_image, ratio):
+    generator = [
+        torch.Generator("cpu").manual_seed(args.seed + i) for i in range(args.batch)
+    ]
+    configured = pipe.token_merging.ratios
+    # a single bucket from 0 pixels up, so the ratio applies at every size
+    pipe.token_merging.ratios = [(0, ratio)]
+    try:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        start = time.perf_counter()
+        images = pipe(
+            prompt=PROMPTS[: args.batch],
+            width=size,
+            height=size,
+            num_inference_steps=args.steps,
+            guidance_scale=args.guidance_scale,
+            control_image=control_image,
+            generator=generator,
+            token_merging=ratio > 0,
+            output_type="np",
+        ).images
+        torch.cuda.synchronize()
+    finally:
+        pipe.token_merging.ratios = configured
+    return images, time.perf_counter() - start, torch.cuda.max_memory_allocated()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[768, 1024])
+    parser.add_argument("--ratios", type=float, nargs="+", default=[0.3, 0.5, 0.7])
+    parser.add_argument("--batch", type=int, default=4)
+    parser.add_argument("--steps", type=int, default=4)
+    parser.add_argument("--guidance-scale", type=float, default=8.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--control-image",
+        default=None,
+        help="Canny ControlNet image, so the ControlNet attention is merged too; plain LCM sampling without one",
+    )
+    args = parser.parse_args()
+
+    predictor = Predictor()
+    predictor.setup()
+    pipe = predictor.controlnet_pipe
+
+    print(
+        f"{'size':>6} {'ratio':>7} {'time (s)':>10} {'speedup':>8} {'peak GiB':>9}"
+        f" {'PSNR (dB)':>10} {'mean abs':>10}"
+    )
+    for size in args.sizes:
+        control_image = [None] * len(CONTROLNET_MODELS)
+        if args.control_image:
+            image = Image.open(args.control_image).convert("RGB")
+            control_image[0] = predictor.control_image(
+                image.resize((size, size)), 100, 200
+            )
+
+        # one run to settle allocations before measuring
+        run(pipe, args, size, control_image, 0.0)
+        baseline, elapsed, memory = run(pipe, args, size, control_image, 0.0)
+        print(
+            f"{size:>6} {0.0:>7.2f} {elapsed:>10.2f} {1.0:>8.2f} {memory / 2**30:>9.2f}"
+            f" {'inf':>10} {0.0:>10.4f}"
+        )
+
+        default_ratio = pipe.token_merging.ratio_for(size, size)
+        for ratio in args.ratios:
+            images, seconds, memory = run(pipe, args, size, control_image, ratio)
+            marker = "*" if ratio == default_ratio else " "
+            print(
+                f"{size:>6} {ratio:>6.2f}{marker} {seconds:>10.2f} {elapsed / seconds:>8.2f}"
+                f" {memory / 2**30:>9.2f} {psnr(images, baseline):>10.2f}"
+                f" {np.abs(images - baseline).mean():>10.4f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Benchmark for two-stage generation: runs the same text-to-image requests directly at the requested size and in two
+stages (generate at the base size, upscale the latents, refine) with matched steps, guidance and seeds, and reports
+the latency of both.
+
+    python bench_two_stage.py --sizes 768 1024 --steps 8 --refine-strength 0.3
+"""
+
+import argparse
+import time
+
+from bench_early_stopping import PROMPTS
+from predict import Predictor
+
+
+def run(predictor, args, size, two_stage):
+    inputs = dict(
+        predictor.default_inputs(),
+        prompt="\n".join(PROMPTS[: args.prompts]),
+        width=size,
+        height=size,
+        num_inference_steps=args.steps,
+        guidance_scale=args.guidance_scale,
+        seed=args.seed,
+        two_stage=two_stage,
+        refine_strength=args.refine_strength,
+    )
+    start = time.perf_counter()
+    predictor.predict(**inputs)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[768, 1024])
+    parser.add_argument("--steps", type=int, default=8)
+    parser.add_argument("--refine-strength", type=float, default=0.3)
+    parser.add_argument("--guidance-scale", type=float, default=8.0)
+    parser.add_argument("--prompts", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    predictor = Predictor()
+    predictor.setup()
+    # one run to settle allocations before measuring
+    run(predictor, args, args.sizes[0], False)
+
+    print(f"{'size':>6} {'direct (s)':>11} {'two-stage (s)':>14} {'speedup':>8}")
+    for size in args.sizes:
+        direct = run(predictor, args, size, False)
+        two_stage = run(predictor, args, size, True)
+        print(
+            f"{size:>6} {direct:>11.2f} {two_stage:>14.2f} {direct / two_stage:>8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,370 @@
+"""
+Offline bulk generation: runs a JSONL file of predict requests, one JSON object of predict inputs per line with an
+optional "id", at maximum throughput and writes the outputs to a directory as they are produced.
+
+    python bulk.py jobs.jsonl --output-dir outputs --shard 0 --num-shards 4
+
+Text-to-image jobs that share size and sampling settings are grouped and run in large batches, with each distinct
+prompt encoded once. Other jobs go through the predictor a few at a time, so the ControlNet engine can batch them.
+Jobs run ordered by checkpoint and LoRA, so that their weights are swapped as rarely as possible.
+Completed jobs are appended to a checkpoint file in the output directory and skipped when the job file is run again,
+so a crashed run resumes where it stopped. Each shard processes every num_shards-th line and keeps its own
+checkpoint, so shards can run as separate processes, e.g. one per GPU.
+"""
+
+import argparse
+import collections
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from PIL import Image
+
+from predict import Predictor
+
+# Settings that have to match for text-to-image jobs to share a batch
+GROUP_KEYS = [
+    "model",
+    "lora",
+    "lora_scale",
+    "width",
+    "height",
+    "num_inference_steps",
+    "guidance_scale",
+    "lcm_origin_steps",
+    "disable_safety_checker",
+    "token_merging",
+]
+# Settings that need weights swapped, jobs are ordered by them so that swaps are rare
+WEIGHT_KEYS = ["model", "lora", "lora_scale"]
+# Inputs that need something other than plain text-to-image. Tiled jobs are denoised by the ControlNet pipeline,
+# two_stage jobs run two passes (refine_strength only applies to those), early stopping and deadlines stop single
+# requests and archives are written by the predictor
+NON_BATCHABLE_KEYS = [
+    "image",
+    "control_image",
+    "depth_image",
+    "pose_image",
+    "latents",
+    "output_latents",
+    "tile_size",
+    "two_stage",
+    "convergence_threshold",
+    "deadline_seconds",
+    "archive_outputs",
+]
+
+
+class PromptEmbeddingCache:
+    """LRU cache of encoded prompts, so that prompts repeated across jobs are only encoded once"""
+
+    def __init__(self, pipe, max_size=1024):
+        self.pipe = pipe
+        self.max_size = max_size
+        self.embeddings = collections.OrderedDict()
+        # the checkpoint whose text encoder made the embeddings
+        self.model = None
+
+    @torch.no_grad()
+    def get(self, prompts):
+        missing = [p for p in dict.fromkeys(prompts) if p not in self.embeddings]
+        if missing:
+            embeddings, _ = self.pipe.encode_prompt(
+                missing, self.pipe._execution_device, 1, False
+            )
+            self.embeddings.update(zip(missing, embeddings))
+
+        for p in prompts:
+            self.embeddings.move_to_end(p)
+        result = torch.stack([self.embeddings[p] for p in prompts])
+        while len(self.embeddings) > self.max_size:
+            self.embeddings.popitem(last=False)
+        return result
+
+
+class Checkpoint:
+    """Append-only record of finished jobs, one JSON line per job, flushed to disk as each job finishes"""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.done = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # a line cut short by a crash, that job runs again
+                        continue
+                    self.done[entry["id"]] = entry
+        self.file = open(path, "a")
+
+    def record(self, job_id, outputs=None, error=None):
+        entry = {"id": job_id, "outputs": outputs or []}
+        if error is not None:
+            entry["error"] = error
+        with self.lock:
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.done[job_id] = entry
+
+
+def load_jobs(path, shard, num_shards, defaults, base_seed):
+    """The `(id, request)` pairs of this shard. Jobs without a seed get `base_seed + line number`, so reruns match"""
+    jobs = []
+    with open(path) as f:
+        for index, line in enumerate(f):
+            if index % num_shards != shard or not line.strip():
+                continue
+            inputs = json.loads(line)
+            job_id = str(inputs.pop("id", index))
+            request = {**defaults, **inputs}
+            if request["seed"] is None:
+                request["seed"] = base_seed + index
+            jobs.append((job_id, request))
+    return jobs
+
+
+def is_batchable(request):
+    # a deadline or threshold of 0 is still set
+    return all(
+        request[key] is None or request[key] is False for key in NON_BATCHABLE_KEYS
+    )
+
+
+def weights_order(request):
+    return tuple(str(request[key]) for key in WEIGHT_KEYS)
+
+
+def group_jobs(jobs):
+    groups = collections.defaultdict(list)
+    for job_id, request in jobs:
+        groups[tuple(request[key] for key in GROUP_KEYS)].append((job_id, request))
+    return sorted(groups.values(), key=lambda group: weights_order(group[0][1]))
+
+
+def run_group(predictor, jobs, batch_size, cache, writer, output_dir, checkpoint):
+    """
+    Run text-to-image jobs with matching settings as batches of up to `batch_size` images, however the images are
+    spread over jobs. Jobs go through the predictor's checks and admission first, and failures are recorded in the
+    checkpoint like those of `run_requests`. Returns the number of images generated.
+    """
+    admitted = []
+    for job_id, request in jobs:
+        try:
+            admitted.append((job_id, predictor.preprocess(dict(request))))
+        except Exception as e:
+            print(f"Job {job_id} failed: {e}")
+            checkpoint.record(job_id, error=str(e))
+    if not admitted:
+        return 0
+
+    settings = admitted[0][1]
+    predictor.activate(settings)
+    if cache.model != settings["model"]:
+        cache.embeddings.clear()
+        cache.model = settings["model"]
+    pipe = (
+        predictor.txt2img_pipe_unsafe
+        if settings["disable_safety_checker"]
+        else predictor.txt2img_pipe
+    )
+    # at least 1, as admission rejected the jobs whose single images do not fit
+    batch_size = predictor.cost_model.max_batch(
+        predictor.memory_budget,
+        "txt2img",
+        settings["width"],
+        settings["height"],
+        batch_size,
+        settings["num_inference_steps"],
+        False,
+    )
+
+    # one row per image: (job id, image index, prompt, seed)
+    rows = []
+    counts = {}
+    for job_id, request in admitted:
+        prompts = [p for p in request["prompt"] for _ in range(request["num_images"])]
+        rows += [
+            (job_id, i, p, s) for i, (p, s) in enumerate(zip(prompts, request["seeds"]))
+        ]
+        counts[job_id] = len(prompts)
+
+    token_merging_ratio = (
+        predictor.token_merging.ratio_for(settings["width"], settings["height"])
+        if settings["token_merging"]
+        else 0.0
+    )
+    latent_size = (
+        settings["height"] // pipe.vae_scale_factor,
+        settings["width"] // pipe.vae_scale_factor,
+    )
+
+    saves = collections.defaultdict(list)
+    generated = 0
+    try:
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start : start + batch_size]
+            with predictor.token_merging.merging(token_merging_ratio, latent_size):
+                latents = pipe(
+                    prompt_embeds=cache.get([p for _, _, p, _ in batch]),
+                    width=settings["width"],
+                    height=settings["height"],
+                    guidance_scale=settings["guidance_scale"],
+                    num_inference_steps=settings["num_inference_steps"],
+                    lcm_origin_steps=settings["lcm_origin_steps"],
+                    generator=[
+                        torch.Generator("cpu").manual_seed(s) for _, _, _, s in batch
+                    ],
+                    output_type="latent",
+                ).images
+            images = predictor.decode_latents(pipe, latents)
+            generated += len(batch)
+
+            for (job_id, i, _, seed), image in zip(batch, images):
+                path = os.path.join(output_dir, f"{job_id}-{i}-{seed}.jpg")
+                saves[job_id].append((path, writer.submit(save_image, image, path)))
+                if len(saves[job_id]) == counts[job_id]:
+                    writer.submit(finish_job, checkpoint, job_id, saves.pop(job_id))
+                    del counts[job_id]
+    except Exception as e:
+        # the jobs not finished yet fail, the run goes on
+        print(f"Group of {len(admitted)} jobs failed: {e}")
+        for job_id in counts:
+            checkpoint.record(job_id, error=str(e))
+
+    return generated
+
+
+def save_image(image, path):
+    Image.fromarray(image).save(path)
+
+
+def finish_job(checkpoint, job_id, saves):
+    for _, save in saves:
+        save.result()
+    checkpoint.record(job_id, [path for path, _ in saves])
+
+
+def run_requests(predictor, jobs, concurrency, output_dir, checkpoint):
+    """
+    Run jobs through the predictor, keeping `concurrency` of them in flight. Failures are recorded in the checkpoint
+    and do not stop the run. Returns the number of images generated.
+    """
+    images = 0
+    in_flight = collections.deque()
+
+    def finish(job_id, future):
+        try:
+            outputs = future.result()
+        except Exception as e:
+            print(f"Job {job_id} failed: {e}")
+            checkpoint.record(job_id, error=str(e))
+            return 0
+
+        if not isinstance(outputs, list):
+            outputs = [outputs]
+        paths = []
+        for output in outputs:
+            path = os.path.join(output_dir, f"{job_id}-{os.path.basename(output)}")
+            shutil.move(str(output), path)
+            paths.append(path)
+        checkpoint.record(job_id, paths)
+        return len(paths)
+
+    for job_id, request in jobs:
+        in_flight.append((job_id, predictor.submit(request)))
+        if len(in_flight) >= concurrency:
+            images += finish(*in_flight.popleft())
+    while in_flight:
+        images += finish(*in_flight.popleft())
+    return images
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("jobs", help="JSONL file with one request per line")
+    parser.add_argument("--output-dir", default="bulk-outputs")
+    parser.add_argument("--shard", type=int, default=0)
+    parser.add_argument("--num-shards", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="Requests in flight for jobs that cannot be grouped",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=4, help="Threads writing output images"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Base seed for jobs without one"
+    )
+    parser.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="Run jobs again that failed in a previous run",
+    )
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    checkpoint = Checkpoint(
+        os.path.join(
+            args.output_dir, f"checkpoint-{args.shard}-of-{args.num_shards}.jsonl"
+        )
+    )
+
+    predictor = Predictor()
+    predictor.setup()
+
+    jobs = load_jobs(
+        args.jobs, args.shard, args.num_shards, predictor.default_inputs(), args.seed
+    )
+    todo = [
+        (job_id, request)
+        for job_id, request in jobs
+        if job_id not in checkpoint.done
+        or (args.retry_failed and "error" in checkpoint.done[job_id])
+    ]
+    print(f"{len(todo)} of {len(jobs)} jobs in shard {args.shard} left to run")
+
+    start = time.perf_counter()
+    images = 0
+    cache = PromptEmbeddingCache(predictor.txt2img_pipe)
+    with ThreadPoolExecutor(args.workers) as writer:
+        for group in group_jobs([job for job in todo if is_batchable(job[1])]):
+            images += run_group(
+                predictor,
+                group,
+                args.batch_size,
+                cache,
+                writer,
+                args.output_dir,
+                checkpoint,
+            )
+        images += run_requests(
+            predictor,
+            sorted(
+                [job for job in todo if not is_batchable(job[1])],
+                key=lambda job: weights_order(job[1]),
+            ),
+            args.concurrency,
+            args.output_dir,
+            checkpoint,
+        )
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"{images} images in {elapsed:.1f}s, {images / max(elapsed, 1e-9):.2f} images/s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,565 @@
+import collections
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+from diffusers import ControlNetModel
+from latent_consistency_controlnet import (
+    EarlyStopping,
+    GenerationCancelled,
+    LatentConsistencyPipelineOutput,
+    LCMScheduler_X,
+    host_array,
+)
+from placement import load_weights
+
+
+class _InFlight:
+    """
+    A request in the engine. `state` is filled in by `prepare_generation` on admission, after which the request
+    tracks its position in its own schedule. With early stopping, `state` only covers the rows still sampling.
+    """
+
+    def __init__(
+        self,
+        future,
+        kwargs,
+        output_type,
+        safety_checker,
+        deadline,
+        cancellation_token,
+        memory,
+        convergence_threshold,
+    ):
+        self.future = future
+        self.kwargs = kwargs
+        self.output_type = output_type
+        self.safety_checker = safety_checker
+        self.deadline = deadline
+        self.cancellation_token = cancellation_token
+        self.memory = memory
+        self.convergence_threshold = convergence_threshold
+        self.early_stopping = None
+        self.state = None
+        self.step = 0
+        self.denoised = None
+
+    @property
+    def bs(self):
+        return self.state["bs"]
+
+    @property
+    def num_steps(self):
+        return len(self.state["timesteps"])
+
+
+class ContinuousBatchingEngine:
+    """
+    Iteration-level batching for `LatentConsistencyModelPipeline_controlnet`.
+
+    The engine keeps a running set of in-flight requests. Every tick advances all of them by one step with a single
+    batched UNet call (one per latent shape), each row at its own timestep. Requests are admitted and retired at tick
+    boundaries, so a 2-step request does not wait behind an 8-step one and new arrivals do not wait for a whole
+    sampling loop to finish. Every request gets its own `LCMScheduler_X`, and noise comes from per-row generators, so
+    a request's output does not depend on what it was batched with. Requests with per-row settings (see the
+    pipeline's `prepare_generation`) are batched like any other.
+    """
+
+    def __init__(self, pipe, max_batch_size=16, memory_budget=None, queue_size=4):
+        self.pipe = pipe
+        self.max_batch_size = max_batch_size
+        # device memory the in-flight requests may use on top of the weights, None for no limit
+        self.memory_budget = memory_budget
+        # bounded, so submitting blocks while the engine is behind instead of requests piling up in memory
+        self.pending = queue.Queue(maxsize=queue_size)
+        # the next pending request, taken off the queue but still waiting for room in the batch
+        self.waiting = None
+        self.running = []
+        # finished requests whose uint8 images are still being copied to the host, oldest first
+        self.transfers = collections.deque()
+        # requests submitted and not finished yet, see wait_idle
+        self.outstanding = 0
+        self.idle = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="lcm-engine", daemon=True)
+        self.thread.start()
+
+    def submit(
+        self,
+        output_type="pil",
+        safety_checker=True,
+        deadline=None,
+        cancellation_token=None,
+        memory=0,
+        convergence_threshold=None,
+        **kwargs,
+    ):
+        """
+        Queue a request, blocking while `queue_size` requests are waiting for admission. `kwargs` are the
+        `prepare_generation` arguments of the pipeline; `deadline` and `cancellation_token` behave as in the
+        pipeline's `__call__`, except that a request still queued when either fires fails without running, with
+        `TimeoutError` or `GenerationCancelled`. `memory` is the device memory the request needs while in
+        flight; requests wait in the queue until it fits the engine's `memory_budget`. `convergence_threshold`
+        enables early stopping as in the pipeline's `__call__`: converged rows leave the batch at the next tick.
+        Returns a `Future` resolving to a `LatentConsistencyPipelineOutput`.
+        """
+        future = Future()
+        with self.idle:
+            self.outstanding += 1
+        future.add_done_callback(self._done)
+        self.pending.put(
+            _InFlight(
+                future,
+                kwargs,
+                output_type,
+                safety_checker,
+                deadline,
+                cancellation_token,
+                memory,
+                convergence_threshold,
+            )
+        )
+        return future
+
+    def wait_idle(self):
+        """Block until every submitted request has finished, e.g. before changing the pipeline's weights"""
+        with self.idle:
+            self.idle.wait_for(lambda: self.outstanding == 0)
+
+    def _done(self, future):
+        with self.idle:
+            self.outstanding -= 1
+            if self.outstanding == 0:
+                self.idle.notify_all()
+
+    def _run(self):
+        while True:
+            self._admit()
+            self._keep_weights()
+            if self.running:
+                self._tick()
+                self._keep_weights()
+            self._deliver()
+
+    def _keep_weights(self):
+        """
+        Prompts of new requests are encoded and finished ones decoded between the steps of the others, so while
+        requests are in flight a `Placement` keeps an offloaded UNet and ControlNet on the device instead of
+        dropping them for each admission and finish
+        """
+        placement = self.pipe.final_offload_hook
+        if placement is not None:
+            placement.keep("denoise", bool(self.running))
+
+    @torch.no_grad()
+    def _admit(self):
+        rows = sum(request.bs for request in self.running)
+        memory = sum(request.memory for request in self.running)
+        while rows < self.max_batch_size or not self.running:
+            if self.waiting is None:
+                try:
+                    # only block when there is nothing else to do
+                    self.waiting = self.pending.get(
+                        block=not self.running and not self.transfers
+                    )
+                except queue.Empty:
+                    return
+
+            request = self.waiting
+            # requests cancelled or out of time while queued are dropped before any work is done for them
+            token = request.cancellation_token
+            expired = (
+                request.deadline is not None and time.monotonic() >= request.deadline
+            )
+            if (token is not None and token.is_set()) or expired:
+                self.waiting = None
+                if request.future.set_running_or_notify_cancel():
+                    request.future.set_exception(
+                        TimeoutError("Deadline passed before the request was admitted")
+                        if expired
+                        else GenerationCancelled("Cancelled before admission")
+                    )
+                continue
+
+            if (
+                self.running
+                and self.memory_budget is not None
+                and memory + request.memory > self.memory_budget
+            ):
+                # stays first in line until enough in-flight requests retire
+                return
+            self.waiting = None
+
+            if not request.future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                scheduler = LCMScheduler_X.from_config(self.pipe.scheduler.config)
+                request.state = self.pipe.prepare_generation(
+                    scheduler=scheduler, **request.kwargs
+                )
+                if request.convergence_threshold is not None:
+                    request.early_stopping = EarlyStopping(
+                        self.pipe, request.state, request.convergence_threshold
+                    )
+            except BaseException as e:
+                request.future.set_exception(e)
+                continue
+
+            self.running.append(request)
+            rows += request.bs
+            memory += request.memory
+
+    @torch.no_grad()
+    def _tick(self):
+        for request in list(self.running):
+            token = request.cancellation_token
+            if token is not None and token.is_set():
+                self.running.remove(request)
+                self.pipe.release_buffers(request.state)
+                request.future.set_exception(
+                    GenerationCancelled(f"Cancelled after {request.step} steps")
+                )
+
+        # requests with different token merging ratios run different attention, so they are stepped separately
+        groups = {}
+        for request in self.running:
+            key = (
+                tuple(request.state["latents"].shape[1:]),
+                request.state["token_merging_ratio"],
+            )
+            groups.setdefault(key, []).append(request)
+
+        for group in groups.values():
+            try:
+                self._step_group(group)
+            except BaseException as e:
+                for request in group:
+                    self.running.remove(request)
+                    self.pipe.release_buffers(request.state)
+                    request.future.set_exception(e)
+
+        for request in list(self.running):
+            done = request.step == request.num_steps or (
+                request.early_stopping is not None and request.early_stopping.finished
+            )
+            if (
+                not done
+                and request.deadline is not None
+                and time.monotonic() >= request.deadline
+            ):
+                print(
+                    f"Deadline reached after {request.step} of {request.num_steps} steps, returning the current prediction"
+                )
+                done = True
+            if done:
+                self.running.remove(request)
+                self._finish(request)
+
+    def _step_group(self, group):
+        # requests on a partial step of their feature cache only run the outer UNet blocks, so they get their own call
+        full, partial = [], []
+        for r in group:
+            cache = r.state["feature_cache"]
+            if r.state["tiling"] is not None:
+                # tiled requests run their tiles in batches of their own
+                self._step_tiled(r)
+            elif (
+                cache is None
+                or r.state["features"] is None
+                or cache.is_full_step(r.step)
+            ):
+                full.append(r)
+            else:
+                partial.append(r)
+
+        for requests in (full, partial):
+            if requests:
+                self._step_requests(requests, partial=requests is partial)
+
+    def _step_requests(self, group, partial=False):
+        pipe = self.pipe
+        device = group[0].state["device"]
+        dtype = group[0].state["prompt_embeds"].dtype
+        sizes = [r.bs for r in group]
+
+        latents = [r.state["latents"].to(dtype) for r in group]
+        batch = None
+        if pipe.arena is not None:
+            # the batch only lives for this tick
+            batch = pipe.arena.take((sum(sizes), *latents[0].shape[1:]), dtype, device)
+        latents = torch.cat(latents, out=batch)
+        # one timestep per request, or per row for requests with per-row schedules
+        ts = torch.cat(
+            [r.state["timesteps"][r.step].to(device).expand(r.bs) for r in group]
+        )
+        prompt_embeds = torch.cat([r.state["prompt_embeds"] for r in group])
+        w_embedding = torch.cat([r.state["w_embedding"] for r in group])
+
+        with pipe.merging_tokens(group[0].state, latents):
+            down_block_res_samples, mid_block_res_sample = self._controlnet_residuals(
+                group, latents, ts, prompt_embeds
+            )
+            unet_kwargs = dict(
+                timestep_cond=w_embedding,
+                encoder_hidden_states=prompt_embeds,
+                down_block_additional_residuals=down_block_res_samples,
+                mid_block_additional_residual=mid_block_res_sample,
+            )
+            caches = [r.state["feature_cache"] for r in group]
+            if partial:
+                features = torch.cat([r.state["features"] for r in group])
+                model_pred = caches[0].partial(features, latents, ts, **unet_kwargs)
+            elif any(cache is not None for cache in caches):
+                cache = next(cache for cache in caches if cache is not None)
+                model_pred, features = cache.full(latents, ts, **unet_kwargs)
+                for r, cache, f in zip(group, caches, features.split(sizes)):
+                    if cache is not None:
+                        r.state["features"] = f
+            else:
+                (model_pred,) = pipe.unet(latents, ts, return_dict=False, **unet_kwargs)
+
+        for r, pred, sample in zip(
+            group, model_pred.split(sizes), latents.split(sizes)
+        ):
+            next_latents, denoised = pipe.scheduler_step(
+                r.state, r.step, pred, sample, self._previous(r)
+            )
+            self._advance(r, next_latents, denoised)
+        if batch is not None:
+            pipe.arena.give([batch])
+
+    def _step_tiled(self, r):
+        latents, denoised = self.pipe.denoise_step(
+            r.state, r.step, r.state["latents"], self._previous(r)
+        )
+        self._advance(r, latents, denoised)
+
+    @staticmethod
+    def _previous(r):
+        """The `denoised` prediction of the rows of `r` still sampling, from its previous step"""
+        return r.denoised if r.early_stopping is None else r.early_stopping.previous
+
+    @staticmethod
+    def _advance(r, latents, denoised):
+        """Records the outcome of the current step of `r` and moves it to the next"""
+        if r.early_stopping is None:
+            r.state["latents"], r.denoised = latents, denoised
+        else:
+            latents = r.early_stopping.update(r.step, latents, denoised)
+            # the state shrinks to the rows that continue
+            r.state = r.early_stopping.step_state
+            r.state["latents"] = latents
+            r.denoised = r.early_stopping.denoised
+        r.step += 1
+
+    def _controlnet_residuals(self, group, latents, ts, prompt_embeds):
+        """
+        Runs each ControlNet once over the rows that use it at this tick and scatters the residuals into zero-filled
+        tensors for the whole batch. Nets are called with a unit conditioning scale and the per-row scale is applied
+        afterwards, which is exact because the residuals are linear in the scale. When every net is active for every
+        row, batched ControlNets (see the pipeline's `enable_batched_controlnets`) run in one vmapped call instead.
+        Requests reusing the residuals of an earlier step (see the pipeline's `reuses_residuals`) skip the nets and
+        get their kept residuals.
+        """
+        controlnet = self.pipe.controlnet
+        nets = (
+            [controlnet]
+            if isinstance(controlnet, ControlNetModel)
+            else list(controlnet.nets)
+        )
+        guess_mode = group[0].state["guess_mode"]
+        reused = [self.pipe.reuses_residuals(r.state, r.step) for r in group]
+
+        # [(control image, scale of each row)] of each net for the requests running the nets, None for the others
+        conditions = []
+        for r, reuse in zip(group, reused):
+            if reuse:
+                conditions.append(None)
+                continue
+            control_image = r.state["control_image"]
+            keep = r.state["controlnet_keep"][r.step]
+            scale = self.pipe.get_cond_scale(
+                r.state["controlnet_conditioning_scale"], keep
+            )
+            if len(nets) == 1:
+                control_image, scale = [control_image], [scale]
+            conditions.append(
+                [
+                    # a scalar scale or one per row
+                    (image, torch.as_tensor(scale, dtype=torch.float32).expand(r.bs))
+                    for image, scale in zip(control_image, scale)
+                ]
+            )
+
+        if (
+            len(nets) > 1
+            and hasattr(controlnet, "_batched_stack")
+            and all(
+                condition is not None
+                and all(image is not None and scale.all() for image, scale in condition)
+                for condition in conditions
+            )
+        ):
+            control_images, scales = [], []
+            for k in range(len(nets)):
+                images = [condition[k][0] for condition in conditions]
+                control_images.append(
+                    images[0] if len(images) == 1 else torch.cat(images)
+                )
+                scales.append(torch.cat([condition[k][1] for condition in conditions]))
+            down_block_res_samples, mid_block_res_sample = (
+                self.pipe.controlnet_residuals(
+                    latents, ts, prompt_embeds, control_images, scales, guess_mode
+                )
+            )
+        else:
+            down_block_res_samples, mid_block_res_sample = self._net_residuals(
+                nets, group, conditions, latents, ts, prompt_embeds, guess_mode
+            )
+
+        offset = 0
+        for r, reuse in zip(group, reused):
+            rows = slice(offset, offset + r.bs)
+            offset += r.bs
+            if reuse:
+                _, down_samples, mid_sample = r.state["residuals"]
+                if down_samples is None:
+                    continue
+                if down_block_res_samples is None:
+                    down_block_res_samples, mid_block_res_sample = self._zeros(
+                        latents.shape[0], down_samples, mid_sample
+                    )
+                for total, d in zip(down_block_res_samples, down_samples):
+                    total[rows] = d
+                mid_block_res_sample[rows] = mid_sample
+            elif r.state["controlnet_cache_interval"] is not None:
+                # copies, so that the batch's residuals are freed after this tick
+                r.state["residuals"] = (
+                    (r.step, None, None)
+                    if down_block_res_samples is None
+                    else (
+                        r.step,
+                        [d[rows].clone() for d in down_block_res_samples],
+                        mid_block_res_sample[rows].clone(),
+                    )
+                )
+
+        return down_block_res_samples, mid_block_res_sample
+
+    def _net_residuals(
+        self, nets, group, conditions, latents, ts, prompt_embeds, guess_mode
+    ):
+        """The summed residuals of calling each net over the rows it is active for, `(None, None)` if there are none"""
+        down_block_res_samples, mid_block_res_sample = None, None
+        for k, net in enumerate(nets):
+            rows, scales, images = [], [], []
+            offset = 0
+            for r, condition in zip(group, conditions):
+                if condition is not None:
+                    control_image, scale = condition[k]
+                    if control_image is not None and scale.any():
+                        rows.append(
+                            torch.arange(offset, offset + r.bs, device=latents.device)
+                        )
+                        scales.append(scale)
+                        images.append(control_image)
+                offset += r.bs
+            if not rows:
+                continue
+            # the nets are called one by one, not through the forward of a `MultiControlNetModel`, which loads them if
+            # they are offloaded
+            load_weights(self.pipe.controlnet)
+
+            rows = torch.cat(rows)
+            down_samples, mid_sample = net(
+                latents[rows],
+                ts[rows],
+                encoder_hidden_states=prompt_embeds[rows],
+                controlnet_cond=images[0] if len(images) == 1 else torch.cat(images),
+                conditioning_scale=1.0,
+                guess_mode=guess_mode,
+                return_dict=False,
+            )
+            scales = torch.cat(scales).to(device=latents.device, dtype=latents.dtype)
+            scales = scales[:, None, None, None]
+
+            if down_block_res_samples is None:
+                down_block_res_samples, mid_block_res_sample = self._zeros(
+                    latents.shape[0], down_samples, mid_sample
+                )
+            for total, d in zip(down_block_res_samples, down_samples):
+                total.index_add_(0, rows, d * scales)
+            mid_block_res_sample.index_add_(0, rows, mid_sample * scales)
+        return down_block_res_samples, mid_block_res_sample
+
+    @staticmethod
+    def _zeros(batch_size, down_samples, mid_sample):
+        """Zero-filled residuals for `batch_size` rows, shaped like `down_samples` and `mid_sample`"""
+        down_block_res_samples = [
+            torch.zeros((batch_size,) + d.shape[1:], device=d.device, dtype=d.dtype)
+            for d in down_samples
+        ]
+        mid_block_res_sample = torch.zeros(
+            (batch_size,) + mid_sample.shape[1:],
+            device=mid_sample.device,
+            dtype=mid_sample.dtype,
+        )
+        return down_block_res_samples, mid_block_res_sample
+
+    def _finish(self, request):
+        try:
+            denoised = request.denoised.to(request.state["prompt_embeds"].dtype)
+            if request.output_type == "uint8":
+                # the copy to the host overlaps the next ticks, _deliver resolves the request once it has landed
+                with self.pipe.vae_tiling(request.state["tiling"] is not None):
+                    image, event = self.pipe.decode_to_host(denoised, non_blocking=True)
+                self.transfers.append((request, image, event))
+                return
+            with self.pipe.vae_tiling(request.state["tiling"] is not None):
+                image, has_nsfw_concept = self.pipe.decode_latents(
+                    denoised,
+                    request.output_type,
+                    request.state["device"],
+                    safety_checker=request.safety_checker,
+                )
+            self._resolve(request, image, has_nsfw_concept)
+        except BaseException as e:
+            request.future.set_exception(e)
+        finally:
+            # decoding is queued, so the next users of the buffers queue their work after it
+            self.pipe.release_buffers(request.state)
+
+    def _deliver(self):
+        """Resolve the requests whose images have reached the host, waiting for them if nothing else is running"""
+        while self.transfers:
+            request, image, event = self.transfers[0]
+            if event is not None and self.running and not event.query():
+                return
+            self.transfers.popleft()
+            try:
+                if event is not None:
+                    event.synchronize()
+                image = host_array(image, self.pipe.arena)
+                has_nsfw_concept = None
+                if request.safety_checker:
+                    image, has_nsfw_concept = self.pipe.run_safety_checker(
+                        image,
+                        request.state["device"],
+                        request.state["prompt_embeds"].dtype,
+                    )
+                self._resolve(request, image, has_nsfw_concept)
+            except BaseException as e:
+                request.future.set_exception(e)
+
+    def _resolve(self, request, image, has_nsfw_concept):
+        request.future.set_result(
+            LatentConsistencyPipelineOutput(
+                images=image,
+                nsfw_content_detected=has_nsfw_concept,
+                steps_used=self.pipe.steps_used(
+                    request.state, request.step, request.early_stopping
+                ),
+            )
+        )
@@ -0,0 +1,97 @@
+import numpy as np
+
+
+class CostModel:
+    """
+    Predicts the peak device memory and the latency of a batch from `(mode, width, height, batch, steps, controlnet)`,
+    where `mode` is "txt2img" or "img2img" (an init image is encoded) and `controlnet` says whether ControlNets run.
+
+    Both are linear in a handful of features: UNet work grows with images x steps, attention with the square of the
+    pixel count, VAE encode/decode and the safety checker with the number of images. The coefficients are fitted by
+    least squares on measured runs (see `Predictor.calibrate`), then scaled so that no calibration run is
+    underestimated.
+    """
+
+    def __init__(self):
+        self.samples = []
+        self.memory_coef = None
+        self.latency_coef = None
+        self.memory_margin = 1.0
+        self.latency_margin = 1.0
+
+    @staticmethod
+    def memory_features(mode, width, height, batch, steps, controlnet):
+        megapixels = width * height / 2**20
+        images = batch * megapixels
+        return [
+            1.0,
+            images,
+            images * controlnet,
+            images * (mode == "img2img"),
+            batch * megapixels**2,
+        ]
+
+    @staticmethod
+    def latency_features(mode, width, height, batch, steps, controlnet):
+        megapixels = width * height / 2**20
+        images = batch * megapixels
+        return [
+            1.0,
+            images,
+            images * steps,
+            images * steps * controlnet,
+            images * (mode == "img2img"),
+            batch * megapixels**2 * steps,
+        ]
+
+    def observe(self, shape, peak_memory, latency):
+        """Record a measured run; `shape` is the `(mode, width, height, batch, steps, controlnet)` tuple"""
+        self.samples.append((tuple(shape), peak_memory, latency))
+
+    def fit(self):
+        if not self.samples:
+            raise ValueError("No samples to fit the cost model to")
+
+        shapes = [shape for shape, _, _ in self.samples]
+        memory = np.array([m for _, m, _ in self.samples], dtype=np.float64)
+        latency = np.array([t for _, _, t in self.samples], dtype=np.float64)
+
+        x = np.array([self.memory_features(*s) for s in shapes], dtype=np.float64)
+        self.memory_coef = np.linalg.lstsq(x, memory, rcond=None)[0]
+        self.memory_margin = self._margin(x @ self.memory_coef, memory)
+
+        x = np.array([self.latency_features(*s) for s in shapes], dtype=np.float64)
+        self.latency_coef = np.linalg.lstsq(x, latency, rcond=None)[0]
+        self.latency_margin = self._margin(x @ self.latency_coef, latency)
+
+    @staticmethod
+    def _margin(predicted, actual):
+        return max(1.0, float(np.max(actual / np.maximum(predicted, 1e-9))))
+
+    @property
+    def fitted(self):
+        return self.memory_coef is not None
+
+    @property
+    def base_memory(self):
+        """Predicted peak memory with no images in flight, i.e. the weights and workspace every batch shares"""
+        return float(self.memory_coef[0]) * self.memory_margin
+
+    def predict(self, mode, width, height, batch, steps, controlnet):
+        """Returns `(peak_memory_bytes, latency_seconds)`"""
+        shape = (mode, width, height, batch, steps, controlnet)
+        memory = float(np.dot(self.memory_features(*shape), self.memory_coef))
+        latency = float(np.dot(self.latency_features(*shape), self.latency_coef))
+        return (
+            max(memory * self.memory_margin, 0.0),
+            max(latency * self.latency_margin, 0.0),
+        )
+
+    def max_batch(self, memory_budget, mode, width, height, batch, steps, controlnet):
+        """The largest batch, up to `batch`, whose predicted peak memory fits `memory_budget`; 0 if none does"""
+        while batch > 0:
+            memory, _ = self.predict(mode, width, height, batch, steps, controlnet)
+            if memory <= memory_budget:
+                return batch
+            batch -= 1
+        return 0
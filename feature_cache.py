@@ -0,0 +1,163 @@
+import torch
+from diffusers.utils import USE_PEFT_BACKEND, scale_lora_layers, unscale_lora_layers
+
+from placement import load_weights
+
+
+class DeepFeatureCache:
+    """
+    Reuse of deep UNet features between adjacent denoising steps, after DeepCache (Ma et al., 2023).
+
+    The output of the deep, low resolution blocks of the UNet changes little from one step to the next, while the
+    skip connections of the outer blocks carry the detail. On a full step the whole UNet runs and the input of its
+    outermost `depth` up blocks is kept. On a partial step only `conv_in`, the outermost `depth` down blocks and those
+    up blocks run, starting from the kept features. A full step runs every `interval` steps, starting with the first.
+
+    ControlNet residuals are added to the skip connections a partial step computes; the deeper residuals and the mid
+    block residual only reach the UNet on full steps, through the kept features.
+    """
+
+    def __init__(self, unet, interval, depth=1):
+        if (
+            unet.class_embedding is not None
+            or unet.config.addition_embed_type is not None
+            or unet.encoder_hid_proj is not None
+            or unet.time_embed_act is not None
+        ):
+            raise ValueError(
+                "Feature caching supports UNets conditioned on timestep and text only"
+            )
+        if not 1 <= depth < len(unet.up_blocks):
+            raise ValueError(
+                f"Feature cache depth must be between 1 and {len(unet.up_blocks) - 1}, got {depth}"
+            )
+        if interval < 1:
+            raise ValueError(
+                f"Feature cache interval must be at least 1, got {interval}"
+            )
+        self.unet = unet
+        self.interval = interval
+        self.depth = depth
+
+    def is_full_step(self, i):
+        return i % self.interval == 0
+
+    def full(self, sample, timestep, **kwargs):
+        """Runs the whole UNet, returns `(model_pred, features)`. `kwargs` are passed on to the UNet"""
+        features = []
+        hook = self.unet.up_blocks[-self.depth - 1].register_forward_hook(
+            lambda module, args, output: features.append(output)
+        )
+        try:
+            model_pred = self.unet(sample, timestep, return_dict=False, **kwargs)[0]
+        finally:
+            hook.remove()
+        return model_pred, features[0]
+
+    def partial(
+        self,
+        features,
+        sample,
+        timestep,
+        timestep_cond=None,
+        encoder_hidden_states=None,
+        cross_attention_kwargs=None,
+        down_block_additional_residuals=None,
+        mid_block_additional_residual=None,
+    ):
+        """
+        Runs the outer blocks of the UNet on `features` from a full step, mirroring `UNet2DConditionModel.forward`.
+        Returns the model prediction.
+        """
+        unet = self.unet
+        # the blocks are called one by one, bypassing the forward that loads an offloaded UNet
+        load_weights(unet)
+        # the spatial size is only a multiple of the overall upsampling factor for some sizes
+        forward_upsample_size = any(
+            s % 2**unet.num_upsamplers != 0 for s in sample.shape[-2:]
+        )
+
+        timesteps = torch.as_tensor(timestep, device=sample.device)
+        if timesteps.ndim == 0:
+            timesteps = timesteps[None]
+        timesteps = timesteps.expand(sample.shape[0])
+        t_emb = unet.time_proj(timesteps).to(dtype=sample.dtype)
+        emb = unet.time_embedding(t_emb, timestep_cond)
+
+        lora_scale = (
+            cross_attention_kwargs.get("scale", 1.0)
+            if cross_attention_kwargs is not None
+            else 1.0
+        )
+        if USE_PEFT_BACKEND:
+            scale_lora_layers(unet, lora_scale)
+
+        sample = unet.conv_in(sample)
+        down_block_res_samples = (sample,)
+        for downsample_block in unet.down_blocks[: self.depth]:
+            if getattr(downsample_block, "has_cross_attention", False):
+                sample, res_samples = downsample_block(
+                    hidden_states=sample,
+                    temb=emb,
+                    encoder_hidden_states=encoder_hidden_states,
+                    cross_attention_kwargs=cross_attention_kwargs,
+                )
+            else:
+                sample, res_samples = downsample_block(
+                    hidden_states=sample, temb=emb, scale=lora_scale
+                )
+            down_block_res_samples += res_samples
+
+        up_blocks = unet.up_blocks[-self.depth :]
+        # the skip connections the outer up blocks consume, the deeper ones come with the features
+        down_block_res_samples = down_block_res_samples[
+            : sum(len(block.resnets) for block in up_blocks)
+        ]
+        if down_block_additional_residuals is not None:
+            down_block_res_samples = tuple(
+                res_sample + residual
+                for res_sample, residual in zip(
+                    down_block_res_samples, down_block_additional_residuals
+                )
+            )
+
+        sample = features
+        for i, upsample_block in enumerate(up_blocks):
+            is_final_block = i == len(up_blocks) - 1
+
+            res_samples = down_block_res_samples[-len(upsample_block.resnets) :]
+            down_block_res_samples = down_block_res_samples[
+                : -len(upsample_block.resnets)
+            ]
+
+            upsample_size = None
+            if not is_final_block and forward_upsample_size:
+                upsample_size = down_block_res_samples[-1].shape[2:]
+
+            if getattr(upsample_block, "has_cross_attention", False):
+                sample = upsample_block(
+                    hidden_states=sample,
+                    temb=emb,
+                    res_hidden_states_tuple=res_samples,
+                    encoder_hidden_states=encoder_hidden_states,
+                    cross_attention_kwargs=cross_attention_kwargs,
+                    upsample_size=upsample_size,
+                )
+            else:
+                sample = upsample_block(
+                    hidden_states=sample,
+                    temb=emb,
+                    res_hidden_states_tuple=res_samples,
+                    upsample_size=upsample_size,
+                    scale=lora_scale,
+                )
+
+        if unet.conv_norm_out:
+            sample = unet.conv_norm_out(sample)
+            sample = unet.conv_act(sample)
+        sample = unet.conv_out(sample)
+
+        if USE_PEFT_BACKEND:
+            unscale_lora_layers(unet, lora_scale)
+
+        return sample
@@ -16,7 +16,10 @@
 # DISCLAIMER: This code is strongly influenced by https://github.com/pesser/pytorch_diffusion
 # and https://github.com/hojonathanho/diffusion
 
+import contextlib
+import copy
 import math
+import time
 from dataclasses import dataclass
 from typing import Any, Dict, List, Optional, Tuple, Union
 
@@ -43,14 +46,146 @@ from diffusers.utils import BaseOutput
 
 from diffusers.utils.torch_utils import randn_tensor, is_compiled_module
 from diffusers.pipelines.controlnet.multicontrolnet import MultiControlNetModel
+from torch.func import functional_call, stack_module_state, vmap
 
 
 import PIL.Image
 
+from feature_cache import DeepFeatureCache
+from placement import load_weights
+from tiling import Tiling
+from token_merging import TokenMerging
+
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
 
+class GenerationCancelled(Exception):
+    """Raised between denoising steps when the request's cancellation token has been set"""
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised from a step callback when the request's deadline has passed. Carries the latest `denoised` prediction so
+    the caller can still decode a best-so-far result.
+    """
+
+    def __init__(self, denoised, steps):
+        super().__init__(f"Deadline reached after {steps} steps")
+        self.denoised = denoised
+        self.steps = steps
+
+
+class Converged(DeadlineExceeded):
+    """Raised from a step callback once every row has converged, with the same payload as `DeadlineExceeded`"""
+
+    def __init__(self, denoised, steps):
+        Exception.__init__(self, f"Converged after {steps} steps")
+        self.denoised = denoised
+        self.steps = steps
+
+
+@dataclass
+class LatentConsistencyPipelineOutput(StableDiffusionPipelineOutput):
+    """`StableDiffusionPipelineOutput` plus the number of steps each image was sampled for"""
+
+    steps_used: Optional[List[int]] = None
+
+
+def relative_change(previous, current):
+    """Per-row change between two `denoised` predictions, relative to the L2 norm of the previous one"""
+    previous = previous.float().flatten(1)
+    current = current.float().flatten(1)
+    return (current - previous).norm(dim=1) / previous.norm(dim=1).clamp_min(1e-6)
+
+
+def repeat_rows(tensor, repeats):
+    """
+    `tensor` with every row repeated `repeats` times. A single row is broadcast instead of copied, so the inputs shared
+    by all images of a prompt take the memory of one image however many are requested.
+    """
+    if tensor.shape[0] == 1:
+        return tensor.expand(repeats, *tensor.shape[1:])
+    return tensor.repeat_interleave(repeats, dim=0)
+
+
+def randn_into(out, generator=None):
+    """
+    Fills `out` with the noise `randn_tensor(out.shape, generator=generator)` samples, without allocating. The
+    generators must be on the device of `out`.
+    """
+    if isinstance(generator, list) and len(generator) > 1:
+        for row, row_generator in zip(out.split(1), generator):
+            torch.randn(row.shape, generator=row_generator, out=row)
+        return out
+    if isinstance(generator, list):
+        generator = generator[0]
+    return torch.randn(out.shape, generator=generator, out=out)
+
+
+def quantize_images(image, do_denormalize=None, out=None):
+    """
+    Decoded images in [-1, 1] as uint8 `(batch, height, width, channels)`: denormalized, clamped and rounded on their
+    device, so that a quarter of the bytes of float32 cross to the host and the host does no float work. Rows with
+    `do_denormalize` False are taken to be in [0, 1] already. Matches `VaeImageProcessor.postprocess` followed by
+    `numpy_to_pil`. The result is written to `out` if given.
+    """
+    if do_denormalize is None:
+        image = image / 2 + 0.5
+    else:
+        rows = torch.tensor(do_denormalize, device=image.device)[:, None, None, None]
+        image = torch.where(rows, image / 2 + 0.5, image)
+    image = image.clamp(0, 1).float().mul_(255).round_().to(torch.uint8)
+    if out is not None:
+        return out.copy_(image.permute(0, 2, 3, 1))
+    return image.permute(0, 2, 3, 1).contiguous()
+
+
+def copy_to_host(tensor, non_blocking=False, arena=None):
+    """
+    `tensor` copied into a page-locked host buffer, taken from `arena` if given, as allocating page-locked memory is
+    slow and synchronizes the device; read it with `host_array`. With `non_blocking` the copy is only queued, and an
+    event is returned to wait on before reading the buffer; otherwise the event is None.
+    """
+    if tensor.device.type == "cpu":
+        return tensor, None
+    if arena is not None:
+        buffer = arena.take(tensor.shape, tensor.dtype, "cpu")
+    else:
+        buffer = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+    buffer.copy_(tensor, non_blocking=non_blocking)
+    if not non_blocking:
+        return buffer, None
+    event = torch.cuda.Event()
+    event.record()
+    return buffer, event
+
+
+def host_array(buffer, arena=None):
+    """
+    A host buffer from `copy_to_host` as a numpy array. A page-locked buffer taken from `arena` is copied out of and
+    given back, so it is reused by the next copy instead of allocated.
+    """
+    if arena is None or not buffer.is_pinned():
+        return buffer.numpy()
+    array = buffer.numpy().copy()
+    arena.give([buffer])
+    return array
+
+
+def check_safety(safety_checker, feature_extractor, images, device, dtype):
+    """
+    Runs `safety_checker` on uint8 host images from `quantize_images`, blacking out flagged ones in place. Returns
+    `(images, has_nsfw_concept)`.
+    """
+    safety_checker_input = feature_extractor(
+        [PIL.Image.fromarray(image) for image in images], return_tensors="pt"
+    ).to(device)
+    return safety_checker(
+        images=images, clip_input=safety_checker_input.pixel_values.to(dtype)
+    )
+
+
 # Copied from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion_img2img.retrieve_latents
 def retrieve_latents(encoder_output, generator):
     if hasattr(encoder_output, "latent_dist"):
@@ -61,8 +196,83 @@ def retrieve_latents(encoder_output, generator):
         raise AttributeError("Could not access latents of provided encoder_output")
 
 
+@torch.no_grad()
+def encode_init_latents(vae, image, generator):
+    """
+    Encodes each distinct init image once and samples one latent per generator, so that row `i` of the batch only
+    depends on `generator[i]` and image `i % len(image)`, whatever else is in the batch.
+    """
+    latent_dist = vae.encode(image).latent_dist
+    init_latents = []
+    for i, row_generator in enumerate(generator):
+        j = i % image.shape[0]
+        mean, std = latent_dist.mean[j : j + 1], latent_dist.std[j : j + 1]
+        noise = randn_tensor(
+            mean.shape, generator=row_generator, device=mean.device, dtype=mean.dtype
+        )
+        init_latents.append(mean + std * noise)
+    return vae.config.scaling_factor * torch.cat(init_latents, dim=0)
+
+
+class EarlyStopping:
+    """
+    Adaptive sampling for one batch. After each step, rows whose `denoised` prediction changed by less than
+    `threshold` (see `relative_change`) since the previous step, and rows whose own schedule has ended, are dropped
+    from the batch. `step_state` is the state of the rows still sampling, `denoised` the latest prediction of every
+    row of the full batch and `steps_used` the number of steps each row ran.
+    """
+
+    def __init__(self, pipe, state, threshold):
+        self.pipe = pipe
+        self.state = state
+        self.threshold = threshold
+        self.rows = torch.arange(state["bs"])
+        self.step_state = state
+        self.steps_used = torch.zeros(state["bs"], dtype=torch.long)
+        self.denoised = None
+        self.previous = None
+
+    @property
+    def finished(self):
+        return len(self.rows) == 0
+
+    def update(self, i, latents, denoised):
+        """Records step `i` of the rows still sampling and returns the latents of the ones that continue"""
+        self.steps_used[self.rows] += 1
+        if self.denoised is None:
+            self.denoised = denoised.clone()
+        else:
+            self.denoised[self.rows.to(denoised.device)] = denoised
+
+        done = torch.zeros(len(self.rows), dtype=torch.bool)
+        if self.threshold is not None and self.previous is not None:
+            done |= (relative_change(self.previous, denoised) < self.threshold).cpu()
+        if self.step_state["row_steps"] is not None:
+            done |= self.step_state["row_steps"] <= i + 1
+        self.previous = denoised
+
+        if done.any():
+            keep = ~done
+            self.rows = self.rows[keep]
+            # selected from the current state, which holds the features and residuals of earlier steps
+            self.step_state = self.pipe.select_rows(
+                self.step_state, keep.nonzero()[:, 0]
+            )
+            keep = keep.to(latents.device)
+            latents, self.previous = latents[keep], denoised[keep]
+        return latents
+
+
 class LatentConsistencyModelPipeline_controlnet(DiffusionPipeline):
     _optional_components = ["scheduler"]
+    # outer block pairs a partial step of the feature cache recomputes, see `DeepFeatureCache`
+    feature_cache_depth = 1
+    # set by `enable_token_merging`
+    token_merging = None
+    # set by `enable_buffer_arena`
+    arena = None
+    # set by `Placement.apply`, drops the offloaded components from the device after a call
+    final_offload_hook = None
 
     def __init__(
         self,
@@ -187,12 +397,8 @@ class LatentConsistencyModelPipeline_controlnet(DiffusionPipeline):
 
         prompt_embeds = prompt_embeds.to(dtype=prompt_embeds_dtype, device=device)
 
-        bs_embed, seq_len, _ = prompt_embeds.shape
-        # duplicate text embeddings for each generation per prompt, using mps friendly method
-        prompt_embeds = prompt_embeds.repeat(1, num_images_per_prompt, 1)
-        prompt_embeds = prompt_embeds.view(
-            bs_embed * num_images_per_prompt, seq_len, -1
-        )
+        # duplicate text embeddings for each generation per prompt
+        prompt_embeds = repeat_rows(prompt_embeds, num_images_per_prompt)
 
         # Don't need to get uncond prompt embedding because of LCM Guided Distillation
         return prompt_embeds
@@ -200,11 +406,16 @@ class LatentConsistencyModelPipeline_controlnet(DiffusionPipeline):
     def run_safety_checker(self, image, device, dtype):
         if self.safety_checker is None:
             has_nsfw_concept = None
+        elif isinstance(image, np.ndarray) and image.dtype == np.uint8:
+            image, has_nsfw_concept = check_safety(
+                self.safety_checker, self.feature_extractor, image, device, dtype
+            )
         else:
             if torch.is_tensor(image):
-                feature_extractor_input = self.image_processor.postprocess(
-                    image, output_type="pil"
-                )
+                host_image, _ = copy_to_host(quantize_images(image))
+                feature_extractor_input = [
+                    PIL.Image.fromarray(i) for i in host_image.numpy()
+                ]
             else:
                 feature_extractor_input = self.image_processor.numpy_to_pil(image)
             safety_checker_input = self.feature_extractor(
@@ -226,6 +437,7 @@ class LatentConsistencyModelPipeline_controlnet(DiffusionPipeline):
         dtype,
         do_classifier_free_guidance=False,
         guess_mode=False,
+        buffers=None,
     ):
         image = self.control_image_processor.preprocess(
             image, height=height, width=width
@@ -238,9 +450,27 @@ class LatentConsistencyModelPipeline_controlnet(DiffusionPipeline):
             # image batch size is the same as prompt batch size
             repeat_by = num_images_per_prompt
 
-        image = image.repeat_interleave(repeat_by, dim=0)
-
-        image = image.to(device=device, dtype=dtype)
+        # moved before repeating, copying a broadcast tensor to another device materializes it
+        if buffers is not None and (
+            image.is_contiguous()
+            or image.is_contiguous(memory_format=torch.channels_last)
+        ):
+            # in the layout the image processor made, which the convolutions of the ControlNets are sensitive to
+            buffer = self.arena.take(
+                image.shape,
+                dtype,
+                device,
+                (
+                    torch.contiguous_format
+                    if image.is_contiguous()
+                    else torch.channels_last
+                ),
+            )
+            buffers["taken"].append(buffer)
+            image = buffer.copy_(image)
+        else:
+            image = image.to(device=device, dtype=dtype)
+        image = repeat_rows(image, repeat_by)
 
         if do_classifier_free_guidance and not guess_mode:
             image = torch.cat([image] * 2)
@@ -259,6 +489,7 @@ class LatentConsistencyModelPipeline_controlnet(DiffusionPipeline):
         device,
         latents=None,
         generator=None,
+        buffers=None,
     ):
         shape = (
             batch_size,
@@ -267,6 +498,20 @@ class LatentConsistencyModelPipeline_controlnet(DiffusionPipeline):
             width // self.vae_scale_factor,
         )
 
+        if image is None:
+            # text-to-image: start from pure noise, no init image to encode
+            if latents is None and buffers is not None:
+                latents = self.sample_noise(buffers, shape, generator)
+            elif latents is None:
+                latents = randn_tensor(
+                    shape, generator=generator, device=device, dtype=dtype
+                )
+            else:
+                latents = latents.to(device=device, dtype=dtype)
+            # scale the initial noise by the standard deviation required by the scheduler
+            latents = latents * self.scheduler.init_noise_sigma
+            return latents
+
         if not isinstance(image, (torch.Tensor, PIL.Image.Image, list)):
             raise ValueError(
                 f"`image` has to be of type `torch.Tensor`, `PIL.Image.Image` or list but is {type(image)}"
@@ -287,19 +532,12 @@ class LatentConsistencyModelPipeline_controlnet(DiffusionPipeline):
                 )
 
             elif isinstance(generator, list):
-                init_latents = [
-                    retrieve_latents(
-                        self.vae.encode(image[i : i + 1]), generator=generator[i]
-                    )
-                    for i in range(batch_size)
-                ]
-                init_latents = torch.cat(init_latents, dim=0)
+                init_latents = encode_init_latents(self.vae, image, generator)
             else:
                 init_latents = retrieve_latents(
                     self.vae.encode(image), generator=generator
                 )
-
-            init_latents = self.vae.config.scaling_factor * init_latents
+                init_latents = self.vae.config.scaling_factor * init_latents
 
         if (
             batch_size > init_latents.shape[0]
@@ -314,9 +552,13 @@ class LatentConsistencyModelPipeline_controlnet(DiffusionPipeline):
             )
             # deprecate("len(prompt) != len(image)", "1.0.0", deprecation_message, standard_warn=False)
             additional_image_per_prompt = batch_size // init_latents.shape[0]
-            init_latents = torch.cat(
-                [init_latents] * additional_image_per_prompt, dim=0
-            )
+            if init_latents.shape[0] == 1:
+                # broadcast, adding the noise gives every row its own copy anyway
+                init_latents = repeat_rows(init_latents, additional_image_per_prompt)
+            else:
+                init_latents = torch.cat(
+                    [init_latents] * additional_image_per_prompt, dim=0
+                )
         elif (
             batch_size > init_latents.shape[0]
             and batch_size % init_latents.shape[0] != 0
@@ -328,7 +570,10 @@ class LatentConsistencyModelPipeline_controlnet(DiffusionPipeline):
             init_latents = torch.cat([init_latents], dim=0)
 
         shape = init_latents.shape
-        noise = randn_tensor(shape, generator=generator, device=device, dtype=dtype)
+        if buffers is not None:
+            noise = self.sample_noise(buffers, shape, generator)
+        else:
+            noise = randn_tensor(shape, generator=generator, device=device, dtype=dtype)
 
         # get latents
         init_latents = self.scheduler.add_noise(init_latents, noise, timestep)
@@ -336,13 +581,260 @@ class LatentConsistencyModelPipeline_controlnet(DiffusionPipeline):
 
         return latents
 
-        if latents is None:
-            latents = torch.randn(shape, dtype=dtype).to(device)
-        else:
-            latents = latents.to(device)
-        # scale the initial noise by the standard deviation required by the scheduler
-        latents = latents * self.scheduler.init_noise_sigma
-        return latents
+    def enable_batched_controlnets(self):
+        r"""
+        Evaluate the nets of a `MultiControlNetModel` in one vmapped call per step when they share an architecture
+        and are all active. Their weights are moved into stacked tensors that each net keeps viewing, so this costs
+        no extra memory. Call it after the pipeline has been moved to its final device and dtype, or before a
+        `Placement` is applied to it, which moves the stack along with the nets.
+        """
+        if not isinstance(self.controlnet, MultiControlNetModel):
+            raise ValueError("Batched evaluation needs a `MultiControlNetModel`")
+
+        nets = list(self.controlnet.nets)
+        shapes = [
+            [(name, param.shape) for name, param in net.state_dict().items()]
+            for net in nets
+        ]
+        if any(net_shapes != shapes[0] for net_shapes in shapes[1:]):
+            logger.warning(
+                "ControlNets do not share an architecture, they will be evaluated one at a time"
+            )
+            return
+
+        if hasattr(self.controlnet, "_batched_stack"):
+            return
+
+        params, buffers = stack_module_state(nets)
+        for i, net in enumerate(nets):
+            for name, param in net.named_parameters():
+                param.data = params[name].data[i]
+        base = copy.deepcopy(nets[0]).to("meta")
+        # kept on the model so that pipelines sharing these ControlNets share the stack too
+        self.controlnet._batched_stack = (params, buffers, base)
+
+    def enable_token_merging(self, ratios, max_downsample=1):
+        r"""
+        Let requests merge similar tokens in the self-attention of the UNet and the ControlNets, see `TokenMerging`.
+        `ratios` maps a minimum pixel count to the share of tokens merged from that image size up. Call it after
+        `enable_batched_controlnets`, so that the batched ControlNets merge tokens too.
+        """
+        if self.token_merging is not None:
+            self.token_merging.remove()
+        self.token_merging = TokenMerging(ratios, max_downsample=max_downsample)
+        self.token_merging.apply(self.unet)
+        self.token_merging.apply(self.controlnet)
+        if hasattr(self.controlnet, "_batched_stack"):
+            self.token_merging.apply(self.controlnet._batched_stack[2])
+
+    def enable_buffer_arena(self, arena):
+        r"""
+        Take the tensors a request keeps for its whole sampling loop (latents, denoised predictions, noise and
+        control images) and its decoded images from `arena`, a `BufferArena`, instead of allocating them. The state
+        of `prepare_generation` then holds them as `buffers`; hand them back with `release_buffers` once the request
+        is decoded.
+        """
+        self.arena = arena
+
+    def take_buffers(self, shape, dtype, device, generator):
+        """
+        The arena buffers of a request whose latents have `shape`. Steps alternate between two buffers for the
+        latents and two for the denoised predictions, so the results of the previous step stay readable. Noise
+        sampled by CPU generators for the device is staged in a host buffer.
+        """
+        taken = [self.arena.take(shape, dtype, device) for _ in range(5)]
+        if isinstance(generator, list):
+            generator = generator[0]
+        staging = None
+        if generator is not None and generator.device.type != torch.device(device).type:
+            staging = self.arena.take(shape, dtype, "cpu")
+            taken.append(staging)
+        return {
+            "latents": taken[0:2],
+            "denoised": taken[2:4],
+            "noise": taken[4],
+            "noise_host": staging,
+            # recorded after the last copy out of the host buffer, see sample_noise
+            "noise_copied": None,
+            "taken": taken,
+        }
+
+    def release_buffers(self, state):
+        """Hand the arena buffers of a request back, see `enable_buffer_arena`. Does nothing the second time"""
+        buffers = state.get("buffers")
+        if buffers is None or not buffers["taken"]:
+            return
+        if buffers["noise_copied"] is not None:
+            # the next user writes the host buffer from the CPU, not after the copy on the stream
+            buffers["noise_copied"].synchronize()
+        self.arena.give(buffers["taken"])
+        buffers["taken"] = []
+
+    def sample_noise(self, buffers, shape, generator):
+        """The noise `randn_tensor` samples for `shape`, sampled into the first rows of the request's noise buffer"""
+        noise = buffers["noise"][: shape[0]]
+        staging = buffers["noise_host"]
+        if staging is None:
+            return randn_into(noise, generator)
+        if buffers["noise_copied"] is not None:
+            # queued a step ago, so this does not wait in practice
+            buffers["noise_copied"].synchronize()
+        noise.copy_(randn_into(staging[: shape[0]], generator), non_blocking=True)
+        buffers["noise_copied"] = torch.cuda.Event()
+        buffers["noise_copied"].record()
+        return noise
+
+    @contextlib.contextmanager
+    def vae_tiling(self, enabled):
+        """Context in which the VAE encodes and decodes in tiles if `enabled`, for tiled generation"""
+        use_tiling = self.vae.use_tiling
+        self.vae.use_tiling = use_tiling or enabled
+        try:
+            yield
+        finally:
+            self.vae.use_tiling = use_tiling
+
+    def merging_tokens(self, state, latents):
+        """Context for the model calls of a step of `state`, merging tokens if the request asked for it"""
+        ratio = state["token_merging_ratio"]
+        if ratio <= 0:
+            return contextlib.nullcontext()
+        return self.token_merging.merging(ratio, latents.shape[-2:])
+
+    def controlnet_residuals(
+        self,
+        control_model_input,
+        timestep,
+        prompt_embeds,
+        control_image,
+        cond_scale,
+        guess_mode,
+    ):
+        r"""
+        Runs the ControlNet(s) for one step and returns `(down_block_res_samples, mid_block_res_sample)`, or
+        `(None, None)` when no net is active. A net is active when it has a control image and a non-zero scale, so
+        nets outside their guidance window cost nothing.
+        """
+        if isinstance(self.controlnet, ControlNetModel):
+            if control_image is None or not torch.as_tensor(cond_scale).any():
+                return None, None
+            return self.run_controlnet(
+                self.controlnet,
+                control_model_input,
+                timestep,
+                prompt_embeds,
+                control_image,
+                cond_scale,
+                guess_mode,
+            )
+
+        nets = self.controlnet.nets
+        active = [
+            k
+            for k in range(len(nets))
+            if control_image[k] is not None and torch.as_tensor(cond_scale[k]).any()
+        ]
+        if not active:
+            return None, None
+        # neither path goes through the forward of the `MultiControlNetModel`, which loads it if it is offloaded
+        load_weights(self.controlnet)
+
+        if len(active) == len(nets) > 1 and hasattr(self.controlnet, "_batched_stack"):
+            params, buffers, base = self.controlnet._batched_stack
+            per_row = any(torch.is_tensor(scale) for scale in cond_scale)
+            if per_row:
+                scales = torch.stack(
+                    [
+                        torch.as_tensor(scale).expand(control_model_input.shape[0])
+                        for scale in cond_scale
+                    ]
+                )
+            else:
+                scales = torch.tensor(cond_scale)
+
+            def run_net(params, buffers, image, scale):
+                down_samples, mid_sample = functional_call(
+                    base,
+                    (params, buffers),
+                    (control_model_input, timestep),
+                    {
+                        "encoder_hidden_states": prompt_embeds,
+                        "controlnet_cond": image,
+                        "conditioning_scale": 1.0 if per_row else scale,
+                        "guess_mode": guess_mode,
+                        "return_dict": False,
+                    },
+                )
+                if per_row:
+                    scale = scale[:, None, None, None]
+                    down_samples = [d * scale for d in down_samples]
+                    mid_sample = mid_sample * scale
+                return down_samples, mid_sample
+
+            if all(image.stride(0) == 0 for image in control_image):
+                # images broadcast over the rows stay broadcast
+                control_image = torch.stack([image[:1] for image in control_image])
+                control_image = control_image.expand(
+                    -1, control_model_input.shape[0], -1, -1, -1
+                )
+            else:
+                control_image = torch.stack(control_image)
+
+            down_samples, mid_sample = vmap(run_net)(
+                params,
+                buffers,
+                control_image,
+                scales.to(
+                    device=control_model_input.device,
+                    dtype=control_model_input.dtype,
+                ),
+            )
+            return [d.sum(dim=0) for d in down_samples], mid_sample.sum(dim=0)
+
+        down_block_res_samples, mid_block_res_sample = None, None
+        for k in active:
+            down_samples, mid_sample = self.run_controlnet(
+                nets[k],
+                control_model_input,
+                timestep,
+                prompt_embeds,
+                control_image[k],
+                cond_scale[k],
+                guess_mode,
+            )
+            if down_block_res_samples is None:
+                down_block_res_samples, mid_block_res_sample = down_samples, mid_sample
+            else:
+                down_block_res_samples = [
+                    prev + curr
+                    for prev, curr in zip(down_block_res_samples, down_samples)
+                ]
+                mid_block_res_sample += mid_sample
+        return down_block_res_samples, mid_block_res_sample
+
+    def run_controlnet(
+        self, net, sample, timestep, prompt_embeds, image, scale, guess_mode
+    ):
+        """
+        Calls a single ControlNet. `scale` is a float or a tensor with one scale per row; a per-row scale is applied
+        to the residuals after a unit-scale call, which is exact because the residuals are linear in the scale.
+        """
+        per_row = torch.is_tensor(scale)
+        down_samples, mid_sample = net(
+            sample,
+            timestep,
+            encoder_hidden_states=prompt_embeds,
+            controlnet_cond=image,
+            conditioning_scale=1.0 if per_row else scale,
+            guess_mode=guess_mode,
+            return_dict=False,
+        )
+        if per_row:
+            scale = scale.to(device=mid_sample.device, dtype=mid_sample.dtype)
+            scale = scale[:, None, None, None]
+            down_samples = [d * scale for d in down_samples]
+            mid_sample = mid_sample * scale
+        return down_samples, mid_sample
 
     def get_w_embedding(self, w, embedding_dim=512, dtype=torch.float32):
         """
@@ -376,30 +868,85 @@ class LatentConsistencyModelPipeline_controlnet(DiffusionPipeline):
 
         return timesteps, num_inference_steps - t_start
 
-    @torch.no_grad()
-    def __call__(
+    def per_row(self, value, batch_size, num_images_per_prompt):
+        """
+        Expands a scalar, a list with one value per prompt or a list with one value per image to one value per row
+        of the batch
+        """
+        bs = batch_size * num_images_per_prompt
+        if not isinstance(value, (list, tuple)):
+            return [value] * bs
+        if len(value) == bs:
+            return list(value)
+        if len(value) == batch_size:
+            return [v for v in value for _ in range(num_images_per_prompt)]
+        raise ValueError(
+            f"Expected one value per prompt ({batch_size}) or per image ({bs}), got {len(value)}"
+        )
+
+    def prepare_generation(
         self,
-        prompt: Union[str, List[str]] = None,
-        image: PipelineImageInput = None,
-        control_image: PipelineImageInput = None,
-        strength: float = 0.8,
-        height: Optional[int] = 768,
-        width: Optional[int] = 768,
-        guidance_scale: float = 7.5,
-        num_images_per_prompt: Optional[int] = 1,
-        latents: Optional[torch.FloatTensor] = None,
-        generator: Optional[torch.Generator] = None,
-        num_inference_steps: int = 4,
-        lcm_origin_steps: int = 50,
-        prompt_embeds: Optional[torch.FloatTensor] = None,
-        output_type: Optional[str] = "pil",
-        return_dict: bool = True,
-        cross_attention_kwargs: Optional[Dict[str, Any]] = None,
-        controlnet_conditioning_scale: Union[float, List[float]] = 0.8,
-        guess_mode: bool = True,
-        control_guidance_start: Union[float, List[float]] = 0.0,
-        control_guidance_end: Union[float, List[float]] = 1.0,
+        prompt=None,
+        image=None,
+        control_image=None,
+        strength=0.8,
+        height=768,
+        width=768,
+        guidance_scale=7.5,
+        num_images_per_prompt=1,
+        latents=None,
+        generator=None,
+        num_inference_steps=4,
+        lcm_origin_steps=50,
+        prompt_embeds=None,
+        controlnet_conditioning_scale=0.8,
+        guess_mode=True,
+        control_guidance_start=0.0,
+        control_guidance_end=1.0,
+        scheduler=None,
+        feature_cache_interval=None,
+        controlnet_cache_interval=None,
+        token_merging=False,
+        tile_size=None,
+        tile_overlap=128,
+        tile_batch_size=4,
     ):
+        r"""
+        Runs everything that happens before the sampling loop and returns the per-request state as a dict: encoded
+        prompt, prepared control images, noised latents, timesteps, guidance embedding and per-step ControlNet
+        keep factors. `scheduler` defaults to the pipeline's own; passing a separate `LCMScheduler_X` keeps the
+        timesteps of this request independent of other requests.
+
+        `guidance_scale`, `num_inference_steps`, `strength` and `lcm_origin_steps` can also be lists with one value
+        per prompt or per image, as can the conditioning scale of each ControlNet, so images with different settings
+        share one batch. With per-row schedules `timesteps` has shape `(steps, batch_size)` and `row_steps` holds
+        the length of each row's schedule, see `LCMScheduler_X.set_timesteps`.
+
+        With `feature_cache_interval`, the UNet only runs in full every that many steps and reuses its deep features
+        in between, see `DeepFeatureCache`. The features of the last full step are kept in the state as `features`.
+        With `controlnet_cache_interval`, the ControlNets only run every that many steps, or when a net enters or
+        leaves its guidance window, and the residuals are reused in between. The state keeps them as `residuals`,
+        `(step, down_block_res_samples, mid_block_res_sample)`. With `token_merging`, the state's
+        `token_merging_ratio` is the pipeline's merge ratio for the image size, see `enable_token_merging`.
+
+        With `tile_size`, images larger than that many pixels in either direction are denoised in overlapping tiles,
+        `tile_batch_size` at a time, see `Tiling`. The VAE then also encodes and decodes in tiles.
+        """
+        if controlnet_cache_interval is not None and controlnet_cache_interval < 1:
+            raise ValueError(
+                f"ControlNet cache interval must be at least 1, got {controlnet_cache_interval}"
+            )
+        if tile_size is not None and (
+            feature_cache_interval is not None or controlnet_cache_interval is not None
+        ):
+            raise ValueError(
+                "Tiled generation does not support feature or ControlNet caching"
+            )
+        if token_merging and self.token_merging is None:
+            raise ValueError(
+                "Token merging is not enabled on this pipeline, see `enable_token_merging`"
+            )
+        scheduler = scheduler if scheduler is not None else self.scheduler
         controlnet = (
             self.controlnet._orig_mod
             if is_compiled_module(self.controlnet)
@@ -408,6 +955,15 @@ class LatentConsistencyModelPipeline_controlnet(DiffusionPipeline):
         # 0. Default height and width to unet
         height = height or self.unet.config.sample_size * self.vae_scale_factor
         width = width or self.unet.config.sample_size * self.vae_scale_factor
+        tiling = None
+        if tile_size is not None and max(width, height) > tile_size:
+            tiling = Tiling(
+                height // self.vae_scale_factor,
+                width // self.vae_scale_factor,
+                tile_size // self.vae_scale_factor,
+                tile_overlap // self.vae_scale_factor,
+                tile_batch_size,
+            )
         if not isinstance(control_guidance_start, list) and isinstance(
             control_guidance_end, list
         ):
@@ -429,6 +985,12 @@ class LatentConsistencyModelPipeline_controlnet(DiffusionPipeline):
             control_guidance_start, control_guidance_end = mult * [
                 control_guidance_start
             ], mult * [control_guidance_end]
+        if isinstance(controlnet, MultiControlNetModel) and not isinstance(
+            controlnet_conditioning_scale, list
+        ):
+            controlnet_conditioning_scale = [controlnet_conditioning_scale] * len(
+                controlnet.nets
+            )
         # 2. Define call parameters
         if prompt is not None and isinstance(prompt, str):
             batch_size = 1
@@ -436,6 +998,29 @@ class LatentConsistencyModelPipeline_controlnet(DiffusionPipeline):
             batch_size = len(prompt)
         else:
             batch_size = prompt_embeds.shape[0]
+        bs = batch_size * num_images_per_prompt
+
+        # per-row conditioning scales become tensors, get_cond_scale and run_controlnet apply them row by row
+        if isinstance(controlnet, MultiControlNetModel):
+            controlnet_conditioning_scale = [
+                (
+                    torch.tensor(
+                        self.per_row(scale, batch_size, num_images_per_prompt)
+                    ).float()
+                    if isinstance(scale, (list, tuple))
+                    else scale
+                )
+                for scale in controlnet_conditioning_scale
+            ]
+        elif (
+            isinstance(controlnet_conditioning_scale, (list, tuple))
+            and len(controlnet_conditioning_scale) > 1
+        ):
+            controlnet_conditioning_scale = torch.tensor(
+                self.per_row(
+                    controlnet_conditioning_scale, batch_size, num_images_per_prompt
+                )
+            ).float()
 
         device = self._execution_device
         # do_classifier_free_guidance = guidance_scale > 0.0  # In LCM Implementation:  cfg_noise = noise_cond + cfg_scale * (noise_cond - noise_uncond) , (cfg_scale > 0.0 using CFG)
@@ -452,11 +1037,28 @@ class LatentConsistencyModelPipeline_controlnet(DiffusionPipeline):
             num_images_per_prompt,
             prompt_embeds=prompt_embeds,
         )
+        buffers = None
+        if self.arena is not None:
+            buffers = self.take_buffers(
+                (
+                    bs,
+                    self.unet.config.in_channels,
+                    height // self.vae_scale_factor,
+                    width // self.vae_scale_factor,
+                ),
+                prompt_embeds.dtype,
+                device,
+                generator,
+            )
 
         # 3.5 encode image
-        image = self.image_processor.preprocess(image)
+        if image is not None:
+            image = self.image_processor.preprocess(image)
+        else:
+            # without an init image, denoise from pure noise over the full schedule
+            strength = 1.0
 
-        if isinstance(controlnet, ControlNetModel):
+        if isinstance(controlnet, ControlNetModel) and control_image is not None:
             control_image = self.prepare_control_image(
                 image=control_image,
                 width=width,
@@ -466,140 +1068,415 @@ class LatentConsistencyModelPipeline_controlnet(DiffusionPipeline):
                 device=device,
                 dtype=controlnet.dtype,
                 guess_mode=guess_mode,
+                buffers=buffers,
             )
         elif isinstance(controlnet, MultiControlNetModel):
+            if control_image is None:
+                # no net is active
+                control_image = [None] * len(controlnet.nets)
+            elif len(control_image) != len(controlnet.nets):
+                raise ValueError(
+                    f"Got {len(control_image)} control images for {len(controlnet.nets)} ControlNets, pass None "
+                    "for the nets to skip"
+                )
             control_images = []
 
             for control_image_ in control_image:
-                control_image_ = self.prepare_control_image(
-                    image=control_image_,
-                    width=width,
-                    height=height,
-                    batch_size=batch_size * num_images_per_prompt,
-                    num_images_per_prompt=num_images_per_prompt,
-                    device=device,
-                    dtype=controlnet.dtype,
-                    do_classifier_free_guidance=do_classifier_free_guidance,
-                    guess_mode=guess_mode,
-                )
+                # nets without a control image are skipped for the whole request
+                if control_image_ is not None:
+                    control_image_ = self.prepare_control_image(
+                        image=control_image_,
+                        width=width,
+                        height=height,
+                        batch_size=batch_size * num_images_per_prompt,
+                        num_images_per_prompt=num_images_per_prompt,
+                        device=device,
+                        dtype=controlnet.dtype,
+                        guess_mode=guess_mode,
+                        buffers=buffers,
+                    )
 
                 control_images.append(control_image_)
 
             control_image = control_images
-        else:
-            assert False
 
         # 4. Prepare timesteps
-        self.scheduler.set_timesteps(strength, num_inference_steps, lcm_origin_steps)
+        schedule = (strength, num_inference_steps, lcm_origin_steps)
+        if any(isinstance(arg, (list, tuple)) for arg in schedule):
+            schedule = [
+                self.per_row(arg, batch_size, num_images_per_prompt) for arg in schedule
+            ]
+        scheduler.set_timesteps(*schedule)
         # timesteps = self.scheduler.timesteps
         # timesteps, num_inference_steps = self.get_timesteps(num_inference_steps, 1.0, device)
-        timesteps = self.scheduler.timesteps
-        latent_timestep = timesteps[:1].repeat(batch_size * num_images_per_prompt)
+        timesteps = scheduler.timesteps
+        row_steps = scheduler.row_num_inference_steps
+        latent_timestep = timesteps[0].expand(bs)
 
         # print("timesteps: ", timesteps)
 
         # 5. Prepare latent variable
         num_channels_latents = self.unet.config.in_channels
-        latents = self.prepare_latents(
-            image,
-            latent_timestep,
-            batch_size * num_images_per_prompt,
-            num_channels_latents,
-            height,
-            width,
-            prompt_embeds.dtype,
-            device,
-            latents,
-        )
-        bs = batch_size * num_images_per_prompt
+        with self.vae_tiling(tiling is not None):
+            latents = self.prepare_latents(
+                image,
+                latent_timestep,
+                batch_size * num_images_per_prompt,
+                num_channels_latents,
+                height,
+                width,
+                prompt_embeds.dtype,
+                device,
+                latents,
+                generator,
+                buffers,
+            )
 
         # 6. Get Guidance Scale Embedding
-        w = torch.tensor(guidance_scale).repeat(bs)
+        w = torch.tensor(
+            self.per_row(guidance_scale, batch_size, num_images_per_prompt)
+        )
         w_embedding = self.get_w_embedding(w, embedding_dim=256).to(
             device=device, dtype=latents.dtype
         )
         controlnet_keep = []
         for i in range(len(timesteps)):
-            keeps = [
-                1.0 - float(i / len(timesteps) < s or (i + 1) / len(timesteps) > e)
-                for s, e in zip(control_guidance_start, control_guidance_end)
-            ]
+            if row_steps is None:
+                keeps = [
+                    1.0 - float(i / len(timesteps) < s or (i + 1) / len(timesteps) > e)
+                    for s, e in zip(control_guidance_start, control_guidance_end)
+                ]
+            else:
+                # each row's guidance window is relative to its own schedule
+                keeps = [
+                    1.0 - ((i / row_steps < s) | ((i + 1) / row_steps > e)).float()
+                    for s, e in zip(control_guidance_start, control_guidance_end)
+                ]
             controlnet_keep.append(
                 keeps[0] if isinstance(controlnet, ControlNetModel) else keeps
             )
-        # 7. LCM MultiStep Sampling Loop:
-        with self.progress_bar(total=num_inference_steps) as progress_bar:
-            for i, t in enumerate(timesteps):
-                ts = torch.full((bs,), t, device=device, dtype=torch.long)
-                latents = latents.to(prompt_embeds.dtype)
-                if guess_mode:
-                    # Infer ControlNet only for the conditional batch.
-                    control_model_input = latents
-                    control_model_input = self.scheduler.scale_model_input(
-                        control_model_input, ts
-                    )
-                    controlnet_prompt_embeds = prompt_embeds
-                else:
-                    control_model_input = latents
-                    controlnet_prompt_embeds = prompt_embeds
-                if isinstance(controlnet_keep[i], list):
-                    cond_scale = [
-                        c * s
-                        for c, s in zip(
-                            controlnet_conditioning_scale, controlnet_keep[i]
-                        )
-                    ]
-                else:
-                    controlnet_cond_scale = controlnet_conditioning_scale
-                    if isinstance(controlnet_cond_scale, list):
-                        controlnet_cond_scale = controlnet_cond_scale[0]
-                    cond_scale = controlnet_cond_scale * controlnet_keep[i]
 
-                down_block_res_samples, mid_block_res_sample = self.controlnet(
-                    control_model_input,
-                    ts,
-                    encoder_hidden_states=controlnet_prompt_embeds,
-                    controlnet_cond=control_image,
-                    conditioning_scale=cond_scale,
-                    guess_mode=guess_mode,
-                    return_dict=False,
+        return {
+            "bs": bs,
+            "device": device,
+            "prompt_embeds": prompt_embeds,
+            "control_image": control_image,
+            "controlnet_conditioning_scale": controlnet_conditioning_scale,
+            "controlnet_keep": controlnet_keep,
+            "guess_mode": guess_mode,
+            "scheduler": scheduler,
+            "timesteps": timesteps,
+            "row_steps": row_steps,
+            "latents": latents,
+            "w_embedding": w_embedding,
+            "generator": generator,
+            "buffers": buffers,
+            "feature_cache": (
+                DeepFeatureCache(
+                    self.unet, feature_cache_interval, self.feature_cache_depth
                 )
+                if feature_cache_interval is not None
+                else None
+            ),
+            "features": None,
+            "controlnet_cache_interval": controlnet_cache_interval,
+            "residuals": None,
+            "tiling": tiling,
+            "token_merging_ratio": (
+                self.token_merging.ratio_for(width, height) if token_merging else 0.0
+            ),
+        }
+
+    def get_cond_scale(self, controlnet_conditioning_scale, keep):
+        """The ControlNet conditioning scale(s) for one step, zero for nets outside their guidance window"""
+        if isinstance(keep, list):
+            return [c * s for c, s in zip(controlnet_conditioning_scale, keep)]
+
+        controlnet_cond_scale = controlnet_conditioning_scale
+        if isinstance(controlnet_cond_scale, list):
+            controlnet_cond_scale = controlnet_cond_scale[0]
+        return controlnet_cond_scale * keep
+
+    def select_rows(self, state, rows):
+        """The state of a subset of the rows of a batch, so that only those rows are sampled from then on"""
+        bs = state["bs"]
+
+        def select(value):
+            if isinstance(value, (list, tuple)):
+                return type(value)(select(v) for v in value)
+            if torch.is_tensor(value) and value.ndim > 0 and value.shape[0] == bs:
+                if value.stride(0) == 0:
+                    # rows broadcast from one, keep them that way
+                    return value[:1].expand(len(rows), *value.shape[1:])
+                return value[rows.to(value.device)]
+            return value
+
+        timesteps = state["timesteps"]
+        generator = state["generator"]
+        return dict(
+            state,
+            bs=len(rows),
+            prompt_embeds=select(state["prompt_embeds"]),
+            control_image=select(state["control_image"]),
+            controlnet_conditioning_scale=select(
+                state["controlnet_conditioning_scale"]
+            ),
+            controlnet_keep=[select(keep) for keep in state["controlnet_keep"]],
+            timesteps=timesteps[:, rows] if timesteps.ndim == 2 else timesteps,
+            row_steps=select(state["row_steps"]),
+            w_embedding=select(state["w_embedding"]),
+            features=select(state["features"]),
+            residuals=select(state["residuals"]),
+            generator=(
+                [generator[r] for r in rows.tolist()]
+                if isinstance(generator, list)
+                else generator
+            ),
+        )
+
+    def denoise_step(self, state, i, latents, denoised, cross_attention_kwargs=None):
+        """Runs the ControlNets, the UNet and the scheduler for step `i` of `state`, returns `(latents, denoised)`"""
+        prompt_embeds = state["prompt_embeds"]
+        guess_mode = state["guess_mode"]
+
+        # one timestep for the batch, or one per row with per-row schedules
+        ts = state["timesteps"][i].to(state["device"]).expand(state["bs"])
+        latents = latents.to(prompt_embeds.dtype)
+        if guess_mode:
+            # Infer ControlNet only for the conditional batch.
+            control_model_input = latents
+            control_model_input = self.scheduler.scale_model_input(
+                control_model_input, ts
+            )
+            controlnet_prompt_embeds = prompt_embeds
+        else:
+            control_model_input = latents
+            controlnet_prompt_embeds = prompt_embeds
+        cond_scale = self.get_cond_scale(
+            state["controlnet_conditioning_scale"], state["controlnet_keep"][i]
+        )
+
+        if state["tiling"] is not None:
+            model_pred = self.tiled_prediction(
+                state, latents, ts, cond_scale, cross_attention_kwargs
+            )
+        else:
+            with self.merging_tokens(state, latents):
+                if self.reuses_residuals(state, i):
+                    _, down_block_res_samples, mid_block_res_sample = state["residuals"]
+                else:
+                    (
+                        down_block_res_samples,
+                        mid_block_res_sample,
+                    ) = self.controlnet_residuals(
+                        control_model_input,
+                        ts,
+                        controlnet_prompt_embeds,
+                        state["control_image"],
+                        cond_scale,
+                        guess_mode,
+                    )
+                    if state["controlnet_cache_interval"] is not None:
+                        state["residuals"] = (
+                            i,
+                            down_block_res_samples,
+                            mid_block_res_sample,
+                        )
                 # model prediction (v-prediction, eps, x)
-                model_pred = self.unet(
+                model_pred = self.run_unet(
+                    state,
+                    i,
                     latents,
                     ts,
-                    timestep_cond=w_embedding,
+                    timestep_cond=state["w_embedding"],
                     encoder_hidden_states=prompt_embeds,
                     cross_attention_kwargs=cross_attention_kwargs,
                     down_block_additional_residuals=down_block_res_samples,
                     mid_block_additional_residual=mid_block_res_sample,
-                    return_dict=False,
-                )[0]
+                )
 
-                # compute the previous noisy sample x_t -> x_t-1
-                latents, denoised = self.scheduler.step(
-                    model_pred, i, t, latents, return_dict=False
+        # compute the previous noisy sample x_t -> x_t-1
+        return self.scheduler_step(state, i, model_pred, latents, denoised)
+
+    def tiled_prediction(
+        self, state, latents, timestep, cond_scale, cross_attention_kwargs=None
+    ):
+        """
+        The UNet prediction for a step of a tiled request. The ControlNets and the UNet run on batches of latent tiles,
+        with the control images cropped to the same regions, and the tile predictions are blended, see `Tiling`.
+        """
+        tiling = state["tiling"]
+
+        def crops(value, batch, scale=1):
+            if isinstance(value, list):
+                return [crops(v, batch, scale) for v in value]
+            if value is None:
+                return None
+            return torch.cat([tiling.crop(value, index, scale) for index in batch])
+
+        def repeated(value, batch):
+            if isinstance(value, list):
+                return [repeated(v, batch) for v in value]
+            if torch.is_tensor(value) and value.ndim > 0:
+                return torch.cat([value] * len(batch))
+            return value
+
+        model_pred = torch.zeros_like(latents)
+        for batch in tiling.batches():
+            # the rows of every tile in the batch, one tile after the other
+            sample = crops(latents, batch)
+            ts = repeated(timestep, batch)
+            prompt_embeds = repeated(state["prompt_embeds"], batch)
+            with self.merging_tokens(state, sample):
+                down_samples, mid_sample = self.controlnet_residuals(
+                    sample,
+                    ts,
+                    prompt_embeds,
+                    crops(state["control_image"], batch, self.vae_scale_factor),
+                    repeated(cond_scale, batch),
+                    state["guess_mode"],
+                )
+                (pred,) = self.unet(
+                    sample,
+                    ts,
+                    timestep_cond=repeated(state["w_embedding"], batch),
+                    encoder_hidden_states=prompt_embeds,
+                    cross_attention_kwargs=cross_attention_kwargs,
+                    down_block_additional_residuals=down_samples,
+                    mid_block_additional_residual=mid_sample,
+                    return_dict=False,
                 )
+            for index, tile_pred in zip(batch, pred.split(state["bs"])):
+                tiling.add(model_pred, index, tile_pred)
+        return tiling.normalize(model_pred)
 
-                # # call the callback, if provided
-                # if i == len(timesteps) - 1:
-                progress_bar.update()
+    def reuses_residuals(self, state, i):
+        """
+        Whether step `i` of `state` reuses the ControlNet residuals of an earlier step: less than
+        `controlnet_cache_interval` steps after they were computed, with every net still in or out of its guidance
+        window as it was then
+        """
+        interval, residuals = state["controlnet_cache_interval"], state["residuals"]
+        if interval is None or residuals is None or i - residuals[0] >= interval:
+            return False
+
+        def same(a, b):
+            if isinstance(a, list):
+                return all(same(x, y) for x, y in zip(a, b))
+            return torch.equal(torch.as_tensor(a), torch.as_tensor(b))
 
-        denoised = denoised.to(prompt_embeds.dtype)
-        if hasattr(self, "final_offload_hook") and self.final_offload_hook is not None:
-            self.unet.to("cpu")
-            self.controlnet.to("cpu")
-            torch.cuda.empty_cache()
+        keeps = state["controlnet_keep"]
+        return same(keeps[i], keeps[residuals[0]])
+
+    def run_unet(self, state, i, latents, timestep, **kwargs):
+        """
+        The UNet prediction for step `i` of `state`. With a feature cache, full steps keep the deep features in
+        `state["features"]` and partial steps start from them.
+        """
+        cache = state["feature_cache"]
+        if cache is None:
+            return self.unet(latents, timestep, return_dict=False, **kwargs)[0]
+        if state["features"] is None or cache.is_full_step(i):
+            model_pred, state["features"] = cache.full(latents, timestep, **kwargs)
+            return model_pred
+        return cache.partial(state["features"], latents, timestep, **kwargs)
+
+    def scheduler_step(self, state, i, model_pred, latents, denoised):
+        """
+        Runs step `i` of the request's schedule and returns `(latents, denoised)`. With per-row schedules, rows whose
+        schedule has already ended still go through the batched forward but keep their previous result.
+        """
+        timesteps = state["timesteps"]
+        buffers = state["buffers"]
+        noise, out = None, None
+        if buffers is not None:
+            if len(timesteps) > 1:
+                noise = self.sample_noise(buffers, model_pred.shape, state["generator"])
+            # the other buffers hold the previous step's results, which this step may still read
+            rows = model_pred.shape[0]
+            out = (buffers["latents"][i % 2][:rows], buffers["denoised"][i % 2][:rows])
+        new_latents, new_denoised = state["scheduler"].step(
+            model_pred,
+            i,
+            timesteps[i],
+            latents,
+            generator=state["generator"],
+            variance_noise=noise,
+            out=out,
+            # per-row schedules may be a subset of the scheduler's rows, see select_rows
+            prev_timestep=(
+                timesteps[min(i + 1, len(timesteps) - 1)]
+                if timesteps.ndim == 2
+                else None
+            ),
+            return_dict=False,
+        )
+        row_steps = state["row_steps"]
+        if row_steps is not None and i > 0:
+            done = (row_steps <= i).to(latents.device)[:, None, None, None]
+            if out is None:
+                new_latents = torch.where(done, latents, new_latents)
+                new_denoised = torch.where(done, denoised, new_denoised)
+            else:
+                torch.where(done, latents, new_latents, out=new_latents)
+                torch.where(done, denoised, new_denoised, out=new_denoised)
+        return new_latents, new_denoised
+
+    def steps_used(self, state, steps, early_stopping=None):
+        """The number of steps each row was sampled for when sampling stopped after `steps` steps"""
+        if early_stopping is not None:
+            return early_stopping.steps_used.tolist()
+        if state["row_steps"] is not None:
+            return state["row_steps"].clamp(max=steps).tolist()
+        return [steps] * state["bs"]
+
+    def decode_to_host(self, denoised, non_blocking=False):
+        """
+        Decodes `denoised` latents into uint8 images in a page-locked host buffer, see `quantize_images` and
+        `copy_to_host`. Returns the buffer and, with `non_blocking`, the event to wait on before reading it. Read it
+        with `host_array(buffer, self.arena)`, as it comes from the arena if the pipeline has one.
+        """
+        image = self.vae.decode(
+            denoised / self.vae.config.scaling_factor, return_dict=False
+        )[0]
+        if self.arena is None or image.device.type == "cpu":
+            # on the CPU the quantized images are the host buffer
+            return copy_to_host(quantize_images(image), non_blocking)
+        batch, channels, height, width = image.shape
+        out = self.arena.take(
+            (batch, height, width, channels), torch.uint8, image.device
+        )
+        result = copy_to_host(quantize_images(image, out=out), non_blocking, self.arena)
+        # the copy out of it is queued before anything that takes the buffer next
+        self.arena.give([out])
+        return result
+
+    def decode_latents(self, denoised, output_type, device, safety_checker=True):
+        """
+        Decodes `denoised` latents, runs the safety checker (unless `safety_checker` is `False`) and postprocesses to
+        `output_type`, which besides the `VaeImageProcessor` types can be "uint8" for a uint8 numpy array of
+        `(batch, height, width, channels)`. Returns `(image, has_nsfw_concept)`.
+        """
+        has_nsfw_concept = None
+        if output_type == "uint8":
+            image, _ = self.decode_to_host(denoised)
+            image = host_array(image, self.arena)
+            if safety_checker:
+                image, has_nsfw_concept = self.run_safety_checker(
+                    image, device, denoised.dtype
+                )
+            return image, has_nsfw_concept
         if not output_type == "latent":
             image = self.vae.decode(
                 denoised / self.vae.config.scaling_factor, return_dict=False
             )[0]
-            image, has_nsfw_concept = self.run_safety_checker(
-                image, device, prompt_embeds.dtype
-            )
+            if safety_checker:
+                image, has_nsfw_concept = self.run_safety_checker(
+                    image, device, denoised.dtype
+                )
         else:
-            image = denoised
-            has_nsfw_concept = None
+            # the latents may be in an arena buffer, which goes back to the arena
+            image = denoised.clone() if self.arena is not None else denoised
 
         if has_nsfw_concept is None:
             do_denormalize = [True] * image.shape[0]
@@ -609,12 +1486,152 @@ class LatentConsistencyModelPipeline_controlnet(DiffusionPipeline):
         image = self.image_processor.postprocess(
             image, output_type=output_type, do_denormalize=do_denormalize
         )
+        return image, has_nsfw_concept
+
+    @torch.no_grad()
+    def __call__(
+        self,
+        prompt: Union[str, List[str]] = None,
+        image: PipelineImageInput = None,
+        control_image: PipelineImageInput = None,
+        strength: float = 0.8,
+        height: Optional[int] = 768,
+        width: Optional[int] = 768,
+        guidance_scale: float = 7.5,
+        num_images_per_prompt: Optional[int] = 1,
+        latents: Optional[torch.FloatTensor] = None,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
+        num_inference_steps: int = 4,
+        lcm_origin_steps: int = 50,
+        prompt_embeds: Optional[torch.FloatTensor] = None,
+        output_type: Optional[str] = "pil",
+        return_dict: bool = True,
+        cross_attention_kwargs: Optional[Dict[str, Any]] = None,
+        controlnet_conditioning_scale: Union[float, List[float]] = 0.8,
+        guess_mode: bool = True,
+        control_guidance_start: Union[float, List[float]] = 0.0,
+        control_guidance_end: Union[float, List[float]] = 1.0,
+        deadline: Optional[float] = None,
+        cancellation_token: Optional[Any] = None,
+        convergence_threshold: Optional[float] = None,
+        feature_cache_interval: Optional[int] = None,
+        controlnet_cache_interval: Optional[int] = None,
+        token_merging: bool = False,
+        tile_size: Optional[int] = None,
+        tile_overlap: int = 128,
+        tile_batch_size: int = 4,
+    ):
+        r"""
+        `deadline` is a `time.monotonic()` value: once it has passed, sampling stops after the current step and the
+        latest `denoised` prediction is decoded. `cancellation_token` is anything with an `is_set()` method (e.g. a
+        `threading.Event`); it is checked between steps and raises `GenerationCancelled` once set, before any more
+        device work is queued.
+
+        With `convergence_threshold`, each image stops sampling once its `denoised` prediction changes by less than
+        that fraction between two steps, and is dropped from the batch (see `EarlyStopping`). The output's
+        `steps_used` reports the steps each image ran.
+
+        With `feature_cache_interval`, the deep UNet features are computed every that many steps and reused in between,
+        see `DeepFeatureCache`. With `controlnet_cache_interval`, the ControlNet residuals are computed every that many
+        steps and reused in between. `token_merging` merges similar attention tokens at the sizes set up with
+        `enable_token_merging`. With `tile_size`, larger images are denoised in overlapping tiles, see `Tiling`.
+        """
+        state = self.prepare_generation(
+            prompt=prompt,
+            image=image,
+            control_image=control_image,
+            strength=strength,
+            height=height,
+            width=width,
+            guidance_scale=guidance_scale,
+            num_images_per_prompt=num_images_per_prompt,
+            latents=latents,
+            generator=generator,
+            num_inference_steps=num_inference_steps,
+            lcm_origin_steps=lcm_origin_steps,
+            prompt_embeds=prompt_embeds,
+            controlnet_conditioning_scale=controlnet_conditioning_scale,
+            guess_mode=guess_mode,
+            control_guidance_start=control_guidance_start,
+            control_guidance_end=control_guidance_end,
+            feature_cache_interval=feature_cache_interval,
+            controlnet_cache_interval=controlnet_cache_interval,
+            token_merging=token_merging,
+            tile_size=tile_size,
+            tile_overlap=tile_overlap,
+            tile_batch_size=tile_batch_size,
+        )
+        device = state["device"]
+        prompt_embeds = state["prompt_embeds"]
+        timesteps = state["timesteps"]
+        latents = state["latents"]
+        early_stopping = (
+            EarlyStopping(self, state, convergence_threshold)
+            if convergence_threshold is not None
+            else None
+        )
+
+        # the buffers go back to the arena and the offloaded weights leave the device however the request ends
+        try:
+            # 7. LCM MultiStep Sampling Loop:
+            denoised = None
+            with self.progress_bar(total=len(timesteps)) as progress_bar:
+                for i in range(len(timesteps)):
+                    if cancellation_token is not None and cancellation_token.is_set():
+                        raise GenerationCancelled(f"Cancelled after {i} steps")
+
+                    if early_stopping is None:
+                        latents, denoised = self.denoise_step(
+                            state, i, latents, denoised, cross_attention_kwargs
+                        )
+                    else:
+                        latents, denoised = self.denoise_step(
+                            early_stopping.step_state,
+                            i,
+                            latents,
+                            early_stopping.previous,
+                            cross_attention_kwargs,
+                        )
+                        latents = early_stopping.update(i, latents, denoised)
+                        denoised = early_stopping.denoised
+
+                    # # call the callback, if provided
+                    # if i == len(timesteps) - 1:
+                    progress_bar.update()
+
+                    if early_stopping is not None and early_stopping.finished:
+                        break
+
+                    if (
+                        deadline is not None
+                        and time.monotonic() >= deadline
+                        and i + 1 < len(timesteps)
+                    ):
+                        logger.warning(
+                            f"Deadline reached after {i + 1} of {len(timesteps)} steps, returning the current prediction"
+                        )
+                        break
+
+            if cancellation_token is not None and cancellation_token.is_set():
+                raise GenerationCancelled("Cancelled before decoding")
+
+            denoised = denoised.to(prompt_embeds.dtype)
+            with self.vae_tiling(state["tiling"] is not None):
+                image, has_nsfw_concept = self.decode_latents(
+                    denoised, output_type, device
+                )
+        finally:
+            self.release_buffers(state)
+            if self.final_offload_hook is not None:
+                self.final_offload_hook.offload()
 
         if not return_dict:
             return (image, has_nsfw_concept)
 
-        return StableDiffusionPipelineOutput(
-            images=image, nsfw_content_detected=has_nsfw_concept
+        return LatentConsistencyPipelineOutput(
+            images=image,
+            nsfw_content_detected=has_nsfw_concept,
+            steps_used=self.steps_used(state, i + 1, early_stopping),
         )
 
 
@@ -827,6 +1844,7 @@ class LCMScheduler_X(SchedulerMixin, ConfigMixin):
 
         # setable values
         self.num_inference_steps = None
+        self.row_num_inference_steps = None
         self.timesteps = torch.from_numpy(
             np.arange(0, num_train_timesteps)[::-1].copy().astype(np.int64)
         )
@@ -902,20 +1920,8 @@ class LCMScheduler_X(SchedulerMixin, ConfigMixin):
 
         return sample
 
-    def set_timesteps(
-        self,
-        stength,
-        num_inference_steps: int,
-        lcm_origin_steps: int,
-        device: Union[str, torch.device] = None,
-    ):
-        """
-        Sets the discrete timesteps used for the diffusion chain (to be run before inference).
-        Args:
-            num_inference_steps (`int`):
-                The number of diffusion steps used when generating samples with a pre-trained model.
-        """
-
+    def lcm_timesteps(self, stength, num_inference_steps: int, lcm_origin_steps: int):
+        """The LCM inference schedule for one set of settings, as a numpy array"""
         if num_inference_steps > self.config.num_train_timesteps:
             raise ValueError(
                 f"`num_inference_steps`: {num_inference_steps} cannot be larger than `self.config.train_timesteps`:"
@@ -923,8 +1929,6 @@ class LCMScheduler_X(SchedulerMixin, ConfigMixin):
                 f" maximal {self.config.num_train_timesteps} timesteps."
             )
 
-        self.num_inference_steps = num_inference_steps
-
         # LCM Timesteps Setting:  # Linear Spacing
         c = self.config.num_train_timesteps // lcm_origin_steps
         lcm_origin_timesteps = (
@@ -934,8 +1938,52 @@ class LCMScheduler_X(SchedulerMixin, ConfigMixin):
         timesteps = lcm_origin_timesteps[::-skipping_step][
             :num_inference_steps
         ]  # LCM Inference Steps Schedule
+        return timesteps
+
+    def set_timesteps(
+        self,
+        stength,
+        num_inference_steps: int,
+        lcm_origin_steps: int,
+        device: Union[str, torch.device] = None,
+    ):
+        """
+        Sets the discrete timesteps used for the diffusion chain (to be run before inference).
+        Args:
+            num_inference_steps (`int`):
+                The number of diffusion steps used when generating samples with a pre-trained model.
 
-        self.timesteps = torch.from_numpy(timesteps.copy()).to(device)
+        Any of the arguments can also be a list with one value per row of the batch. `timesteps` then has shape
+        `(steps, batch_size)`, each column holding one row's schedule padded with its last timestep, and
+        `row_num_inference_steps` holds the length of each row's schedule.
+        """
+        settings = (stength, num_inference_steps, lcm_origin_steps)
+        if not any(isinstance(arg, (list, tuple)) for arg in settings):
+            self.num_inference_steps = num_inference_steps
+            self.row_num_inference_steps = None
+            timesteps = self.lcm_timesteps(*settings)
+            self.timesteps = torch.from_numpy(timesteps.copy()).to(device)
+            return
+
+        rows = max(len(arg) for arg in settings if isinstance(arg, (list, tuple)))
+        settings = [
+            arg if isinstance(arg, (list, tuple)) else [arg] * rows for arg in settings
+        ]
+        schedules = [self.lcm_timesteps(*row) for row in zip(*settings)]
+        steps = max(len(schedule) for schedule in schedules)
+        # a padded step repeats the row's last timestep, so its "previous" timestep is the timestep itself, as for
+        # the last step of an unpadded schedule
+        timesteps = np.stack(
+            [
+                np.pad(schedule, (0, steps - len(schedule)), "edge")
+                for schedule in schedules
+            ],
+            axis=1,
+        )
+
+        self.num_inference_steps = steps
+        self.row_num_inference_steps = torch.tensor([len(s) for s in schedules])
+        self.timesteps = torch.from_numpy(timesteps).to(device)
 
     def get_scalings_for_boundary_condition_discrete(self, t):
         self.sigma_data = 0.5  # Default: 0.5
@@ -955,6 +2003,8 @@ class LCMScheduler_X(SchedulerMixin, ConfigMixin):
         use_clipped_model_output: bool = False,
         generator=None,
         variance_noise: Optional[torch.FloatTensor] = None,
+        prev_timestep: Optional[torch.Tensor] = None,
+        out: Optional[Tuple[torch.FloatTensor, torch.FloatTensor]] = None,
         return_dict: bool = True,
     ) -> Union[LCMSchedulerOutput, Tuple]:
         """
@@ -963,8 +2013,8 @@ class LCMScheduler_X(SchedulerMixin, ConfigMixin):
         Args:
             model_output (`torch.FloatTensor`):
                 The direct output from learned diffusion model.
-            timestep (`float`):
-                The current discrete timestep in the diffusion chain.
+            timestep (`float` or `torch.Tensor`):
+                The current discrete timestep in the diffusion chain, or one per row with per-row schedules.
             sample (`torch.FloatTensor`):
                 A current instance of a sample created by the diffusion process.
             eta (`float`):
@@ -974,11 +2024,17 @@ class LCMScheduler_X(SchedulerMixin, ConfigMixin):
                 because predicted original sample is clipped to [-1, 1] when `self.config.clip_sample` is `True`. If no
                 clipping has happened, "corrected" `model_output` would coincide with the one provided as input and
                 `use_clipped_model_output` has no effect.
-            generator (`torch.Generator`, *optional*):
-                A random number generator.
+            generator (`torch.Generator` or `List[torch.Generator]`, *optional*):
+                A random number generator, or one per sample in the batch.
             variance_noise (`torch.FloatTensor`):
                 Alternative to generating noise with `generator` by directly providing the noise for the variance
                 itself. Useful for methods such as [`CycleDiffusion`].
+            prev_timestep (`torch.Tensor`, *optional*):
+                The timestep(s) of the next step, instead of looking them up in `timesteps`. Needed when stepping a
+                subset of the rows of a per-row schedule.
+            out (`Tuple[torch.FloatTensor, torch.FloatTensor]`, *optional*):
+                Preallocated tensors to write the previous sample and the denoised prediction into, in place of new
+                ones. Neither may be `sample` itself.
             return_dict (`bool`, *optional*, defaults to `True`):
                 Whether or not to return a [`~schedulers.scheduling_lcm.LCMSchedulerOutput`] or `tuple`.
         Returns:
@@ -992,18 +2048,21 @@ class LCMScheduler_X(SchedulerMixin, ConfigMixin):
             )
 
         # 1. get previous step value
-        prev_timeindex = timeindex + 1
-        if prev_timeindex < len(self.timesteps):
-            prev_timestep = self.timesteps[prev_timeindex]
-        else:
-            prev_timestep = timestep
+        if prev_timestep is None:
+            prev_timeindex = timeindex + 1
+            if prev_timeindex < len(self.timesteps):
+                prev_timestep = self.timesteps[prev_timeindex]
+            else:
+                prev_timestep = timestep
 
         # 2. compute alphas, betas
+        timestep = torch.as_tensor(timestep)
+        prev_timestep = torch.as_tensor(prev_timestep)
         alpha_prod_t = self.alphas_cumprod[timestep]
-        alpha_prod_t_prev = (
-            self.alphas_cumprod[prev_timestep]
-            if prev_timestep >= 0
-            else self.final_alpha_cumprod
+        alpha_prod_t_prev = torch.where(
+            prev_timestep >= 0,
+            self.alphas_cumprod[prev_timestep.clamp(min=0)],
+            self.final_alpha_cumprod,
         )
 
         beta_prod_t = 1 - alpha_prod_t
@@ -1012,9 +2071,72 @@ class LCMScheduler_X(SchedulerMixin, ConfigMixin):
         # 3. Get scalings for boundary conditions
         c_skip, c_out = self.get_scalings_for_boundary_condition_discrete(timestep)
 
+        coefficients = (
+            alpha_prod_t,
+            alpha_prod_t_prev,
+            beta_prod_t,
+            beta_prod_t_prev,
+            c_skip,
+            c_out,
+        )
+        if timestep.ndim == 1:
+            # per-row timesteps: one coefficient per row of the batch
+            coefficients = (
+                coefficient.to(sample.device)[:, None, None, None]
+                for coefficient in coefficients
+            )
+        if out is not None:
+            # in the dtype of `out`, so that the in-place ops below need no float32 temporaries
+            coefficients = (
+                coefficient.to(sample.device, out[0].dtype)
+                for coefficient in coefficients
+            )
+        (
+            alpha_prod_t,
+            alpha_prod_t_prev,
+            beta_prod_t,
+            beta_prod_t_prev,
+            c_skip,
+            c_out,
+        ) = coefficients
+
         # 4. Different Parameterization:
         parameterization = self.config.prediction_type
 
+        if out is not None:
+            # the same steps written into the preallocated tensors, so that only the coefficients are allocated
+            prev_sample, denoised = out
+            if parameterization == "epsilon":
+                torch.mul(model_output, beta_prod_t.sqrt(), out=denoised).neg_().add_(
+                    sample
+                ).div_(alpha_prod_t.sqrt())
+            elif parameterization == "sample":
+                denoised.copy_(model_output)
+            elif parameterization == "v_prediction":
+                torch.mul(sample, alpha_prod_t.sqrt(), out=denoised).addcmul_(
+                    model_output, -beta_prod_t.sqrt()
+                )
+            denoised.mul_(c_out).addcmul_(sample, c_skip)
+
+            if len(self.timesteps) > 1:
+                noise = variance_noise
+                if noise is None:
+                    noise = randn_tensor(
+                        model_output.shape,
+                        generator=generator,
+                        device=model_output.device,
+                        dtype=model_output.dtype,
+                    )
+                torch.mul(noise, beta_prod_t_prev.sqrt(), out=prev_sample).addcmul_(
+                    denoised, alpha_prod_t_prev.sqrt()
+                )
+            else:
+                prev_sample.copy_(denoised)
+
+            if not return_dict:
+                return (prev_sample, denoised)
+            return LCMSchedulerOutput(prev_sample=prev_sample, denoised=denoised)
+
         if parameterization == "epsilon":  # noise-prediction
             pred_x0 = (sample - beta_prod_t.sqrt() * model_output) / alpha_prod_t.sqrt()
 
@@ -1030,13 +2152,24 @@ class LCMScheduler_X(SchedulerMixin, ConfigMixin):
         # 5. Sample z ~ N(0, I), For MultiStep Inference
         # Noise is not used for one-step sampling.
         if len(self.timesteps) > 1:
-            noise = torch.randn(model_output.shape).to(model_output.device)
+            noise = variance_noise
+            if noise is None:
+                noise = randn_tensor(
+                    model_output.shape,
+                    generator=generator,
+                    device=model_output.device,
+                    dtype=model_output.dtype,
+                )
             prev_sample = (
                 alpha_prod_t_prev.sqrt() * denoised + beta_prod_t_prev.sqrt() * noise
             )
         else:
             prev_sample = denoised
 
+        # per-row coefficients are float32 tensors, keep the sample dtype as with scalar coefficients
+        prev_sample = prev_sample.to(model_output.dtype)
+        denoised = denoised.to(model_output.dtype)
+
         if not return_dict:
             return (prev_sample, denoised)
 
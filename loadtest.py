@@ -0,0 +1,75 @@
+"""
+Load test for the predictor: sends the same request at increasing concurrency and reports throughput and latency.
+
+    python loadtest.py --concurrency 1 2 4 8 --requests 16
+"""
+
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from predict import Predictor
+
+
+def run_level(predictor, inputs, concurrency, num_requests):
+    latencies = []
+
+    def one_request(i):
+        start = time.perf_counter()
+        predictor.predict(**{**inputs, "seed": i})
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one_request, range(num_requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "requests/s": num_requests / elapsed,
+        "p50 latency": statistics.median(latencies),
+        "p95 latency": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--requests", type=int, default=16)
+    parser.add_argument("--num-images", type=int, default=1)
+    parser.add_argument("--steps", type=int, default=4)
+    parser.add_argument("--control-image", default=None)
+    parser.add_argument("--image", default=None)
+    args = parser.parse_args()
+
+    predictor = Predictor()
+    predictor.setup()
+
+    inputs = predictor.default_inputs()
+    inputs.update(
+        num_images=args.num_images,
+        num_inference_steps=args.steps,
+        control_image=args.control_image,
+        image=args.image,
+    )
+
+    # one request to settle allocations before measuring
+    predictor.predict(**inputs)
+
+    print(f"{'concurrency':>12} {'requests/s':>12} {'p50 (s)':>10} {'p95 (s)':>10}")
+    for concurrency in args.concurrency:
+        stats = run_level(predictor, inputs, concurrency, args.requests)
+        print(
+            f"{stats['concurrency']:>12} {stats['requests/s']:>12.2f}"
+            f" {stats['p50 latency']:>10.2f} {stats['p95 latency']:>10.2f}"
+        )
+
+    print("metrics:")
+    for name, value in sorted(predictor.metrics.snapshot().items()):
+        print(f"  {name}: {value}")
+
+
+if __name__ == "__main__":
+    main()
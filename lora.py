@@ -0,0 +1,192 @@
+import collections
+import time
+
+import torch
+
+
+def lora_layers(state_dict, network_alphas=None):
+    """
+    The UNet layers of a LoRA as returned by diffusers' `LoraLoaderMixin.lora_state_dict`, as
+    `{parameter name: (down, up, alpha)}`. Text encoder layers are left out.
+    """
+    network_alphas = network_alphas or {}
+    if all(k.startswith(("unet.", "text_encoder.")) for k in state_dict):
+        state_dict = {
+            k[len("unet.") :]: v for k, v in state_dict.items() if k.startswith("unet.")
+        }
+        network_alphas = {
+            k[len("unet.") :]: v
+            for k, v in network_alphas.items()
+            if k.startswith("unet.")
+        }
+
+    def lora_compatible(key):
+        # PEFT keys, e.g. `to_q.lora_A.weight`
+        key = key.replace(".lora_A.", ".lora.down.").replace(".lora_B.", ".lora.up.")
+        # attention processor keys of older and kohya LoRAs, e.g. `attn1.processor.to_out_lora.up.weight`
+        if "processor" not in key.split("."):
+            return key
+        return (
+            key.replace(".processor", "")
+            .replace("to_out_lora", "to_out.0.lora")
+            .replace("_lora", ".lora")
+        )
+
+    factors = collections.defaultdict(dict)
+    for key, value in state_dict.items():
+        module, _, kind = lora_compatible(key).rpartition(".lora.")
+        factors[module][kind.split(".")[0]] = value
+    # alphas are named after the module, or after its down weight for attention layers
+    alphas = {
+        lora_compatible(key[: -len(".alpha")]).partition(".lora.")[0]: alpha
+        for key, alpha in network_alphas.items()
+    }
+
+    return {
+        f"{module}.weight": (
+            weights["down"],
+            weights["up"],
+            alphas.get(module),
+        )
+        for module, weights in factors.items()
+    }
+
+
+def lora_delta(down, up, alpha, shape):
+    """The weight update `up @ down` of a linear or convolution layer, scaled by `alpha / rank` if it has an alpha"""
+    delta = up.flatten(1).float() @ down.flatten(1).float()
+    if alpha is not None:
+        delta *= alpha / down.shape[0]
+    return delta.reshape(shape)
+
+
+class LoraCache:
+    """
+    Serves LoRA adapters by fusing them into the UNet weights in place, so a request with an adapter runs exactly
+    as fast as one without.
+
+    The fused weights of the layers an adapter touches are computed once per checkpoint, adapter and scale and kept
+    on the device in an LRU cache of `budget` bytes, so switching to a recently used adapter only copies them over
+    the layers. The checkpoint's own weights of those layers are kept in host memory, to copy back when a UNet
+    switches to another adapter or none. Weights are copied rather than deltas added and subtracted, so half
+    precision weights do not drift as adapters come and go.
+
+    `load(adapter)` reads an adapter as `lora_layers` does. Swap times and cache hits go to `metrics` under
+    `lora.`. Activate from one thread, while nothing runs on the UNet.
+    """
+
+    def __init__(self, load, budget, metrics=None):
+        self.load = load
+        self.budget = budget
+        self.metrics = metrics
+        # (checkpoint, adapter, scale) -> {parameter name: fused weight}, least recently used first
+        self.fused = collections.OrderedDict()
+        self.fused_bytes = 0
+        # (checkpoint, parameter name) -> the checkpoint's weight, in host memory
+        self.originals = {}
+        # unet -> (checkpoint, adapter, scale) fused into it, and the parameters that adapter touches
+        self.active = {}
+        self.touched = {}
+        self.hits = collections.Counter()
+
+    def is_active(self, unet, checkpoint, adapter=None, scale=1.0):
+        """Whether `unet` already has `adapter` at `scale` fused in, or no adapter if it is None"""
+        return self.active.get(unet) == self._key(checkpoint, adapter, scale)
+
+    @torch.no_grad()
+    def activate(self, unet, checkpoint, adapter=None, scale=1.0):
+        """Fuse `adapter` at `scale` into `unet`, which holds `checkpoint`, or no adapter if it is None"""
+        key = self._key(checkpoint, adapter, scale)
+        current = self.active.get(unet)
+        if current == key:
+            self._increment("activations.active")
+            return
+
+        start = time.perf_counter()
+        fused = self._fused(unet, key) if key is not None else {}
+        params = dict(unet.named_parameters())
+        # layers of the current adapter that the new one does not touch get the checkpoint's weights back
+        for name in self.touched.get(unet, set()) - fused.keys():
+            params[name].copy_(self.originals[(current[0], name)], non_blocking=True)
+        for name, weight in fused.items():
+            params[name].copy_(weight)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+        if key is None:
+            self.active.pop(unet, None)
+        else:
+            self.active[unet] = key
+        self.touched[unet] = set(fused)
+        self._observe("swap_seconds", time.perf_counter() - start)
+
+    def reset(self):
+        """Take the adapters out of every UNet, e.g. before its checkpoint is swapped"""
+        for unet, (checkpoint, _, _) in list(self.active.items()):
+            self.activate(unet, checkpoint)
+
+    @staticmethod
+    def _key(checkpoint, adapter, scale):
+        return (checkpoint, adapter, scale) if adapter is not None else None
+
+    def _fused(self, unet, key):
+        cached = key in self.fused
+        self.hits[cached] += 1
+        self._set("hit_rate", self.hits[True] / sum(self.hits.values()))
+        if cached:
+            self.fused.move_to_end(key)
+            self._increment("activations.cached")
+            return self.fused[key]
+
+        self._increment("activations.fused")
+        start = time.perf_counter()
+        checkpoint, adapter, scale = key
+        params = dict(unet.named_parameters())
+        fused = {}
+        for name, (down, up, alpha) in self.load(adapter).items():
+            if name not in params:
+                raise ValueError(
+                    f"LoRA {adapter} has weights for {name}, which the UNet does not have"
+                )
+            param = params[name]
+            original = self.originals.get((checkpoint, name))
+            if original is None:
+                # no UNet holding this checkpoint has an adapter in this layer, so the weight is the checkpoint's
+                original = torch.empty(
+                    param.shape,
+                    dtype=param.dtype,
+                    pin_memory=torch.cuda.is_available(),
+                ).copy_(param)
+                self.originals[(checkpoint, name)] = original
+            delta = lora_delta(
+                down.to(param.device), up.to(param.device), alpha, param.shape
+            )
+            fused[name] = (original.to(param.device, torch.float32) + scale * delta).to(
+                param.dtype
+            )
+        self._observe("fuse_seconds", time.perf_counter() - start)
+
+        size = sum(w.numel() * w.element_size() for w in fused.values())
+        if size <= self.budget:
+            self.fused[key] = fused
+            self.fused_bytes += size
+            while self.fused_bytes > self.budget:
+                _, evicted = self.fused.popitem(last=False)
+                self.fused_bytes -= sum(
+                    w.numel() * w.element_size() for w in evicted.values()
+                )
+                self._increment("evictions")
+            self._set("fused_bytes", self.fused_bytes)
+        return fused
+
+    def _observe(self, name, value):
+        if self.metrics is not None:
+            self.metrics.observe(f"lora.{name}", value)
+
+    def _increment(self, name):
+        if self.metrics is not None:
+            self.metrics.increment(f"lora.{name}")
+
+    def _set(self, name, value):
+        if self.metrics is not None:
+            self.metrics.set(f"lora.{name}", value)
@@ -0,0 +1,43 @@
+import threading
+
+
+class Metrics:
+    """
+    Thread-safe in-process metrics. Gauges keep the last value set, counters a running total and summaries the
+    count, sum, min, max and last value of what was observed. `snapshot()` returns them all as a plain dict.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def set(self, name, value):
+        with self._lock:
+            self._values[name] = value
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self._lock:
+            summary = self._values.get(name)
+            if summary is None:
+                summary = self._values[name] = {
+                    "count": 0,
+                    "sum": 0.0,
+                    "min": value,
+                    "max": value,
+                }
+            summary["count"] += 1
+            summary["sum"] += value
+            summary["min"] = min(summary["min"], value)
+            summary["max"] = max(summary["max"], value)
+            summary["last"] = value
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                name: dict(value) if isinstance(value, dict) else value
+                for name, value in self._values.items()
+            }
@@ -0,0 +1,158 @@
+import collections
+import time
+
+import torch
+
+
+def copy_weights(module, state_dict):
+    """
+    Copies `state_dict` into the parameters and buffers of `module` in place, so that hooks on the module and views
+    of its weights (e.g. the stacked weights of batched ControlNets) stay valid
+    """
+    target = module.state_dict()
+    if target.keys() != state_dict.keys() or any(
+        tensor.shape != state_dict[name].shape for name, tensor in target.items()
+    ):
+        raise ValueError(
+            f"Weights do not match the architecture of the {type(module).__name__} they are swapped into"
+        )
+    for name, tensor in target.items():
+        tensor.copy_(state_dict[name], non_blocking=True)
+
+
+def to_host(state_dict):
+    """A copy of `state_dict` in page-locked host memory, which copies to the device asynchronously"""
+    pin = torch.cuda.is_available()
+    return {
+        name: torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=pin).copy_(
+            tensor
+        )
+        for name, tensor in state_dict.items()
+    }
+
+
+def nbytes(weights):
+    return sum(
+        tensor.numel() * tensor.element_size()
+        for state_dict in weights.values()
+        for tensor in state_dict.values()
+    )
+
+
+class ModelCache:
+    """
+    Tiered cache of model weights, so one set of pipelines can serve several checkpoints and ControlNets of the same
+    architecture without reloading.
+
+    A slot is a group of live modules that always hold the weights of one variant, e.g. the UNets, VAEs and text
+    encoders of every pipeline for a checkpoint. The active variant of each slot is on the device; activating another
+    copies its weights into the slot's modules in place. Variants are kept warm in page-locked host memory, least
+    recently used first out once they take more than `host_budget` bytes, and loaded from disk with the slot's `load`
+    function when they are cold. The host tier includes the active variants, so switching away from one costs
+    nothing if it is still warm.
+
+    Load and offload times, and how often activations were served from each tier, go to `metrics` under
+    `model_cache.`. Slots are not locked: activate them from one thread, while nothing runs on their modules.
+    """
+
+    TIERS = ["device", "host", "disk"]
+
+    def __init__(self, host_budget, metrics=None):
+        self.host_budget = host_budget
+        self.metrics = metrics
+        # slot -> ({component: [modules]}, load)
+        self.slots = {}
+        self.active = {}
+        # (slot, variant) -> {component: state dict}, least recently used first
+        self.host = collections.OrderedDict()
+        self.host_bytes = 0
+        self.counts = collections.Counter()
+
+    def add_slot(self, slot, components, load, variant):
+        """
+        Manage the modules of `components` (`{component: [modules]}`) as `slot`, currently holding `variant`.
+        `load(variant)` reads the weights of a variant from disk as `{component: state dict}`.
+        """
+        self.slots[slot] = (components, load)
+        self.active[slot] = variant
+
+    def activate(self, slot, variant):
+        """Give the modules of `slot` the weights of `variant`. Returns the tier they came from"""
+        components, load = self.slots[slot]
+        tier = "device"
+        if self.active[slot] != variant:
+            self._offload(slot)
+            start = time.perf_counter()
+            weights = self.host.get((slot, variant))
+            if weights is not None:
+                tier = "host"
+                self.host.move_to_end((slot, variant))
+            else:
+                tier = "disk"
+                weights = self._keep((slot, variant), load(variant))
+            for component, modules in components.items():
+                for module in modules:
+                    copy_weights(module, weights[component])
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            self.active[slot] = variant
+            elapsed = time.perf_counter() - start
+            print(f"Loaded {slot} {variant} from {tier} in {elapsed:.2f}s")
+            self._observe(f"load_seconds.{tier}", elapsed)
+
+        self.counts[tier] += 1
+        self._increment(f"activations.{tier}")
+        total = sum(self.counts.values())
+        for t in self.TIERS:
+            self._set(f"hit_rate.{t}", self.counts[t] / total)
+        return tier
+
+    def _offload(self, slot):
+        """Keep the active variant of `slot` warm on the host before its modules are overwritten"""
+        key = (slot, self.active[slot])
+        if key in self.host:
+            return
+        start = time.perf_counter()
+        components, _ = self.slots[slot]
+        self._keep(
+            key,
+            {
+                component: modules[0].state_dict()
+                for component, modules in components.items()
+            },
+        )
+        self._observe("offload_seconds", time.perf_counter() - start)
+
+    def _keep(self, key, weights):
+        """
+        Add `weights` to the host tier, evicting the least recently used variants to stay within the budget.
+        Returns them, in page-locked memory if they were kept.
+        """
+        size = nbytes(weights)
+        if size > self.host_budget:
+            return weights
+
+        weights = {
+            component: to_host(state_dict) for component, state_dict in weights.items()
+        }
+        self.host[key] = weights
+        self.host_bytes += size
+        while self.host_bytes > self.host_budget:
+            (slot, variant), evicted = self.host.popitem(last=False)
+            self.host_bytes -= nbytes(evicted)
+            print(f"Evicted {slot} {variant} from host memory")
+            self._increment("host_evictions")
+        self._set("host_bytes", self.host_bytes)
+        return weights
+
+    def _observe(self, name, value):
+        if self.metrics is not None:
+            self.metrics.observe(f"model_cache.{name}", value)
+
+    def _increment(self, name):
+        if self.metrics is not None:
+            self.metrics.increment(f"model_cache.{name}")
+
+    def _set(self, name, value):
+        if self.metrics is not None:
+            self.metrics.set(f"model_cache.{name}", value)
@@ -0,0 +1,406 @@
+import collections
+import itertools
+import threading
+import time
+
+import torch
+
+COMPONENTS = ["text_encoder", "unet", "controlnet", "vae", "safety_checker"]
+PLACEMENTS = ["resident", "offload", "stream"]
+# components that run together, so offloaded ones of a stage are on the device at the same time
+STAGES = {
+    "text_encoder": "encode_prompt",
+    "unet": "denoise",
+    "controlnet": "denoise",
+    "vae": "vae",
+    "safety_checker": "safety_check",
+}
+
+
+def own_tensors(module):
+    """The parameters and buffers of `module` itself, not those of its children"""
+    return list(module.parameters(recurse=False)) + list(module.buffers(recurse=False))
+
+
+def component_tensors(module):
+    """The parameters and buffers of `module`, including the stacked weights of batched ControlNets"""
+    tensors = list(module.parameters()) + list(module.buffers())
+    if hasattr(module, "_batched_stack"):
+        params, buffers, _ = module._batched_stack
+        tensors += list(params.values()) + list(buffers.values())
+    return [tensor for tensor in tensors if tensor.device.type != "meta"]
+
+
+def layers(module):
+    """The submodules of `module` holding tensors of their own, which a streamed component loads one at a time"""
+    return [submodule for submodule in module.modules() if own_tensors(submodule)]
+
+
+def by_storage(tensors):
+    """`[(storage, tensors viewing it)]`"""
+    groups = {}
+    for tensor in {id(tensor): tensor for tensor in tensors}.values():
+        storage = tensor.untyped_storage()
+        key = (storage.device, storage.data_ptr())
+        groups.setdefault(key, (storage, []))[1].append(tensor)
+    return list(groups.values())
+
+
+def storage_bytes(tensors):
+    return sum(storage.nbytes() for storage, _ in by_storage(tensors))
+
+
+def component_size(module):
+    """`(bytes, bytes of the largest layer)` of the weights of `module`"""
+    return (
+        storage_bytes(component_tensors(module)),
+        max(
+            (storage_bytes(own_tensors(layer)) for layer in layers(module)),
+            default=0,
+        ),
+    )
+
+
+def as_bytes(storage):
+    return torch.empty(0, dtype=torch.uint8, device=storage.device).set_(storage)
+
+
+def rebind(tensors, data):
+    """Point `tensors` at the storage of `data` in place, keeping their offsets, sizes and strides"""
+    storage = data.untyped_storage()
+    with torch.no_grad():
+        for tensor in tensors:
+            tensor.set_(
+                storage, tensor.storage_offset(), tensor.size(), tensor.stride()
+            )
+
+
+def move(tensors, device, pin_memory=False):
+    """
+    Move `tensors` to `device` in place. Unlike `Module.to`, tensors viewing one storage, e.g. batched ControlNets
+    and their stack, keep viewing one storage, and every reference to them stays valid. Returns
+    `[(data, tensors)]`, the new storage of each group of tensors as a uint8 tensor.
+    """
+    groups = []
+    for storage, members in by_storage(tensors):
+        data = torch.empty(
+            storage.nbytes(), dtype=torch.uint8, device=device, pin_memory=pin_memory
+        )
+        data.copy_(as_bytes(storage))
+        rebind(members, data)
+        groups.append((data, members))
+    return groups
+
+
+def measure_bandwidth(device="cuda", nbytes=2**28):
+    """Copy bandwidth from page-locked host memory to `device`, in bytes per second"""
+    host = torch.empty(nbytes, dtype=torch.uint8, pin_memory=True)
+    target = torch.empty(nbytes, dtype=torch.uint8, device=device)
+    target.copy_(host, non_blocking=True)
+    torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    target.copy_(host, non_blocking=True)
+    torch.cuda.synchronize(device)
+    return nbytes / (time.perf_counter() - start)
+
+
+def load_weights(module):
+    """
+    Load the weights of `module` if it is offloaded, for calls that bypass its `forward`, the way diffusers'
+    `apply_forward_hook` does for the `encode` and `decode` of VAEs
+    """
+    hook = getattr(module, "_hf_hook", None)
+    if hook is not None and hasattr(hook, "pre_forward"):
+        hook.pre_forward(module)
+
+
+class OffloadedWeights:
+    """
+    Tensors kept in page-locked host memory, copied to `device` by `load` and dropped from it by `offload`. The
+    host copy is the one that counts: `offload` does not copy the device copy back, so write the weights while
+    they are offloaded.
+    """
+
+    def __init__(self, tensors, device):
+        self.device = torch.device(device)
+        self.groups = move(tensors, "cpu", pin_memory=torch.cuda.is_available())
+        self.nbytes = sum(host.numel() for host, _ in self.groups)
+        self.loaded = False
+
+    def load(self):
+        if self.loaded:
+            return
+        for host, members in self.groups:
+            data = torch.empty(host.shape, dtype=torch.uint8, device=self.device)
+            data.copy_(host, non_blocking=True)
+            rebind(members, data)
+        self.loaded = True
+
+    def offload(self):
+        # the device copies are freed once the work queued on them has run
+        if not self.loaded:
+            return
+        for host, members in self.groups:
+            rebind(members, host)
+        self.loaded = False
+
+
+class ComponentHook:
+    """
+    The `_hf_hook` of a component that is not resident: diffusers pipelines take their execution device from it,
+    and VAEs call `pre_forward` before `encode` and `decode`
+    """
+
+    def __init__(self, placement, component):
+        self.placement = placement
+        self.component = component
+        self.execution_device = placement.device
+
+    def pre_forward(self, module, *args, **kwargs):
+        self.placement.load(self.component)
+        return args, kwargs
+
+    def forward_pre_hook(self, module, args):
+        self.placement.load(self.component)
+
+
+class Placement:
+    """
+    Places the components of a pipeline on the device according to `plan`, `{component: placement}`, see
+    `PlacementPlanner`. "resident" components stay on `device`. "offload"ed ones are kept in page-locked host
+    memory and copied to the device when they are called, which drops the offloaded components of other stages
+    (see `STAGES`), so the UNet and ControlNet make room for the VAE and back. "stream"ed ones are copied one layer
+    at a time, before the layer runs, and dropped after it.
+
+    Weights are moved in place, so the modules, the views of batched ControlNets, the model and LoRA caches and
+    anything else holding them keep working. The pipeline gets the placement as its `final_offload_hook`:
+    `offload()` drops every offloaded component from the device. Swap weights only after it, as the host copies
+    are the ones loaded next. Pipelines that interleave the stages of several requests `keep` the stage they
+    share on the device. Loads and the bytes they copy go to `metrics` under `placement.`.
+    """
+
+    def __init__(self, plan, device="cuda", metrics=None):
+        self.plan = plan
+        self.device = torch.device(device)
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        # component -> OffloadedWeights
+        self.offloaded = {}
+        # stages whose offloaded components are not dropped for other stages, see keep
+        self.kept = set()
+        self.streamed = []
+        self.handles = []
+        # modules with a ComponentHook, and the pipelines placed
+        self.hooked = []
+        self.pipes = []
+
+    def apply(self, pipe):
+        for component, placement in self.plan.items():
+            module = getattr(pipe, component, None)
+            if module is None:
+                continue
+            if placement == "resident":
+                move(component_tensors(module), self.device)
+                continue
+            if placement == "stream" and hasattr(module, "_batched_stack"):
+                raise ValueError(
+                    "Batched ControlNets run in one vmapped call and cannot be streamed"
+                )
+
+            hook = ComponentHook(self, component)
+            module._hf_hook = hook
+            self.hooked.append(module)
+            if placement == "offload":
+                self.offloaded[component] = OffloadedWeights(
+                    component_tensors(module), self.device
+                )
+                self.handles.append(
+                    module.register_forward_pre_hook(hook.forward_pre_hook)
+                )
+                continue
+            for layer in layers(module):
+                weights = OffloadedWeights(own_tensors(layer), self.device)
+                self.streamed.append(weights)
+                self.handles.append(
+                    layer.register_forward_pre_hook(
+                        lambda module, args, weights=weights: self._stream(weights)
+                    )
+                )
+                self.handles.append(
+                    layer.register_forward_hook(
+                        lambda module, args, output, weights=weights: weights.offload()
+                    )
+                )
+        pipe.final_offload_hook = self
+        self.pipes.append(pipe)
+        return self
+
+    def load(self, component):
+        """Copy `component` to the device if it is offloaded, dropping the offloaded components of other stages"""
+        weights = self.offloaded.get(component)
+        if weights is None:
+            return
+        with self.lock:
+            if weights.loaded:
+                return
+            for other, other_weights in self.offloaded.items():
+                if STAGES[other] not in (STAGES[component], *self.kept):
+                    other_weights.offload()
+            weights.load()
+        self._count(weights)
+
+    def keep(self, stage, kept=True):
+        """
+        Keep the offloaded components of `stage` on the device while the components of other stages are loaded, or
+        stop keeping them. The continuous batching engine keeps the denoising stage while requests are in flight,
+        as it encodes the prompts of new requests and decodes finished ones between the steps of the others.
+        """
+        with self.lock:
+            if kept:
+                self.kept.add(stage)
+            else:
+                self.kept.discard(stage)
+
+    def offload(self):
+        """Drop every offloaded component from the device, and any streamed layer left by a call that failed"""
+        with self.lock:
+            for weights in [*self.offloaded.values(), *self.streamed]:
+                weights.offload()
+            if self.device.type == "cuda":
+                # copies still queued out of the host copies run before they are written
+                torch.cuda.synchronize(self.device)
+
+    def remove(self):
+        """Load every component to the device for good and take the hooks out"""
+        for weights in [*self.offloaded.values(), *self.streamed]:
+            weights.load()
+        for handle in self.handles:
+            handle.remove()
+        for module in self.hooked:
+            del module._hf_hook
+        for pipe in self.pipes:
+            pipe.final_offload_hook = None
+        self.offloaded, self.streamed = {}, []
+        self.handles, self.hooked, self.pipes = [], [], []
+
+    def _stream(self, weights):
+        weights.load()
+        self._count(weights)
+
+    def _count(self, weights):
+        if self.metrics is not None:
+            self.metrics.increment("placement.loads")
+            self.metrics.increment("placement.loaded_bytes", weights.nbytes)
+
+
+class PlacementPlanner:
+    """
+    Plans where the weights of the components of a pipeline live for a device memory budget, and predicts what each
+    plan costs: the device memory of the weights, and the seconds the copies add to a request run alone.
+
+    `sizes` maps each component to `(bytes, bytes of its largest layer)`, see `component_size`. A resident
+    component takes its bytes for each of the `copies` pipelines holding it. An offloaded one takes them only while
+    its stage runs and is copied once per request; a streamed one takes its largest layer and is copied on each of
+    its `calls` per request, e.g. once per step for the UNet. Copies run at `bandwidth` bytes per second and do not
+    overlap compute. `concurrency` pipelines run stages at once, e.g. the continuous batching engine's alongside
+    one of the others, and one of them keeps the offloaded components of the `kept` stages on the device while its
+    other stages run, see `Placement.keep`. `options` limits the placements of a component.
+    """
+
+    def __init__(
+        self,
+        sizes,
+        bandwidth,
+        calls=None,
+        copies=None,
+        concurrency=1,
+        kept=(),
+        options=None,
+    ):
+        self.sizes = sizes
+        self.bandwidth = bandwidth
+        self.calls = calls or {}
+        self.copies = copies or {}
+        self.concurrency = concurrency
+        self.kept = kept
+        self.options = options or {}
+
+    def cost(self, plan):
+        """`(device bytes, seconds per request)` of `plan`"""
+        resident = 0
+        # device bytes each stage needs while it runs, and those of its offloaded components
+        stages = collections.Counter()
+        offloaded = collections.Counter()
+        latency = 0.0
+        for component, placement in plan.items():
+            size, layer = self.sizes[component]
+            if placement == "resident":
+                resident += size * self.copies.get(component, 1)
+            elif placement == "offload":
+                stages[STAGES[component]] += size
+                offloaded[STAGES[component]] += size
+                latency += size / self.bandwidth
+            else:
+                stages[STAGES[component]] += layer
+                latency += size * self.calls.get(component, 1) / self.bandwidth
+        # the pipeline keeping stages holds them alongside each of its other stages
+        keeping = max(
+            (
+                stages[stage]
+                + sum(offloaded[kept] for kept in self.kept if kept != stage)
+                for stage in stages
+            ),
+            default=0,
+        )
+        transient = (self.concurrency - 1) * max(stages.values(), default=0)
+        return resident + transient + keeping, latency
+
+    def plans(self):
+        """Every plan as `(plan, device bytes, seconds per request)`, densest first"""
+        components = list(self.sizes)
+        plans = []
+        for placements in itertools.product(
+            *[self.options.get(component, PLACEMENTS) for component in components]
+        ):
+            plan = dict(zip(components, placements))
+            plans.append((plan, *self.cost(plan)))
+        return sorted(plans, key=lambda plan: (plan[1], plan[2]))
+
+    def frontier(self):
+        """The plans that no other plan beats on both memory and latency, densest first"""
+        frontier = []
+        for plan in self.plans():
+            if not frontier or plan[2] < frontier[-1][2]:
+                frontier.append(plan)
+        return frontier
+
+    def choose(self, budget, latency_target=None):
+        """
+        The densest plan within `budget` bytes that adds at most `latency_target` seconds per request, or the
+        fastest one within the budget if there is no target or no plan meets it
+        """
+        frontier = self.frontier()
+        fitting = [plan for plan in frontier if plan[1] <= budget]
+        if not fitting:
+            raise ValueError(
+                f"No placement fits the weights into {budget / 2**30:.2f} GiB, the densest takes "
+                f"{frontier[0][1] / 2**30:.2f} GiB"
+            )
+        if latency_target is not None:
+            for plan in fitting:
+                if plan[2] <= latency_target:
+                    return plan
+        return fitting[-1]
+
+    def report(self, plans):
+        """Print `plans`, as returned by `plans` or `frontier`"""
+        components = list(self.sizes)
+        print(
+            f"{'GiB':>6} {'+seconds':>9} "
+            + " ".join(f"{component:>14}" for component in components)
+        )
+        for plan, memory, latency in plans:
+            print(
+                f"{memory / 2**30:>6.2f} {latency:>9.3f} "
+                + " ".join(f"{plan[component]:>14}" for component in components)
+            )
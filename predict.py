@@ -1,14 +1,116 @@
-import cv2 as cv
+import time
+
+IMPORT_STARTED = time.perf_counter()
+
+import asyncio
+import collections
+import inspect
+import math
 import os
+import threading
 import torch
 import datetime
-import tarfile
+import tempfile
 import numpy as np
+from concurrent.futures import Future
 from typing import List, Optional
-from diffusers import ControlNetModel, DiffusionPipeline, AutoPipelineForImage2Image
-from latent_consistency_controlnet import LatentConsistencyModelPipeline_controlnet
 from cog import BasePredictor, Input, Path
 from PIL import Image
+from safetensors.torch import load_file, save_file
+from arena import BufferArena
+from cost_model import CostModel
+from lora import LoraCache, lora_layers
+from metrics import Metrics
+from model_cache import ModelCache
+from placement import COMPONENTS, Placement, PlacementPlanner
+from placement import component_size, measure_bandwidth
+from stages import StagedExecutor
+from startup import StartupTimeline
+from tiling import Tiling
+
+# diffusers, cv2, tarfile and the modules built on diffusers (latent_consistency_controlnet, attention,
+# token_merging, continuous_batching) are imported where they are used, so importing this module, e.g. to read
+# its constants or build the Cog schema, does not pay for them. See bench_startup.py
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
+
+# Checkpoints the `model` input can pick from, the first is loaded at setup. They must be in the model cache and
+# share the SD 1.5 architecture, as they are swapped into the same pipelines
+MODELS = os.environ.get("MODELS", "SimianLuo/LCM_Dreamshaper_v7").split(",")
+# Pipeline components that make up a checkpoint
+CHECKPOINT_COMPONENTS = ["unet", "vae", "text_encoder"]
+# ControlNets served by the controlnet pipes, in the order their control images are passed
+CONTROLNET_MODELS = [
+    "lllyasviel/control_v11p_sd15_canny",
+    "lllyasviel/control_v11f1p_sd15_depth",
+    "lllyasviel/control_v11p_sd15_openpose",
+]
+# ControlNets the `controlnet_model` input can pick for `control_image`, in place of the first of CONTROLNET_MODELS.
+# Only the canny one gets a Canny map of the control image, the others take it as is
+CONTROL_IMAGE_MODELS = os.environ.get(
+    "CONTROL_IMAGE_MODELS",
+    ",".join(
+        [
+            CONTROLNET_MODELS[0],
+            "lllyasviel/control_v11p_sd15_lineart",
+            "lllyasviel/control_v11p_sd15_softedge",
+            "lllyasviel/control_v11p_sd15_scribble",
+        ]
+    ),
+).split(",")
+# Host memory for the weights of checkpoints and ControlNets, kept warm for the next swap
+MODEL_CACHE_HOST_BYTES = int(float(os.environ.get("MODEL_CACHE_HOST_GIB", 16)) * 2**30)
+# LoRA adapters the `lora` input can pick from, which must be in the model cache, and the device memory for their
+# fused weights. It comes out of the memory budget of requests
+LORAS = [lora for lora in os.environ.get("LORAS", "").split(",") if lora]
+LORA_CACHE_BYTES = int(float(os.environ.get("LORA_CACHE_GIB", 1)) * 2**30)
+# Device memory for the free buffers of the ControlNet pipeline's buffer arena, also out of the memory budget
+BUFFER_ARENA_BYTES = int(float(os.environ.get("BUFFER_ARENA_GIB", 0.5)) * 2**30)
+# Device memory for the weights of the pipelines, for hosts that cannot keep every component resident. 0 keeps them
+# all resident; otherwise setup plans which components stay resident, are offloaded between stages or are streamed
+# layer by layer, and takes the densest plan that adds at most PLACEMENT_LATENCY_SECONDS to a request of
+# PLACEMENT_STEPS steps, or the fastest that fits. See PlacementPlanner
+WEIGHT_MEMORY_BYTES = int(float(os.environ.get("WEIGHT_MEMORY_GIB", 0)) * 2**30)
+PLACEMENT_LATENCY_SECONDS = (
+    float(os.environ["PLACEMENT_LATENCY_SECONDS"])
+    if "PLACEMENT_LATENCY_SECONDS" in os.environ
+    else None
+)
+PLACEMENT_STEPS = 8
+
+# Worker threads for each CPU stage and the depth of the queue in front of every stage
+CPU_WORKERS = 2
+QUEUE_SIZE = 4
+# Rows the continuous batching engine admits into a single UNet call
+ENGINE_MAX_BATCH_SIZE = 16
+# Share of device memory requests may use at their peak, the rest is left for allocator fragmentation
+MEMORY_BUDGET_FRACTION = 0.85
+# Attention implementation of the UNets, ControlNets and VAEs: "sdpa", "sliced", "chunked", or "auto" to benchmark
+# them per resolution bucket at setup and use the fastest that fits the memory budget, see AttentionBackends
+ATTENTION_BACKEND = os.environ.get("ATTENTION_BACKEND", "auto")
+# Batch x heads slices per step of "sliced" attention and queries per step of "chunked" attention
+ATTENTION_SLICE_SIZE = int(os.environ.get("ATTENTION_SLICE_SIZE", 4))
+ATTENTION_CHUNK_SIZE = int(os.environ.get("ATTENTION_CHUNK_SIZE", 1024))
+ATTENTION_BUCKETS = [512 * 512, 768 * 768, 1024 * 1024]
+# Share of self-attention tokens merged for requests with token_merging, from each pixel count up. Smaller images
+# are not merged, the matching costs more than the attention it saves there
+TOKEN_MERGING_RATIOS = {896 * 896: 0.3, 1024 * 1024: 0.5}
+# Pixels neighbouring tiles of requests with tile_size share, and tiles denoised per model call
+TILE_OVERLAP = 128
+TILE_BATCH_SIZE = 4
+# Pixel count two_stage requests are first generated at, before their latents are upscaled and refined
+TWO_STAGE_BASE_PIXELS = 512 * 512
+# (mode, width, height, batch, steps, controlnet) runs measured at setup to fit the cost model
+CALIBRATION_RUNS = [
+    ("txt2img", 512, 512, 1, 2, False),
+    ("txt2img", 768, 768, 1, 4, False),
+    ("txt2img", 768, 768, 2, 2, False),
+    ("txt2img", 1024, 1024, 1, 2, False),
+    ("img2img", 768, 768, 1, 2, False),
+    ("img2img", 512, 512, 2, 4, False),
+    ("txt2img", 512, 512, 1, 4, True),
+    ("txt2img", 768, 768, 2, 2, True),
+    ("img2img", 768, 768, 1, 2, True),
+]
 
 
 class Predictor(BasePredictor):
@@ -16,7 +118,7 @@ class Predictor(BasePredictor):
         self,
         pipeline_class,
         safety_checker: bool = True,
-        controlnet: Optional[ControlNetModel] = None,
+        controlnet: Optional["ControlNetModel"] = None,
     ):
         kwargs = {
             "cache_dir": "model_cache",
@@ -30,12 +132,33 @@ class Predictor(BasePredictor):
             kwargs["controlnet"] = controlnet
             kwargs["scheduler"] = None
 
-        pipe = pipeline_class.from_pretrained("SimianLuo/LCM_Dreamshaper_v7", **kwargs)
-        pipe.to(torch_device="cuda", torch_dtype=torch.float16)
+        pipe = pipeline_class.from_pretrained(MODELS[0], **kwargs)
+        # with a weight budget, place_components moves the weights to the device
+        pipe.to(
+            torch_device="cpu" if WEIGHT_MEMORY_BYTES else "cuda",
+            torch_dtype=torch.float16,
+        )
         return pipe
 
     def setup(self) -> None:
         """Load the model into memory to make running multiple predictions efficient"""
+        timeline = StartupTimeline()
+        timeline.add("module_import", IMPORT_SECONDS)
+        from diffusers import (
+            AutoPipelineForImage2Image,
+            ControlNetModel,
+            DiffusionPipeline,
+        )
+        from diffusers.pipelines.controlnet.multicontrolnet import MultiControlNetModel
+        from attention import AttentionBackends
+        from continuous_batching import ContinuousBatchingEngine
+        from latent_consistency_controlnet import (
+            LatentConsistencyModelPipeline_controlnet,
+        )
+        from token_merging import TokenMerging
+
+        timeline.mark("imports")
+        self.metrics = Metrics()
 
         self.txt2img_pipe = self.create_pipeline(DiffusionPipeline)
         self.txt2img_pipe_unsafe = self.create_pipeline(
@@ -47,21 +170,52 @@ class Predictor(BasePredictor):
             AutoPipelineForImage2Image, safety_checker=False
         )
 
-        controlnet_canny = ControlNetModel.from_pretrained(
-            "lllyasviel/control_v11p_sd15_canny",
-            cache_dir="model_cache",
-            local_files_only=True,
-            torch_dtype=torch.float16,
-        ).to("cuda")
+        controlnet = MultiControlNetModel(
+            [
+                ControlNetModel.from_pretrained(
+                    model_id,
+                    cache_dir="model_cache",
+                    local_files_only=True,
+                    torch_dtype=torch.float16,
+                ).to("cpu" if WEIGHT_MEMORY_BYTES else "cuda")
+                for model_id in CONTROLNET_MODELS
+            ]
+        )
 
         self.controlnet_pipe = self.create_pipeline(
-            LatentConsistencyModelPipeline_controlnet, controlnet=controlnet_canny
+            LatentConsistencyModelPipeline_controlnet, controlnet=controlnet
         )
-        self.controlnet_pipe_unsafe = self.create_pipeline(
-            LatentConsistencyModelPipeline_controlnet,
-            safety_checker=False,
-            controlnet=controlnet_canny,
+        # the ControlNets share the SD 1.5 architecture, so requests using all of them run as one call per step
+        self.controlnet_pipe.enable_batched_controlnets()
+        self.controlnet_pipe.enable_token_merging(TOKEN_MERGING_RATIOS)
+        # the diffusers pipes run on the model worker thread, so they get their own merging state
+        self.token_merging = TokenMerging(TOKEN_MERGING_RATIOS)
+        for pipe in [
+            self.txt2img_pipe,
+            self.txt2img_pipe_unsafe,
+            self.img2img_pipe,
+            self.img2img_pipe_unsafe,
+        ]:
+            self.token_merging.apply(pipe.unet)
+
+        self.attention = AttentionBackends(
+            ATTENTION_BUCKETS,
+            backend="sdpa" if ATTENTION_BACKEND == "auto" else ATTENTION_BACKEND,
+            slice_size=ATTENTION_SLICE_SIZE,
+            chunk_size=ATTENTION_CHUNK_SIZE,
         )
+        for pipe in [
+            self.txt2img_pipe,
+            self.txt2img_pipe_unsafe,
+            self.img2img_pipe,
+            self.img2img_pipe_unsafe,
+            self.controlnet_pipe,
+        ]:
+            self.attention.apply(pipe)
+        timeline.mark("weights")
+        if WEIGHT_MEMORY_BYTES:
+            self.place_components()
+            timeline.mark("placement")
 
         # warm the pipes
         self.txt2img_pipe(prompt="warmup")
@@ -71,19 +225,374 @@ class Predictor(BasePredictor):
         self.controlnet_pipe(
             prompt="warmup",
             image=[Image.new("RGB", (768, 768))],
-            control_image=[Image.new("RGB", (768, 768))],
+            control_image=[Image.new("RGB", (768, 768))] * len(CONTROLNET_MODELS),
         )
-        self.controlnet_pipe_unsafe(
-            prompt="warmup",
-            image=[Image.new("RGB", (768, 768))],
-            control_image=[Image.new("RGB", (768, 768))],
+        timeline.mark("warmup")
+
+        # checkpoints are swapped into every pipeline at once, ControlNets into the slot of control_image
+        self.model_cache = ModelCache(MODEL_CACHE_HOST_BYTES, self.metrics)
+        pipes = [
+            self.txt2img_pipe,
+            self.txt2img_pipe_unsafe,
+            self.img2img_pipe,
+            self.img2img_pipe_unsafe,
+            self.controlnet_pipe,
+        ]
+        self.model_cache.add_slot(
+            "checkpoint",
+            {
+                name: [getattr(pipe, name) for pipe in pipes]
+                for name in CHECKPOINT_COMPONENTS
+            },
+            self.load_checkpoint,
+            MODELS[0],
+        )
+        self.model_cache.add_slot(
+            "controlnet",
+            {"controlnet": [self.controlnet_pipe.controlnet.nets[0]]},
+            self.load_controlnet,
+            CONTROLNET_MODELS[0],
+        )
+        self.lora_cache = LoraCache(self.load_lora, LORA_CACHE_BYTES, self.metrics)
+        self.cost_model = CostModel()
+        self.memory_budget = (
+            torch.cuda.get_device_properties(0).total_memory * MEMORY_BUDGET_FRACTION
+            - LORA_CACHE_BYTES
+            - BUFFER_ARENA_BYTES
         )
+        if ATTENTION_BACKEND == "auto":
+            self.select_attention()
+            timeline.mark("attention_selection")
+        self.calibrate()
+        timeline.mark("calibration")
+        # after calibration, whose memory measurements should not include buffers pooled by earlier runs
+        self.controlnet_pipe.enable_buffer_arena(
+            BufferArena(BUFFER_ARENA_BYTES, self.metrics)
+        )
+
+        # ControlNet requests are stepped together by the engine, which skips the safety checker per request
+        # instead of needing a second copy of the pipeline
+        self.engine = ContinuousBatchingEngine(
+            self.controlnet_pipe,
+            max_batch_size=ENGINE_MAX_BATCH_SIZE,
+            memory_budget=self.memory_budget - self.cost_model.base_memory,
+            queue_size=QUEUE_SIZE,
+        )
+
+        # Requests flow through CPU preprocessing, a single model worker and CPU postprocessing, so the
+        # pipelines (and their schedulers) are only ever used from one thread, apart from the ControlNet
+        # pipeline which only the engine thread uses.
+        self.executor = StagedExecutor(
+            [
+                ("preprocess", self.preprocess, CPU_WORKERS),
+                ("generate", self.generate, 1),
+                ("postprocess", self.postprocess, CPU_WORKERS),
+            ],
+            queue_size=QUEUE_SIZE,
+        )
+        timeline.mark("engine")
+        timeline.report(self.metrics)
+
+    def place_components(self, plan=None):
+        """
+        Place the weights of each component according to `plan`, see Placement, by default the plan
+        PlacementPlanner chooses within WEIGHT_MEMORY_BYTES. `remove` the `placements` to make every component
+        resident again.
+        """
+        if plan is None:
+            planner = self.placement_planner()
+            planner.report(planner.frontier())
+            plan, memory, latency = planner.choose(
+                WEIGHT_MEMORY_BYTES, PLACEMENT_LATENCY_SECONDS
+            )
+            print(
+                f"Placing {', '.join(f'{c} {p}' for c, p in plan.items())}: "
+                f"{memory / 2**30:.2f} GiB of weights, {latency:.3f}s per request"
+            )
+            self.metrics.set("placement.weight_bytes", memory)
+            self.metrics.set("placement.latency_seconds", latency)
+        self.placements = [
+            Placement(plan, "cuda", self.metrics).apply(pipe)
+            for pipe in self.placed_pipes()
+        ]
+
+    def placement_planner(self):
+        """
+        The PlacementPlanner of the components of the pipelines. The ControlNet pipeline holds every component, the
+        other pipelines copies of some.
+        """
+        return PlacementPlanner(
+            {
+                component: component_size(getattr(self.controlnet_pipe, component))
+                for component in COMPONENTS
+                if getattr(self.controlnet_pipe, component, None) is not None
+            },
+            measure_bandwidth(),
+            calls={"unet": PLACEMENT_STEPS, "controlnet": PLACEMENT_STEPS},
+            copies=collections.Counter(
+                component
+                for pipe in self.placed_pipes()
+                for component in COMPONENTS
+                if getattr(pipe, component, None) is not None
+            ),
+            # the engine's pipeline runs alongside one of the others, and keeps its UNet and ControlNet on the device
+            # while it has requests in flight
+            concurrency=2,
+            kept=["denoise"],
+            # the batched ControlNets run in one vmapped call, which cannot load them layer by layer
+            options={"controlnet": ["resident", "offload"]},
+        )
+
+    def placed_pipes(self):
+        """The pipelines whose components are placed, each holding weights of its own"""
+        return [
+            self.txt2img_pipe,
+            self.txt2img_pipe_unsafe,
+            self.img2img_pipe,
+            self.img2img_pipe_unsafe,
+            self.controlnet_pipe,
+        ]
+
+    def offload(self, pipes):
+        """Drop the offloaded components of `pipes` from the device, see `Placement`"""
+        for pipe in pipes:
+            if getattr(pipe, "final_offload_hook", None) is not None:
+                pipe.final_offload_hook.offload()
+
+    def load_checkpoint(self, model_id):
+        """The weights of the components of checkpoint `model_id`, read from the model cache on disk"""
+        return {
+            name: type(getattr(self.txt2img_pipe, name))
+            .from_pretrained(
+                model_id,
+                subfolder=name,
+                cache_dir="model_cache",
+                local_files_only=True,
+                torch_dtype=torch.float16,
+            )
+            .state_dict()
+            for name in CHECKPOINT_COMPONENTS
+        }
+
+    def load_controlnet(self, model_id):
+        """The weights of ControlNet `model_id`, read from the model cache on disk"""
+        from diffusers import ControlNetModel
+
+        controlnet = ControlNetModel.from_pretrained(
+            model_id,
+            cache_dir="model_cache",
+            local_files_only=True,
+            torch_dtype=torch.float16,
+        )
+        return {"controlnet": controlnet.state_dict()}
+
+    def load_lora(self, lora_id):
+        """The UNet layers of LoRA `lora_id`, read from the model cache on disk"""
+        from diffusers.loaders import LoraLoaderMixin
+
+        state_dict, network_alphas = LoraLoaderMixin.lora_state_dict(
+            lora_id, cache_dir="model_cache", local_files_only=True
+        )
+        return lora_layers(state_dict, network_alphas)
+
+    def pipes_for(self, request):
+        """The pipelines that run the request, the one for its last stage first"""
+        mode = request["mode"]
+        if mode == "controlnet":
+            return [self.controlnet_pipe]
+        pipes = [
+            getattr(
+                self,
+                (
+                    f"{mode}_pipe"
+                    if not request["disable_safety_checker"]
+                    else f"{mode}_pipe_unsafe"
+                ),
+            )
+        ]
+        if request["base_size"] is not None:
+            pipes.append(self.txt2img_pipe_unsafe)
+        return pipes
+
+    def activate(self, request):
+        """
+        Swap the request's checkpoint, for ControlNet requests its ControlNet, and its LoRA into the pipelines that
+        run it. In-flight requests share the ControlNet pipeline's weights, so a swap that changes them first waits
+        for the engine to finish the ones it is running.
+        """
+        wanted = [("checkpoint", request["model"])]
+        if request["mode"] == "controlnet":
+            wanted.append(("controlnet", request["controlnet_model"]))
+        swaps = [
+            slot for slot, variant in wanted if self.model_cache.active[slot] != variant
+        ]
+        unets = [pipe.unet for pipe in self.pipes_for(request)]
+        wait = swaps or (
+            self.controlnet_pipe.unet in unets
+            and not self.lora_cache.is_active(
+                self.controlnet_pipe.unet,
+                request["model"],
+                request["lora"],
+                request["lora_scale"],
+            )
+        )
+        if wait:
+            self.engine.wait_idle()
+        # Swaps write the host copies of offloaded weights, see Placement. The other pipelines only run on this
+        # thread, so they drop theirs from the device before every request, the engine's once it is idle.
+        self.offload(
+            [
+                self.txt2img_pipe,
+                self.txt2img_pipe_unsafe,
+                self.img2img_pipe,
+                self.img2img_pipe_unsafe,
+            ]
+            + ([self.controlnet_pipe] if wait else [])
+        )
+
+        if "checkpoint" in swaps:
+            # adapters are fused into the checkpoint's weights, which are about to be replaced
+            self.lora_cache.reset()
+        for slot, variant in wanted:
+            self.model_cache.activate(slot, variant)
+        for unet in unets:
+            self.lora_cache.activate(
+                unet, request["model"], request["lora"], request["lora_scale"]
+            )
+
+    def select_attention(self):
+        """Benchmark the attention backends on a ControlNet request with every net, the heaviest workload"""
+
+        def run(width, height):
+            self.controlnet_pipe(
+                prompt="benchmark",
+                width=width,
+                height=height,
+                num_inference_steps=2,
+                control_image=[Image.new("RGB", (width, height))]
+                * len(CONTROLNET_MODELS),
+                generator=[torch.Generator("cpu").manual_seed(0)],
+                output_type="np",
+            )
+
+        results = self.attention.select(run, self.memory_budget)
+        for bucket, measured in results.items():
+            choice = self.attention.table[bucket]
+            side = int(bucket**0.5)
+            print(
+                f"Attention up to {side}x{side}: {choice} ("
+                + ", ".join(
+                    f"{b} {r[0]:.2f}s {r[1] / 2**30:.2f} GiB" if r else f"{b} OOM"
+                    for b, r in measured.items()
+                )
+                + ")"
+            )
+            self.metrics.set(f"attention.backend.{bucket}", choice)
+
+    def calibrate(self):
+        """Fit the cost model on measured runs of the pipelines, see CALIBRATION_RUNS"""
+        for shape in CALIBRATION_RUNS:
+            mode, width, height, batch, steps, controlnet = shape
+            kwargs = {
+                "prompt": ["calibration"] * batch,
+                "width": width,
+                "height": height,
+                "num_inference_steps": steps,
+                "generator": [
+                    torch.Generator("cpu").manual_seed(i) for i in range(batch)
+                ],
+                "output_type": "np",
+            }
+            if mode == "img2img":
+                kwargs["image"] = [Image.new("RGB", (width, height))]
+            if controlnet:
+                pipe = self.controlnet_pipe
+                kwargs["control_image"] = [Image.new("RGB", (width, height))] * len(
+                    CONTROLNET_MODELS
+                )
+            else:
+                pipe = getattr(self, f"{mode}_pipe")
+
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            start = time.perf_counter()
+            pipe(**kwargs)
+            torch.cuda.synchronize()
+            self.cost_model.observe(
+                shape, torch.cuda.max_memory_allocated(), time.perf_counter() - start
+            )
+
+        self.cost_model.fit()
+        print(
+            f"Cost model calibrated on {len(CALIBRATION_RUNS)} runs, "
+            f"memory margin {self.cost_model.memory_margin:.2f}, latency margin {self.cost_model.latency_margin:.2f}"
+        )
+        self.metrics.set("cost_model.memory_margin", self.cost_model.memory_margin)
+        self.metrics.set("cost_model.latency_margin", self.cost_model.latency_margin)
 
     def control_image(self, image, canny_low_threshold, canny_high_threshold):
+        import cv2 as cv
+
         image = np.array(image)
         canny = cv.Canny(image, canny_low_threshold, canny_high_threshold)
         return Image.fromarray(canny)
 
+    def get_seeds(self, seed, count):
+        """
+        Per-image seeds derived from the request seed. The first image uses the request seed itself, so any image
+        can be regenerated alone by passing its reported seed with a single prompt and num_images=1.
+        """
+        return [(seed + i) % 2**64 for i in range(count)]
+
+    def load_latents(self, path):
+        """Read latents written by a previous prediction: a .safetensors file with a `latents` tensor, or a .npy file"""
+        path = str(path)
+        if path.endswith(".npy"):
+            latents = torch.from_numpy(np.load(path))
+        else:
+            latents = load_file(path)["latents"]
+
+        if latents.ndim == 3:
+            latents = latents[None]
+        if latents.ndim != 4 or latents.shape[1] != 4:
+            raise ValueError(
+                f"Expected latents of shape (N, 4, height / 8, width / 8), got {tuple(latents.shape)}"
+            )
+        return latents
+
+    def save_latents(self, request, output_dir):
+        """Write the latents of each image to its own .safetensors file, which the `latents` input accepts"""
+        latents = request["result"].cpu()
+        seeds = request["seeds"]
+        names = [f"out-{i}-{s}.safetensors" for i, s in enumerate(seeds)]
+        for i, name in enumerate(names):
+            save_file(
+                {"latents": latents[i : i + 1].contiguous()},
+                os.path.join(output_dir, name),
+            )
+
+        if request["archive_outputs"]:
+            import tarfile
+
+            tar_path = os.path.join(output_dir, "output_latents.tar")
+            with tarfile.open(tar_path, "w") as tar:
+                for name in names:
+                    tar.add(os.path.join(output_dir, name), name)
+            return Path(tar_path)
+
+        return [Path(os.path.join(output_dir, name)) for name in names]
+
+    def encode_image(self, pipe, image, generator):
+        """
+        Encode the init image once for the whole batch, sampling each image's latent from its own generator
+        """
+        from latent_consistency_controlnet import encode_init_latents
+
+        image = pipe.image_processor.preprocess(image).to(
+            device=pipe._execution_device, dtype=pipe.vae.dtype
+        )
+        return encode_init_latents(pipe.vae, image, generator)
+
     def get_allowed_dimensions(self, base=512, max_dim=1024):
         """
         Function to generate allowed dimensions optimized around a base up to a max
@@ -94,6 +603,14 @@ class Predictor(BasePredictor):
                 allowed_dimensions.append((i, j))
         return allowed_dimensions
 
+    def get_base_dimensions(self, width, height):
+        """The size the first stage of a two_stage request runs at: the aspect ratio at about TWO_STAGE_BASE_PIXELS"""
+        scale = min(1.0, math.sqrt(TWO_STAGE_BASE_PIXELS / (width * height)))
+        return (
+            max(64, round(width * scale / 64) * 64),
+            max(64, round(height * scale / 64) * 64),
+        )
+
     def get_resized_dimensions(self, width, height):
         """
         Function adapted from Lucataco's implementation of SDXL-Controlnet for Replicate
@@ -210,6 +727,26 @@ class Predictor(BasePredictor):
             le=1.0,
             default=1.0,
         ),
+        depth_image: Path = Input(
+            description="Depth map for the depth controlnet, used as is",
+            default=None,
+        ),
+        depth_conditioning_scale: float = Input(
+            description="Depth controlnet conditioning scale",
+            ge=0.1,
+            le=4.0,
+            default=1.0,
+        ),
+        pose_image: Path = Input(
+            description="OpenPose skeleton image for the pose controlnet, used as is",
+            default=None,
+        ),
+        pose_conditioning_scale: float = Input(
+            description="Pose controlnet conditioning scale",
+            ge=0.1,
+            le=4.0,
+            default=1.0,
+        ),
         canny_low_threshold: float = Input(
             description="Canny low threshold",
             ge=1,
@@ -230,15 +767,221 @@ class Predictor(BasePredictor):
             description="Disable safety checker for generated images. This feature is only available through the API",
             default=False,
         ),
+        latents: Path = Input(
+            description="Latents returned by a previous prediction (.safetensors or .npy), used instead of an input image for img2img and ControlNet. They set the width and height",
+            default=None,
+        ),
+        output_latents: bool = Input(
+            description="Return latents as .safetensors files instead of images, to pass on to another prediction without decoding. Skips the safety checker, so it needs disable_safety_checker",
+            default=False,
+        ),
+        convergence_threshold: float = Input(
+            description="Stop denoising an image once its prediction changes by less than this fraction between steps, e.g. 0.02. Leave blank to always run all steps",
+            ge=0.0,
+            default=None,
+        ),
+        token_merging: bool = Input(
+            description="Merge similar tokens in self-attention for faster, lower memory sampling of large images (896x896 and up) at a small cost in detail",
+            default=False,
+        ),
+        feature_cache_interval: int = Input(
+            description="ControlNet requests only: run the full UNet every this many steps and reuse its deep features in between, e.g. 2. Faster at a small cost in quality. Leave blank to run the full UNet every step",
+            ge=1,
+            default=None,
+        ),
+        controlnet_cache_interval: int = Input(
+            description="ControlNet requests only: run the ControlNets every this many steps and reuse their residuals in between, e.g. 2. Faster at a small cost in how closely the image follows the control images. Leave blank to run them every step",
+            ge=1,
+            default=None,
+        ),
+        tile_size: int = Input(
+            description="Denoise images larger than this many pixels in either direction in overlapping tiles of this size, for outputs beyond 1024x1024 with memory bounded by the tile size, e.g. 768. Leave blank to denoise the whole image at once",
+            ge=256,
+            default=None,
+        ),
+        two_stage: bool = Input(
+            description="Text-to-image only: generate at about 512x512, upscale in latent space and refine at the requested size with a short img2img pass. Faster than generating large images directly",
+            default=False,
+        ),
+        refine_strength: float = Input(
+            description="Strength of the refine pass of two_stage requests, and the share of num_inference_steps it runs. Higher redraws more detail at the requested size",
+            ge=0.1,
+            le=1.0,
+            default=0.3,
+        ),
+        model: str = Input(
+            description="Checkpoint to generate with. Switching checkpoints takes a moment the first time, recently used ones stay warm",
+            choices=MODELS,
+            default=MODELS[0],
+        ),
+        controlnet_model: str = Input(
+            description="ControlNet for control_image. The canny one is given the Canny edges of control_image, the others take control_image as is, e.g. line art or a scribble",
+            choices=CONTROL_IMAGE_MODELS,
+            default=CONTROL_IMAGE_MODELS[0],
+        ),
+        lora: str = Input(
+            description="LoRA adapter to apply to the UNet. Requests with the same LoRA and lora_scale run faster one after another",
+            default=None,
+        ),
+        lora_scale: float = Input(
+            description="Strength of the LoRA adapter",
+            ge=0.0,
+            le=2.0,
+            default=1.0,
+        ),
+        deadline_seconds: float = Input(
+            description="Latency budget in seconds, counted from when the request arrives. When it runs out, sampling stops and the current best image is returned. Leave blank for no deadline",
+            ge=0.0,
+            default=None,
+        ),
     ) -> List[Path]:
         """Run a single prediction on the model"""
 
+        request = {name: value for name, value in locals().items() if name != "self"}
+        return self.submit(request).result()
+
+    async def predict_async(self, **inputs) -> List[Path]:
+        """
+        Async entry point taking the same inputs as `predict`. Cancelling the awaiting task abandons the request: it
+        is dropped between stages or between denoising steps and the device is freed without decoding.
+        """
+        self.validate_inputs(inputs)
+        request = {
+            **self.default_inputs(),
+            **inputs,
+            "cancellation_token": threading.Event(),
+        }
+        try:
+            # the first stage's queue is bounded, so waiting for room in it happens off the event loop
+            future = await asyncio.get_running_loop().run_in_executor(
+                None, self.submit, request
+            )
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            request["cancellation_token"].set()
+            raise
+
+    def default_inputs(self):
+        """The predict() defaults, as cog would fill them in for an empty request"""
+        return {
+            name: getattr(param.default, "default", param.default)
+            for name, param in inspect.signature(self.predict).parameters.items()
+        }
+
+    def validate_inputs(self, inputs):
+        """
+        Check inputs against the predict() signature, as cog does for the requests it runs: unknown names, values
+        outside the ge/le bounds and values that are not among the choices raise ValueError
+        """
+        parameters = inspect.signature(self.predict).parameters
+        for name, value in inputs.items():
+            if name not in parameters:
+                raise ValueError(f"Unknown input {name}")
+            field = parameters[name].default
+            if value is None:
+                continue
+            ge, le = getattr(field, "ge", None), getattr(field, "le", None)
+            if ge is not None and value < ge:
+                raise ValueError(f"{name} must be at least {ge}, got {value}")
+            if le is not None and value > le:
+                raise ValueError(f"{name} must be at most {le}, got {value}")
+            choices = getattr(field, "choices", None)
+            if choices is not None and value not in choices:
+                raise ValueError(
+                    f"Unknown {name} {value}, expected one of {', '.join(map(str, choices))}"
+                )
+
+    def submit(self, request):
+        """Queue a request and return a future for its outputs, blocking while the first stage's queue is full"""
+        request.setdefault("cancellation_token", threading.Event())
+        request["deadline"] = (
+            time.monotonic() + request["deadline_seconds"]
+            if request["deadline_seconds"] is not None
+            else None
+        )
+        return self.executor.submit(request, request["cancellation_token"])
+
+    def step_callback(self, request):
+        """
+        Step callback that gives the diffusers pipelines the same cancellation and deadline checks the ControlNet
+        pipeline does natively. Early stopping stops the whole batch once every image has converged, as these
+        pipelines cannot drop single rows.
+        """
+        from latent_consistency_controlnet import (
+            Converged,
+            DeadlineExceeded,
+            GenerationCancelled,
+            relative_change,
+        )
+
+        deadline = request["deadline"]
+        cancellation_token = request["cancellation_token"]
+        convergence_threshold = request["convergence_threshold"]
+        previous = [None]
+
+        def callback(pipe, i, t, callback_kwargs):
+            if cancellation_token.is_set():
+                raise GenerationCancelled(f"Cancelled after {i + 1} steps")
+            if i + 1 == len(pipe.scheduler.timesteps):
+                return {}
+
+            denoised = callback_kwargs["denoised"]
+            if deadline is not None and time.monotonic() >= deadline:
+                raise DeadlineExceeded(denoised, i + 1)
+            if convergence_threshold is not None:
+                if previous[0] is not None:
+                    change = relative_change(previous[0], denoised)
+                    if bool((change < convergence_threshold).all()):
+                        raise Converged(denoised, i + 1)
+                previous[0] = denoised
+            return {}
+
+        return callback
+
+    @torch.no_grad()
+    def decode_latents(self, pipe, denoised, output_latents=False):
+        """
+        Decode and safety check latents the way the pipeline does after its last step, into uint8 images on the host
+        (see `quantize_images`)
+        """
+        from latent_consistency_controlnet import (
+            check_safety,
+            copy_to_host,
+            host_array,
+            quantize_images,
+        )
+
+        if output_latents:
+            return denoised
+        image = pipe.vae.decode(
+            denoised / pipe.vae.config.scaling_factor, return_dict=False
+        )[0]
+        # the host buffers are pooled in the ControlNet pipeline's arena
+        arena = self.controlnet_pipe.arena
+        image, _ = copy_to_host(quantize_images(image), arena=arena)
+        image = host_array(image, arena)
+        if pipe.safety_checker is not None:
+            image, _ = check_safety(
+                pipe.safety_checker,
+                pipe.feature_extractor,
+                image,
+                pipe._execution_device,
+                denoised.dtype,
+            )
+        return image
+
+    def preprocess(self, request):
+        """
+        CPU stage: parse the prompt, decode and resize input images, compute the Canny map and decide how the request
+        is admitted
+        """
+        seed = request["seed"]
         if seed is None:
-            seed = int.from_bytes(os.urandom(2), "big")
+            seed = int.from_bytes(os.urandom(8), "big")
 
         print(f"Using seed: {seed}")
 
-        prompt = prompt.strip().splitlines()
+        prompt = request["prompt"].strip().splitlines()
         if len(prompt) == 1:
             print("Found 1 prompt:")
         else:
@@ -246,11 +989,41 @@ class Predictor(BasePredictor):
         for p in prompt:
             print(f"- {p}")
 
+        num_images = request["num_images"]
         if len(prompt) * num_images == 1:
             print("Making 1 image")
         else:
             print(f"Making {len(prompt) * num_images} images")
 
+        if request["lora"] and request["lora"] not in LORAS:
+            raise ValueError(
+                f"Unknown LoRA {request['lora']}, expected one of {', '.join(LORAS) or 'none'}"
+            )
+
+        if request["output_latents"] and not request["disable_safety_checker"]:
+            raise ValueError(
+                "Latent outputs are not safety checked, set disable_safety_checker to return them"
+            )
+
+        width, height = request["width"], request["height"]
+        image, control_image = request["image"], request["control_image"]
+        sizing_strategy = request["sizing_strategy"]
+        latents = None
+        if request["latents"]:
+            if image:
+                raise ValueError("Pass either an input image or latents, not both")
+            latents = self.load_latents(request["latents"])
+            # one init latent per image, cycling through the ones given
+            rows = torch.arange(len(prompt) * num_images) % latents.shape[0]
+            latents = latents[rows]
+            # the latents fix the output size
+            scale_factor = self.txt2img_pipe.vae_scale_factor
+            height, width = (
+                latents.shape[2] * scale_factor,
+                latents.shape[3] * scale_factor,
+            )
+            sizing_strategy = "width/height"
+
         if image or control_image:
             (
                 width,
@@ -261,68 +1034,448 @@ class Predictor(BasePredictor):
                 sizing_strategy, width, height, control_image, image
             )
 
-        kwargs = {}
         canny_image = None
-
-        if image:
-            kwargs["image"] = image
-            kwargs["strength"] = prompt_strength
-
-        if control_image:
+        if control_image and request["controlnet_model"] != CONTROLNET_MODELS[0]:
+            canny_image = control_image.convert("RGB")
+        elif control_image:
             canny_image = self.control_image(
-                control_image, canny_low_threshold, canny_high_threshold
+                control_image,
+                request["canny_low_threshold"],
+                request["canny_high_threshold"],
             )
-            kwargs["control_guidance_start"]: control_guidance_start
-            kwargs["control_guidance_end"]: control_guidance_end
-            kwargs["controlnet_conditioning_scale"]: controlnet_conditioning_scale
 
-            # TODO: This is a hack to get controlnet working without an image input
-            # The current pipeline doesn't seem to support not having an image, so
-            # we pass one in but set strength to 1 to ignore it
-            if not image:
-                kwargs["image"] = Image.new("RGB", (width, height), (128, 128, 128))
-                kwargs["strength"] = 1.0
+        depth_image, pose_image = self.resize_images(
+            [
+                self.open_image(request["depth_image"]),
+                self.open_image(request["pose_image"]),
+            ],
+            width,
+            height,
+        )
 
-            kwargs["control_image"] = canny_image
+        if canny_image or depth_image or pose_image:
+            mode = "controlnet"
+        elif self.tiling(request, width, height) is not None:
+            # only the ControlNet pipeline denoises in tiles, without control images it samples like the others
+            mode = "controlnet"
+        else:
+            mode = "img2img" if image or latents is not None else "txt2img"
 
-        mode = "controlnet" if control_image else "img2img" if image else "txt2img"
+        base_size = None
+        if request["two_stage"]:
+            if mode != "txt2img":
+                raise ValueError(
+                    "two_stage is supported for text-to-image requests only"
+                )
+            base_size = self.get_base_dimensions(width, height)
+            if base_size[0] * base_size[1] < width * height:
+                # the refine pass is an img2img run from the upscaled latents
+                mode = "img2img"
+                print(f"Generating at {base_size[0]}x{base_size[1]}, then refining")
+            else:
+                base_size = None
         print(f"{mode} mode")
-        pipe = getattr(self, f"{mode}_pipe" if not disable_safety_checker else f"{mode}_pipe_unsafe")
 
+        request.update(
+            prompt=prompt,
+            seeds=self.get_seeds(seed, len(prompt) * num_images),
+            width=width,
+            height=height,
+            image=image,
+            latents=latents,
+            canny_image=canny_image,
+            depth_image=depth_image,
+            pose_image=pose_image,
+            mode=mode,
+            base_size=base_size,
+        )
+        self.admit(request)
+        return request
+
+    def generate(self, request):
+        """Model stage: run the pipeline for the request. This is the only stage that touches the pipelines"""
+        from latent_consistency_controlnet import DeadlineExceeded, GenerationCancelled
+
+        self.activate(request)
+        mode = request["mode"]
+        generator = [torch.Generator("cpu").manual_seed(s) for s in request["seeds"]]
         common_args = {
-            "width": width,
-            "height": height,
-            "prompt": prompt,
-            "guidance_scale": guidance_scale,
-            "num_images_per_prompt": num_images,
-            "num_inference_steps": num_inference_steps,
-            "lcm_origin_steps": lcm_origin_steps,
-            "output_type": "pil",
+            "width": request["width"],
+            "height": request["height"],
+            "guidance_scale": request["guidance_scale"],
+            "num_inference_steps": request["num_inference_steps"],
+            "lcm_origin_steps": request["lcm_origin_steps"],
+            # images are quantized to uint8 on the device before they are copied to the host, and PIL conversion
+            # happens in the postprocess stage, off the model thread
+            "output_type": "latent" if request["output_latents"] else "uint8",
         }
-        result = pipe(**common_args, **kwargs, generator=torch.manual_seed(seed)).images
+        chunks = self.get_chunks(request, generator)
+
+        if mode == "controlnet":
+            return self.generate_continuous(request, common_args, chunks)
+        # the diffusers pipelines only postprocess to float images, so they hand back latents to decode_latents
+        common_args["output_type"] = "latent"
+        if request["base_size"] is not None:
+            # the refine pass runs its share of the steps, from a correspondingly later timestep
+            common_args["num_inference_steps"] = math.ceil(
+                request["num_inference_steps"] * request["refine_strength"]
+            )
+
+        pipe = self.pipes_for(request)[0]
+
+        token_merging_ratio = (
+            self.token_merging.ratio_for(request["width"], request["height"])
+            if request["token_merging"]
+            else 0.0
+        )
+        latent_size = (
+            request["height"] // pipe.vae_scale_factor,
+            request["width"] // pipe.vae_scale_factor,
+        )
+
+        results = []
+        steps_used = []
+        for prompt, num_images_per_prompt, chunk_generator, init_latents in chunks:
+            kwargs = {
+                "callback_on_step_end": self.step_callback(request),
+                "callback_on_step_end_tensor_inputs": ["denoised"],
+            }
+            if request["base_size"] is not None:
+                kwargs["image"] = self.generate_base(
+                    request, prompt, num_images_per_prompt, chunk_generator
+                )
+                kwargs["strength"] = request["refine_strength"]
+            elif mode == "img2img":
+                # 4-channel images are taken as latents by the pipeline, skipping the VAE encode
+                kwargs["image"] = (
+                    init_latents
+                    if init_latents is not None
+                    else self.encode_image(pipe, request["image"], chunk_generator)
+                )
+                kwargs["strength"] = request["prompt_strength"]
+
+            torch.cuda.reset_peak_memory_stats()
+            start = time.perf_counter()
+            result = None
+            try:
+                with self.token_merging.merging(token_merging_ratio, latent_size):
+                    result = pipe(
+                        prompt=prompt,
+                        num_images_per_prompt=num_images_per_prompt,
+                        **common_args,
+                        **kwargs,
+                        generator=chunk_generator,
+                    ).images
+                result = self.decode_latents(pipe, result, request["output_latents"])
+                steps = len(pipe.scheduler.timesteps)
+            except DeadlineExceeded as e:
+                # also covers Converged
+                print(f"{e}, returning the current prediction")
+                result = self.decode_latents(
+                    pipe, e.denoised, request["output_latents"]
+                )
+                steps = e.steps
+            except GenerationCancelled:
+                pass
+
+            if result is None:
+                # The pipeline frame holding the request's device tensors is gone once we are out of the except
+                # block, so the cached blocks can be handed back before the next request starts.
+                torch.cuda.empty_cache()
+                raise GenerationCancelled("Request was cancelled")
+
+            if request["base_size"] is not None:
+                # and the steps of the first stage
+                steps += request["num_inference_steps"]
+            self.record_cost(request, time.perf_counter() - start)
+            results.append(result)
+            steps_used += [steps] * len(chunk_generator)
+
+        request["result"] = self.concatenate(results)
+        self.record_steps(request, steps_used)
+        return request
+
+    def generate_base(self, request, prompt, num_images_per_prompt, generator):
+        """
+        The first stage of a two_stage request: latents sampled at its base size and upscaled to the requested size,
+        for the refine pass to start from
+        """
+        width, height = request["base_size"]
+        # only latents come out, so there is nothing to safety check yet
+        pipe = self.txt2img_pipe_unsafe
+        scale = pipe.vae_scale_factor
+        token_merging_ratio = (
+            self.token_merging.ratio_for(width, height)
+            if request["token_merging"]
+            else 0.0
+        )
+        with self.token_merging.merging(
+            token_merging_ratio, (height // scale, width // scale)
+        ):
+            latents = pipe(
+                prompt=prompt,
+                num_images_per_prompt=num_images_per_prompt,
+                width=width,
+                height=height,
+                guidance_scale=request["guidance_scale"],
+                num_inference_steps=request["num_inference_steps"],
+                lcm_origin_steps=request["lcm_origin_steps"],
+                output_type="latent",
+                generator=generator,
+            ).images
+        # the refine pass runs on another pipeline
+        self.offload([pipe])
+        return torch.nn.functional.interpolate(
+            latents.float(),
+            size=(request["height"] // scale, request["width"] // scale),
+            mode="bicubic",
+        ).to(latents.dtype)
+
+    def record_steps(self, request, steps_used):
+        """Report the denoising steps each image actually ran"""
+        print(f"Steps used: {steps_used}")
+        for steps in steps_used:
+            self.metrics.observe("sampling.steps_used", steps)
+        request["steps_used"] = steps_used
+
+    def concatenate(self, results):
+        """Join the outputs of the chunks of a request: numpy images, or latent tensors"""
+        if torch.is_tensor(results[0]):
+            return torch.cat(results)
+        return np.concatenate(results)
+
+    def get_chunks(self, request, generator):
+        """
+        Split the request into batches of at most `chunk_size` images, as
+        `(prompt, num_images_per_prompt, generator, init_latents)` tuples. Every image keeps its own generator, so
+        chunking does not change the outputs. `init_latents` are the chunk's rows of the `latents` input, or None.
+        """
+        chunk_size = request["chunk_size"]
+        latents = request["latents"]
+        if chunk_size >= len(generator):
+            return [(request["prompt"], request["num_images"], generator, latents)]
+
+        prompts = [p for p in request["prompt"] for _ in range(request["num_images"])]
+        return [
+            (
+                prompts[i : i + chunk_size],
+                1,
+                generator[i : i + chunk_size],
+                latents[i : i + chunk_size] if latents is not None else None,
+            )
+            for i in range(0, len(prompts), chunk_size)
+        ]
+
+    def generate_continuous(self, request, common_args, chunks):
+        """
+        Hand a ControlNet request to the continuous batching engine, which steps it together with the other
+        in-flight requests. Returns a future so the model worker can take the next request meanwhile.
+        """
+        kwargs = {
+            # one entry per net in CONTROLNET_MODELS, nets without an image are skipped
+            "control_image": [
+                request["canny_image"],
+                request["depth_image"],
+                request["pose_image"],
+            ],
+            "controlnet_conditioning_scale": [
+                request["controlnet_conditioning_scale"],
+                request["depth_conditioning_scale"],
+                request["pose_conditioning_scale"],
+            ],
+            "control_guidance_start": request["control_guidance_start"],
+            "control_guidance_end": request["control_guidance_end"],
+            "feature_cache_interval": request["feature_cache_interval"],
+            "controlnet_cache_interval": request["controlnet_cache_interval"],
+            "tile_size": request["tile_size"],
+            "tile_overlap": TILE_OVERLAP,
+            "tile_batch_size": TILE_BATCH_SIZE,
+            "token_merging": request["token_merging"],
+        }
+        if request["image"] or request["latents"] is not None:
+            kwargs["strength"] = request["prompt_strength"]
+
+        # the engine queues chunks until the memory they need on top of the weights is free
+        memory = request["predicted_cost"][0] - self.cost_model.base_memory
+        futures = [
+            self.engine.submit(
+                prompt=prompt,
+                num_images_per_prompt=num_images_per_prompt,
+                image=init_latents if init_latents is not None else request["image"],
+                **common_args,
+                **kwargs,
+                generator=chunk_generator,
+                safety_checker=not request["disable_safety_checker"],
+                deadline=request["deadline"],
+                cancellation_token=request["cancellation_token"],
+                memory=memory,
+                convergence_threshold=request["convergence_threshold"],
+            )
+            for prompt, num_images_per_prompt, chunk_generator, init_latents in chunks
+        ]
+
+        done = Future()
+        lock = threading.Lock()
+        remaining = [len(futures)]
+
+        def finish(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            try:
+                outputs = [future.result() for future in futures]
+                request["result"] = self.concatenate([o.images for o in outputs])
+                self.record_steps(
+                    request, [steps for o in outputs for steps in o.steps_used]
+                )
+            except BaseException as e:
+                done.set_exception(e)
+            else:
+                done.set_result(request)
+
+        for future in futures:
+            future.add_done_callback(finish)
+        return done
+
+    def tiling(self, request, width, height):
+        """The tiles a request is denoised in, None if it is denoised whole"""
+        tile_size = request["tile_size"]
+        if tile_size is None or max(width, height) <= tile_size:
+            return None
+        scale = self.controlnet_pipe.vae_scale_factor
+        return Tiling(
+            height // scale,
+            width // scale,
+            tile_size // scale,
+            TILE_OVERLAP // scale,
+            TILE_BATCH_SIZE,
+        )
+
+    def admit(self, request):
+        """
+        Admission control, run before the request reaches the model. Predicts peak memory and latency with the cost
+        model and sets the batch size the request runs in: requests that do not fit the memory budget in one batch
+        are chunked, requests where a single image does not fit are rejected.
+
+        A tiled image is costed as a batch of tiles, the memory of one model call over its tiles and the time of all
+        of them. A two_stage request is costed as its base-size pass followed by its refine pass, which runs in
+        img2img for its share of the steps.
+        """
+        width, height = request["width"], request["height"]
+        tiles, calls = 1, 1
+        tiling = self.tiling(request, width, height)
+        if tiling is not None:
+            scale = self.controlnet_pipe.vae_scale_factor
+            width, height = tiling.tile_width * scale, tiling.tile_height * scale
+            tiles, calls = min(len(tiling), TILE_BATCH_SIZE), len(tiling.batches())
+
+        # the shape of each pass a batch runs
+        batch = len(request["seeds"]) * tiles
+        steps = request["num_inference_steps"]
+        controlnet = request["mode"] == "controlnet"
+        if request["base_size"] is not None:
+            refine_steps = math.ceil(steps * request["refine_strength"])
+            shapes = [
+                ("txt2img", *request["base_size"], batch, steps, controlnet),
+                ("img2img", width, height, batch, refine_steps, controlnet),
+            ]
+        else:
+            init = (
+                request["mode"] == "img2img"
+                or request["image"]
+                or request["latents"] is not None
+            )
+            mode = "img2img" if init else "txt2img"
+            shapes = [(mode, width, height, batch, steps, controlnet)]
+
+        chunk_size = (
+            min(
+                self.cost_model.max_batch(self.memory_budget, *shape)
+                for shape in shapes
+            )
+            // tiles
+        )
+        if chunk_size == 0:
+            self.metrics.increment("admission.rejected")
+            memory = max(
+                self.cost_model.predict(*shape[:3], tiles, *shape[4:])[0]
+                for shape in shapes
+            )
+            raise ValueError(
+                f"A {request['width']}x{request['height']} image needs about {memory / 2**30:.1f} GiB of device "
+                f"memory, more than the {self.memory_budget / 2**30:.1f} GiB available. Lower width and height."
+            )
+
+        if chunk_size < len(request["seeds"]):
+            self.metrics.increment("admission.chunked")
+            print(f"Generating in batches of {chunk_size} images to fit in memory")
+        else:
+            self.metrics.increment("admission.accepted")
+
+        costs = [
+            self.cost_model.predict(*shape[:3], chunk_size * tiles, *shape[4:])
+            for shape in shapes
+        ]
+        # the passes run one after the other
+        memory = max(memory for memory, _ in costs)
+        latency = sum(latency for _, latency in costs) * calls
+        print(
+            f"Predicted peak memory {memory / 2**30:.2f} GiB, {latency:.2f}s per batch"
+        )
+        self.metrics.observe("cost_model.predicted_memory_bytes", memory)
+        self.metrics.observe("cost_model.predicted_latency_seconds", latency)
+        request.update(chunk_size=chunk_size, predicted_cost=(memory, latency))
+
+    def record_cost(self, request, latency):
+        """Compare a batch's measured peak memory and latency with the cost model's prediction"""
+        memory, predicted_latency = request["predicted_cost"]
+        self.metrics.observe(
+            "cost_model.memory_error_bytes", torch.cuda.max_memory_allocated() - memory
+        )
+        self.metrics.observe(
+            "cost_model.latency_error_seconds", latency - predicted_latency
+        )
+
+    def postprocess(self, request):
+        """CPU stage: convert the outputs to images and write them to a directory owned by this request"""
+        seeds = request["seeds"]
+        output_dir = tempfile.mkdtemp(prefix="lcm-")
+
+        for i, s in enumerate(seeds):
+            print(f"Image {i} seed: {s}")
+
+        if request["output_latents"]:
+            return self.save_latents(request, output_dir)
+
+        # uint8 rows are wrapped without a copy
+        result = [Image.fromarray(image) for image in request["result"]]
+
+        if request["archive_outputs"]:
+            import tarfile
 
-        if archive_outputs:
             archive_start_time = datetime.datetime.now()
             print(f"Archiving images started at {archive_start_time}")
 
-            tar_path = "/tmp/output_images.tar"
+            tar_path = os.path.join(output_dir, "output_images.tar")
             with tarfile.open(tar_path, "w") as tar:
                 for i, sample in enumerate(result):
-                    output_path = f"/tmp/out-{i}.png"
+                    output_path = os.path.join(output_dir, f"out-{i}-{seeds[i]}.png")
                     sample.save(output_path)
-                    tar.add(output_path, f"out-{i}.png")
+                    tar.add(output_path, f"out-{i}-{seeds[i]}.png")
 
             return Path(tar_path)
 
         # If not archiving, or there is an error in archiving, return the paths of individual images.
         output_paths = []
         for i, sample in enumerate(result):
-            output_path = f"/tmp/out-{i}.jpg"
+            output_path = os.path.join(output_dir, f"out-{i}-{seeds[i]}.jpg")
             sample.save(output_path)
             output_paths.append(Path(output_path))
 
-        if canny_image:
-            canny_image_path = "/tmp/canny-image.jpg"
+        canny_image = request["canny_image"]
+        if canny_image and request["controlnet_model"] == CONTROLNET_MODELS[0]:
+            canny_image_path = os.path.join(output_dir, "canny-image.jpg")
             canny_image.save(canny_image_path)
             output_paths.append(Path(canny_image_path))
 
@@ -0,0 +1,236 @@
+"""
+Frame sequence generation: stylizes the frames of a video with the canny ControlNet and writes the outputs to a
+directory as numbered frames, e.g. for ffmpeg.
+
+    python sequence.py frames.zip --prompt "A watercolor painting of a city street" --output-dir outputs
+    python sequence.py frames/ --prompt "..." --init previous --strength 0.6 --batch-size 4
+
+Frames come from a directory, a zip or tar archive, or a text file listing one image path per line, in name order.
+The prompt is encoded once for the whole sequence and every frame is sampled with the same seed, so frames that
+look alike get the same noise and stay consistent instead of flickering. Frames are decoded, resized and turned
+into Canny maps on worker threads one batch ahead of the model, and run in batches.
+
+With `--init frame` each frame starts from its own image, as an img2img request would. With `--init previous`
+each batch starts from the last output latent of the batch before it, which carries the look of one frame into
+the next; `--batch-size 1` chains every frame to the one before it.
+"""
+
+import argparse
+import io
+import os
+import tarfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from PIL import Image
+
+from predict import CONTROLNET_MODELS, Predictor
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".bmp")
+
+
+def is_image(name):
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def read_frames(path):
+    """The frames in order, as `(name, source)` pairs where source is a file path or the bytes of an archive member"""
+    if os.path.isdir(path):
+        names = sorted(n for n in os.listdir(path) if is_image(n))
+        return [(n, os.path.join(path, n)) for n in names]
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            names = sorted(n for n in archive.namelist() if is_image(n))
+            return [(n, archive.read(n)) for n in names]
+    if tarfile.is_tarfile(path):
+        with tarfile.open(path) as archive:
+            members = sorted(
+                (m for m in archive.getmembers() if m.isfile() and is_image(m.name)),
+                key=lambda m: m.name,
+            )
+            return [(m.name, archive.extractfile(m).read()) for m in members]
+    with open(path) as f:
+        return [(line.strip(), line.strip()) for line in f if line.strip()]
+
+
+def open_frame(source):
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    return Image.open(source).convert("RGB")
+
+
+def load_frame(predictor, source, args):
+    """CPU stage: decode and resize a frame and compute its Canny map"""
+    image = open_frame(source).resize((args.width, args.height))
+    return image, predictor.control_image(
+        image, args.canny_low_threshold, args.canny_high_threshold
+    )
+
+
+@torch.no_grad()
+def run_batch(pipe, args, prompt_embeds, frames, init_latents):
+    """
+    Sample a batch of `(image, canny_image)` frames. Returns the output latents and the decoded images, as uint8
+    numpy arrays.
+    """
+    images, canny_images = zip(*frames)
+    kwargs = {}
+    if init_latents is not None:
+        # 4-channel images are taken as latents, a single one is shared by the whole batch
+        kwargs.update(image=init_latents, strength=args.strength)
+    elif args.init != "noise":
+        kwargs.update(image=list(images), strength=args.strength)
+
+    # one entry per net in CONTROLNET_MODELS, nets without an image are skipped
+    control_image = [None] * len(CONTROLNET_MODELS)
+    control_image[0] = list(canny_images)
+    latents = pipe(
+        prompt_embeds=prompt_embeds.expand(len(frames), -1, -1),
+        width=args.width,
+        height=args.height,
+        guidance_scale=args.guidance_scale,
+        num_inference_steps=args.num_inference_steps,
+        lcm_origin_steps=args.lcm_origin_steps,
+        control_image=control_image,
+        controlnet_conditioning_scale=[args.controlnet_conditioning_scale]
+        * len(CONTROLNET_MODELS),
+        # the same seed for every frame, so they all start from the same noise
+        generator=[
+            torch.Generator("cpu").manual_seed(args.seed) for _ in range(len(frames))
+        ],
+        output_type="latent",
+        **kwargs,
+    ).images
+    images, _ = pipe.decode_latents(
+        latents,
+        "uint8",
+        pipe._execution_device,
+        safety_checker=not args.disable_safety_checker,
+    )
+    return latents, images
+
+
+def save_image(image, path):
+    Image.fromarray(image).save(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "frames", help="Directory, zip or tar archive, or text file listing frames"
+    )
+    parser.add_argument("--prompt", required=True)
+    parser.add_argument("--output-dir", default="sequence-outputs")
+    parser.add_argument(
+        "--width",
+        type=int,
+        default=None,
+        help="Output width, picked from the first frame's aspect ratio if not set",
+    )
+    parser.add_argument("--height", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument(
+        "--init",
+        choices=["noise", "frame", "previous"],
+        default="frame",
+        help="What each frame starts from: noise, its own image, or the previous batch's output",
+    )
+    parser.add_argument(
+        "--strength",
+        type=float,
+        default=0.8,
+        help="Prompt strength when starting from an image or a previous output",
+    )
+    parser.add_argument("--num-inference-steps", type=int, default=8)
+    parser.add_argument("--guidance-scale", type=float, default=8.0)
+    parser.add_argument("--lcm-origin-steps", type=int, default=50)
+    parser.add_argument("--controlnet-conditioning-scale", type=float, default=2.0)
+    parser.add_argument("--canny-low-threshold", type=float, default=100)
+    parser.add_argument("--canny-high-threshold", type=float, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--disable-safety-checker", action="store_true")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Threads preparing input frames and writing output frames",
+    )
+    args = parser.parse_args()
+
+    frames = read_frames(args.frames)
+    if not frames:
+        print(f"No frames found in {args.frames}")
+        return
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    predictor = Predictor()
+    predictor.setup()
+    pipe = predictor.controlnet_pipe
+
+    if args.width is None or args.height is None:
+        args.width, args.height = predictor.get_resized_dimensions(
+            *open_frame(frames[0][1]).size
+        )
+    batch_size = max(
+        1,
+        predictor.cost_model.max_batch(
+            predictor.memory_budget,
+            "txt2img" if args.init == "noise" else "img2img",
+            args.width,
+            args.height,
+            args.batch_size,
+            args.num_inference_steps,
+            True,
+        ),
+    )
+    batches = [frames[i : i + batch_size] for i in range(0, len(frames), batch_size)]
+    print(
+        f"{len(frames)} frames at {args.width}x{args.height} in batches of {batch_size}"
+    )
+
+    start = time.perf_counter()
+    with torch.no_grad():
+        prompt_embeds = pipe._encode_prompt(
+            args.prompt, pipe._execution_device, 1, None
+        )
+
+    with ThreadPoolExecutor(args.workers) as loader, ThreadPoolExecutor(
+        args.workers
+    ) as writer:
+
+        def load(batch):
+            return [
+                loader.submit(load_frame, predictor, source, args)
+                for _, source in batch
+            ]
+
+        pending = load(batches[0])
+        init_latents = None
+        index = 0
+        for number, batch in enumerate(batches):
+            loaded = [future.result() for future in pending]
+            if number + 1 < len(batches):
+                # the next batch is prepared while this one runs on the model
+                pending = load(batches[number + 1])
+
+            latents, images = run_batch(pipe, args, prompt_embeds, loaded, init_latents)
+            if args.init == "previous":
+                init_latents = latents[-1:]
+            for image in images:
+                writer.submit(
+                    save_image, image, os.path.join(args.output_dir, f"{index:06d}.png")
+                )
+                index += 1
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"{len(frames)} frames in {elapsed:.1f}s, {len(frames) / max(elapsed, 1e-9):.2f} frames/s"
+    )
+
+
+if __name__ == "__main__":
+    main()
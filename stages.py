@@ -0,0 +1,110 @@
+import functools
+import queue
+import threading
+from concurrent.futures import CancelledError, Future
+
+
+class StagedExecutor:
+    """
+    Runs jobs through a fixed sequence of stages. Each stage has its own worker threads and reads from a bounded
+    queue, so a slow stage applies backpressure to the ones before it instead of letting work pile up in memory.
+
+    A stage is a `(name, fn, num_workers)` tuple where `fn` takes the job and returns the job for the next stage, or a
+    `Future` resolving to it when the work continues elsewhere.
+    Stages that touch the model should use a single worker; CPU stages can use several so that decoding and encoding
+    of one request overlap with model execution of another.
+
+    Jobs handed off are moved on by a forwarding thread of their own, so a full queue downstream holds up neither
+    the stage's workers nor whatever resolves the hand-off.
+
+    A job submitted with a cancellation token (anything with an `is_set()` method, e.g. `threading.Event`) is dropped
+    at the next stage boundary once the token is set, and its future fails with `CancelledError`.
+    """
+
+    def __init__(self, stages, queue_size=4):
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self.threads = []
+        for index, (name, fn, num_workers) in enumerate(stages):
+            for worker in range(num_workers):
+                thread = threading.Thread(
+                    target=self._work,
+                    args=(index, fn),
+                    name=f"{name}-{worker}",
+                    daemon=True,
+                )
+                thread.start()
+                self.threads.append(thread)
+        # (index, job, future, cancellation_token) of handed-off jobs, unbounded as it only holds jobs that already
+        # passed the queue of their stage
+        self.resolved = queue.Queue()
+        thread = threading.Thread(
+            target=self._forward_resolved, name="forward", daemon=True
+        )
+        thread.start()
+        self.threads.append(thread)
+
+    def submit(self, job, cancellation_token=None):
+        """Queue a job at the first stage and return a `Future` for the output of the last stage"""
+        future = Future()
+        self.queues[0].put((job, future, cancellation_token))
+        return future
+
+    def shutdown(self):
+        for index, (_, _, num_workers) in enumerate(self.stages):
+            for _ in range(num_workers):
+                self.queues[index].put(None)
+        self.resolved.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _work(self, index, fn):
+        while True:
+            item = self.queues[index].get()
+            if item is None:
+                return
+
+            job, future, cancellation_token = item
+            if index == 0 and not future.set_running_or_notify_cancel():
+                continue
+            if cancellation_token is not None and cancellation_token.is_set():
+                future.set_exception(CancelledError())
+                continue
+
+            try:
+                job = fn(job)
+            except BaseException as e:
+                future.set_exception(e)
+                continue
+
+            if isinstance(job, Future):
+                # the stage handed the job off (e.g. to a batching engine) and its worker is free again,
+                # the job moves on to the next stage once the hand-off resolves
+                job.add_done_callback(
+                    functools.partial(self._resolved, index, future, cancellation_token)
+                )
+                continue
+
+            self._forward(index, job, future, cancellation_token)
+
+    def _resolved(self, index, future, cancellation_token, pending):
+        try:
+            job = pending.result()
+        except BaseException as e:
+            future.set_exception(e)
+            return
+        # runs on whatever resolved the hand-off, e.g. the engine's thread, which must not wait for a full queue
+        self.resolved.put((index, job, future, cancellation_token))
+
+    def _forward_resolved(self):
+        while True:
+            item = self.resolved.get()
+            if item is None:
+                return
+            self._forward(*item)
+
+    def _forward(self, index, job, future, cancellation_token):
+        if index + 1 < len(self.queues):
+            self.queues[index + 1].put((job, future, cancellation_token))
+        else:
+            future.set_result(job)
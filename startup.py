@@ -0,0 +1,33 @@
+import time
+
+
+class StartupTimeline:
+    """
+    Wall-clock breakdown of startup into consecutive phases, e.g. imports, weight loading and warmup. `mark(phase)`
+    ends a phase that started at the previous mark, or when the timeline was created. `report` prints the phases
+    and sets them in `metrics` as `startup.{phase}_seconds`.
+    """
+
+    def __init__(self):
+        self.phases = []
+        self.last = time.perf_counter()
+
+    def add(self, phase, seconds):
+        """Record a phase measured elsewhere, e.g. the import of the module that creates the timeline"""
+        self.phases.append((phase, seconds))
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self, metrics=None):
+        total = sum(seconds for _, seconds in self.phases)
+        print(
+            f"Startup took {total:.1f}s: "
+            + ", ".join(f"{phase} {seconds:.1f}s" for phase, seconds in self.phases)
+        )
+        if metrics is not None:
+            for phase, seconds in self.phases:
+                metrics.set(f"startup.{phase}_seconds", seconds)
+            metrics.set("startup.total_seconds", total)
@@ -0,0 +1,85 @@
+import math
+
+import torch
+
+
+def tile_offsets(size, tile_size, overlap):
+    """Start offsets of tiles of `tile_size` covering `size`, spread evenly with at least `overlap` between neighbours"""
+    if size <= tile_size:
+        return [0]
+    count = math.ceil((size - tile_size) / (tile_size - overlap)) + 1
+    return [round(i * (size - tile_size) / (count - 1)) for i in range(count)]
+
+
+def ramp(offset, tile_size, size, overlap):
+    """Blend weights along one axis of a tile, fading in and out over `overlap` on the sides that have a neighbour"""
+    weights = torch.ones(tile_size)
+    if overlap > 0:
+        fade = torch.arange(1, overlap + 1) / (overlap + 1)
+        if offset > 0:
+            weights[:overlap] = fade
+        if offset + tile_size < size:
+            weights[-overlap:] = torch.minimum(weights[-overlap:], fade.flip(0))
+    return weights
+
+
+class Tiling:
+    """
+    Overlapping tiles of a `height` x `width` latent, as in MultiDiffusion (Bar-Tal et al., 2023). Every step, the
+    models run on the tiles `batch_size` at a time and the predictions are merged with weights that fade in and out
+    over the overlap, so seams blend and peak memory grows with the tile size rather than the image size. Sizes are
+    in latent pixels.
+    """
+
+    def __init__(self, height, width, tile_size, overlap, batch_size=1):
+        if not 0 <= overlap < tile_size:
+            raise ValueError(
+                f"Tile overlap must be between 0 and the tile size {tile_size}, got {overlap}"
+            )
+        if batch_size < 1:
+            raise ValueError(f"Tile batch size must be at least 1, got {batch_size}")
+        self.tile_height = min(tile_size, height)
+        self.tile_width = min(tile_size, width)
+        self.batch_size = batch_size
+        self.tiles = [
+            (y, x)
+            for y in tile_offsets(height, tile_size, overlap)
+            for x in tile_offsets(width, tile_size, overlap)
+        ]
+        self.weights = [
+            ramp(y, self.tile_height, height, overlap)[:, None]
+            * ramp(x, self.tile_width, width, overlap)[None, :]
+            for y, x in self.tiles
+        ]
+        self.total = torch.zeros(height, width)
+        for (y, x), weight in zip(self.tiles, self.weights):
+            self.total[y : y + self.tile_height, x : x + self.tile_width] += weight
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def batches(self):
+        """The tile indices of each model call"""
+        indices = list(range(len(self.tiles)))
+        return [
+            indices[i : i + self.batch_size]
+            for i in range(0, len(indices), self.batch_size)
+        ]
+
+    def crop(self, value, index, scale=1):
+        """Tile `index` of an image-shaped `value` that is `scale` times the size of the latent"""
+        y, x = self.tiles[index]
+        return value[
+            ...,
+            y * scale : (y + self.tile_height) * scale,
+            x * scale : (x + self.tile_width) * scale,
+        ]
+
+    def add(self, merged, index, prediction):
+        """Adds the weighted `prediction` for tile `index` into the full size `merged`, in place"""
+        weight = self.weights[index].to(device=merged.device, dtype=merged.dtype)
+        self.crop(merged, index).add_(prediction * weight)
+
+    def normalize(self, merged):
+        """`merged` with every tile added, divided by the sum of the weights at each position"""
+        return merged / self.total.to(device=merged.device, dtype=merged.dtype)
@@ -0,0 +1,178 @@
+import contextlib
+import math
+
+import torch
+from diffusers.models.attention import BasicTransformerBlock
+
+
+def bipartite_soft_matching(metric, w, h, sx, sy, r, dst_index):
+    """
+    Token merging by bipartite soft matching over a `h` x `w` token grid, as in ToMe for SD (Bolya & Hoffman, 2023).
+    The grid is split into `sx` x `sy` cells with one destination token per cell, at `dst_index` within the cell, and
+    the `r` source tokens most similar to a destination are merged into it. Returns `(merge, unmerge)` functions.
+    """
+    B, N, _ = metric.shape
+    if r <= 0:
+        return (lambda x: x), (lambda x: x)
+
+    hsy, wsx = h // sy, w // sx
+    # -1 marks the destination token of every cell, the rest are sources
+    cells = torch.zeros(hsy, wsx, sy * sx, device=metric.device, dtype=torch.int64)
+    cells = cells.scatter(2, dst_index, -torch.ones_like(dst_index))
+    cells = cells.view(hsy, wsx, sy, sx).transpose(1, 2).reshape(hsy * sy, wsx * sx)
+    if hsy * sy < h or wsx * sx < w:
+        # tokens in the partial cells at the edges are always sources
+        grid = torch.zeros(h, w, device=metric.device, dtype=torch.int64)
+        grid[: hsy * sy, : wsx * sx] = cells
+        cells = grid
+    order = cells.reshape(1, -1, 1).argsort(dim=1)
+
+    num_dst = hsy * wsx
+    a_idx = order[:, num_dst:, :]
+    b_idx = order[:, :num_dst, :]
+
+    def split(x):
+        c = x.shape[-1]
+        src = torch.gather(x, 1, a_idx.expand(B, N - num_dst, c))
+        dst = torch.gather(x, 1, b_idx.expand(B, num_dst, c))
+        return src, dst
+
+    metric = metric / metric.norm(dim=-1, keepdim=True)
+    a, b = split(metric)
+    scores = a @ b.transpose(-1, -2)
+    r = min(a.shape[1], r)
+
+    node_max, node_idx = scores.max(dim=-1)
+    edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+    unm_idx = edge_idx[..., r:, :]
+    src_idx = edge_idx[..., :r, :]
+    dst_idx = torch.gather(node_idx[..., None], -2, src_idx)
+
+    def merge(x):
+        src, dst = split(x)
+        n, t, c = src.shape
+        unm = torch.gather(src, -2, unm_idx.expand(n, t - r, c))
+        src = torch.gather(src, -2, src_idx.expand(n, r, c))
+        dst = dst.scatter_reduce(-2, dst_idx.expand(n, r, c), src, reduce="mean")
+        return torch.cat([unm, dst], dim=1)
+
+    def unmerge(x):
+        unm_len = unm_idx.shape[1]
+        unm, dst = x[..., :unm_len, :], x[..., unm_len:, :]
+        c = unm.shape[-1]
+        src = torch.gather(dst, -2, dst_idx.expand(B, r, c))
+        a_full = a_idx.expand(B, a_idx.shape[1], 1)
+        # out of place, so that it also works under vmap
+        out = torch.zeros(B, N, c, device=x.device, dtype=x.dtype)
+        out = out.scatter(-2, b_idx.expand(B, num_dst, c), dst)
+        out = out.scatter(
+            -2, torch.gather(a_full, 1, unm_idx).expand(B, unm_len, c), unm
+        )
+        out = out.scatter(-2, torch.gather(a_full, 1, src_idx).expand(B, r, c), src)
+        return out
+
+    return merge, unmerge
+
+
+class TokenMerging:
+    """
+    Merges similar tokens before the self-attention of every transformer block of the models it is applied to and
+    unmerges the output, so that attention runs over fewer tokens. Only blocks at most `max_downsample` times below
+    the latent resolution are merged, where attention over the full token count costs the most.
+
+    `ratios` maps a minimum pixel count (width x height) to the share of tokens merged from that size up. Smaller
+    images are not merged at all, as the overhead of matching outweighs the attention saved.
+
+    Merging is only active inside `merging()`, for the latent size given there. The destination tokens sit at a fixed
+    position in every cell, so a row's output does not depend on the rows or steps it is batched with.
+    """
+
+    def __init__(self, ratios, max_downsample=1, sx=2, sy=2):
+        self.ratios = sorted(ratios.items())
+        self.max_downsample = max_downsample
+        self.sx = sx
+        self.sy = sy
+        self.handles = []
+        # attention modules already hooked, models may share blocks
+        self.hooked = set()
+        # the unmerge of each attention module between its pre-hook and its hook
+        self.unmerges = {}
+        self.ratio = 0.0
+        self.latent_size = None
+
+    def ratio_for(self, width, height):
+        """The merge ratio for images of `width` x `height` pixels, 0 below the smallest bucket"""
+        ratio = 0.0
+        for min_pixels, bucket_ratio in self.ratios:
+            if width * height >= min_pixels:
+                ratio = bucket_ratio
+        return ratio
+
+    def apply(self, model):
+        """Hooks the self-attention of every `BasicTransformerBlock` in `model`"""
+        for module in model.modules():
+            if (
+                isinstance(module, BasicTransformerBlock)
+                and not module.only_cross_attention
+                and module.attn1 not in self.hooked
+            ):
+                self.hooked.add(module.attn1)
+                self.handles.append(
+                    module.attn1.register_forward_pre_hook(
+                        self._merge, with_kwargs=True
+                    )
+                )
+                self.handles.append(module.attn1.register_forward_hook(self._unmerge))
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        self.hooked = set()
+
+    @contextlib.contextmanager
+    def merging(self, ratio, latent_size):
+        """Merge `ratio` of the tokens of calls in this context, for latents of `latent_size` `(height, width)`"""
+        self.ratio, self.latent_size = ratio, tuple(latent_size)
+        try:
+            yield
+        finally:
+            self.ratio, self.latent_size = 0.0, None
+
+    def _merge(self, module, args, kwargs):
+        self.unmerges.pop(module, None)
+        if self.ratio <= 0:
+            return None
+        hidden_states = args[0]
+        tokens = hidden_states.shape[1]
+        h, w = self.latent_size
+        downsample = int(math.ceil(math.sqrt(h * w // tokens)))
+        if downsample > self.max_downsample:
+            return None
+
+        h, w = math.ceil(h / downsample), math.ceil(w / downsample)
+        if h * w != tokens:
+            return None
+        dst_index = torch.zeros(
+            h // self.sy,
+            w // self.sx,
+            1,
+            device=hidden_states.device,
+            dtype=torch.int64,
+        )
+        merge, self.unmerges[module] = bipartite_soft_matching(
+            hidden_states,
+            w,
+            h,
+            self.sx,
+            self.sy,
+            int(tokens * self.ratio),
+            dst_index,
+        )
+        return (merge(hidden_states),) + args[1:], kwargs
+
+    def _unmerge(self, module, args, output):
+        unmerge = self.unmerges.pop(module, None)
+        if unmerge is None:
+            return None
+        return unmerge(output)